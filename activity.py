@@ -0,0 +1,109 @@
+from array import array
+from threading import Lock
+from time import time
+from typing import List, Optional
+
+
+class ActivityLog:
+    # records the on/off state of the last 24 hours with second resolution. The state is stored as a ring of bits
+    # (one bit per second). Additionally, the cumulative active seconds are stored at the start of each block of 64 seconds.
+    # The active seconds of an arbitrary window are answered in constant time by subtracting two cumulative values.
+    # The ring is written on state transitions only. It holds one block more than a day, so that a window of a full day
+    # starting within the oldest block is still covered
+
+    SECONDS = 24 * 60 * 60
+    BLOCK_SECONDS = 64
+    RING_SECONDS = SECONDS + BLOCK_SECONDS
+    BLOCKS = RING_SECONDS // BLOCK_SECONDS
+
+    def __init__(self, now: Optional[float] = None):
+        self.__lock = Lock()
+        self.__bits = bytearray(self.RING_SECONDS // 8)
+        self.__block_cum = array('Q', [0] * self.BLOCKS)
+        self.__is_active = False
+        self.__filled_until = int(time() if now is None else now)   # absolute second (exclusive)
+        self.__cum_at_filled = 0
+        self.__block_cum[(self.__filled_until // self.BLOCK_SECONDS) % self.BLOCKS] = 0
+        self.__oldest = self.__filled_until
+
+    @property
+    def is_active(self) -> bool:
+        return self.__is_active
+
+    def set_active(self, is_active: bool, now: Optional[float] = None):
+        with self.__lock:
+            if is_active != self.__is_active:
+                self.__fill(int(time() if now is None else now))
+                self.__is_active = is_active
+
+    def __fill(self, until: int):
+        # writes the current state for the seconds [filled_until, until)
+        if until <= self.__filled_until:
+            return
+        t = self.__filled_until
+        active = 1 if self.__is_active else 0
+        cum = self.__cum_at_filled
+        if until - t > self.RING_SECONDS:
+            # older seconds would be overwritten anyway
+            skipped = ((until - self.RING_SECONDS) // self.BLOCK_SECONDS) * self.BLOCK_SECONDS - t
+            if skipped > 0:
+                cum += skipped * active
+                t += skipped
+                self.__block_cum[(t // self.BLOCK_SECONDS) % self.BLOCKS] = cum
+                self.__oldest = t
+        block_byte = bytes([0xFF if active else 0x00]) * (self.BLOCK_SECONDS // 8)
+        while t < until:
+            if t % self.BLOCK_SECONDS == 0:
+                self.__block_cum[(t // self.BLOCK_SECONDS) % self.BLOCKS] = cum
+                if until - t >= self.BLOCK_SECONDS:
+                    # fast path: a complete block
+                    pos = (t % self.RING_SECONDS) // 8
+                    self.__bits[pos:pos + len(block_byte)] = block_byte
+                    cum += self.BLOCK_SECONDS * active
+                    t += self.BLOCK_SECONDS
+                    continue
+            pos = t % self.RING_SECONDS
+            if active:
+                self.__bits[pos >> 3] |= (1 << (pos & 7))
+            else:
+                self.__bits[pos >> 3] &= ~(1 << (pos & 7)) & 0xFF
+            cum += active
+            t += 1
+        self.__filled_until = until
+        self.__cum_at_filled = cum
+        self.__oldest = max(self.__oldest, ((until // self.BLOCK_SECONDS) - self.BLOCKS + 1) * self.BLOCK_SECONDS)
+
+    def __cumulative(self, t: int) -> int:
+        # cumulative active seconds at absolute second t (exclusive)
+        if t >= self.__filled_until:
+            return self.__cum_at_filled + (t - self.__filled_until) * (1 if self.__is_active else 0)
+        t = max(t, self.__oldest)
+        block_start = (t // self.BLOCK_SECONDS) * self.BLOCK_SECONDS
+        cum = self.__block_cum[(t // self.BLOCK_SECONDS) % self.BLOCKS]
+        offset = t - block_start
+        if offset > 0:
+            pos = (block_start % self.RING_SECONDS) // 8
+            block_bits = int.from_bytes(self.__bits[pos:pos + self.BLOCK_SECONDS // 8], 'little')
+            cum += bin(block_bits & ((1 << offset) - 1)).count('1')
+        return cum
+
+    def active_secs(self, window_secs: int, now: Optional[float] = None) -> int:
+        # active seconds of the last window_secs seconds (max 24 hours)
+        return self.active_secs_of_windows([window_secs], now)[0]
+
+    def active_secs_of_windows(self, windows_secs: List[int], now: Optional[float] = None) -> List[int]:
+        # active seconds of several windows ending now. The cumulative value of the end is looked up once
+        with self.__lock:
+            end = int(time() if now is None else now)
+            cum_end = None
+            active_secs = []
+            for window_secs in windows_secs:
+                start = end - min(window_secs, self.SECONDS)
+                if start >= self.__filled_until:
+                    # no transition within the window (the usual case)
+                    active_secs.append((end - start) if self.__is_active else 0)
+                else:
+                    if cum_end is None:
+                        cum_end = self.__cumulative(end)
+                    active_secs.append(cum_end - self.__cumulative(start))
+            return active_secs
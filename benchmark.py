@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import random
+import asyncio
+import logging
+import tempfile
+import statistics
+from threading import Thread
+from time import monotonic, sleep
+from typing import List, Dict, Any, Optional
+import tornado.web
+from tornado.netutil import bind_sockets
+from tornado.httpserver import HTTPServer
+from heater import Heater
+from heater_webthing import HeaterThing, ShellyEventHandler
+from shelly_simulator import ShellySimulator
+
+
+def rss_kb() -> int:
+    # current resident set size. Falls back to the peak size, if /proc is not available
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except Exception:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentiles(values: List[float]) -> Dict[str, Any]:
+    if len(values) == 0:
+        return {"count": 0}
+    values = sorted(values)
+    return {"count": len(values),
+            "mean": round(statistics.mean(values) * 1000, 1),
+            "p50": round(values[len(values) // 2] * 1000, 1),
+            "p95": round(values[min(len(values) - 1, int(len(values) * 0.95))] * 1000, 1),
+            "max": round(values[-1] * 1000, 1)}
+
+
+class Benchmark:
+    # drives a Heater and its HeaterThing against a ShellySimulator and reports sync cycle latency, command to state
+    # latency (until the relays and the thing reflect the command), device requests per sync cycle and cpu/rss over time
+
+    def __init__(self,
+                 duration_sec: float = 60,
+                 latency_sec: float = 0.02,
+                 error_rate: float = 0,
+                 num_rods: int = 3,
+                 command_period_sec: float = 5,
+                 sample_period_sec: float = 5,
+                 push: bool = False,
+                 auto_off_sec: float = None):
+        self.duration_sec = duration_sec
+        self.command_period_sec = command_period_sec
+        self.sample_period_sec = sample_period_sec
+        self.push = push
+        self.simulator = ShellySimulator(num_switches=num_rods, latency_sec=latency_sec, latency_jitter_sec=latency_sec / 2, error_rate=error_rate, auto_off_sec=auto_off_sec)
+        self.sync_latencies: List[float] = []
+        self.sync_requests: List[int] = []
+        self.command_latencies: List[float] = []
+        self.command_timeouts = 0
+        self.samples: List[Dict[str, Any]] = []
+        self.__loop = asyncio.new_event_loop()
+        self.__thing: Optional[HeaterThing] = None
+
+    def __run_loop(self):
+        asyncio.set_event_loop(self.__loop)
+        self.__loop.run_forever()
+
+    async def __create_thing(self, heater: Heater, sockets) -> HeaterThing:
+        # created on the loop of the benchmark, which serves as ioloop of the thing (and of the callback handler)
+        thing = HeaterThing("benchmark", heater)
+        if sockets is not None:
+            server = HTTPServer(tornado.web.Application([(r'/shelly/event', ShellyEventHandler, ShellyEventHandler.args({None: heater}))]))
+            server.add_sockets(sockets)
+        return thing
+
+    def __instrument_sync(self, heater: Heater):
+        # measures each run of the sync job of the heater. The job is registered on startup
+        while len([job for job in heater.scheduler.jobs if job.name == "sync"]) == 0:
+            sleep(0.01)
+        job = [job for job in heater.scheduler.jobs if job.name == "sync"][0]
+        sync = job.func
+
+        def measured_sync():
+            requests = self.simulator.total_requests
+            started = monotonic()
+            sync()
+            self.sync_latencies.append(monotonic() - started)
+            self.sync_requests.append(self.simulator.total_requests - requests)
+        job.func = measured_sync
+
+    def __command(self, heater: Heater, target: int):
+        started = monotonic()
+        heater.set_heating_rods_active(target, reason="benchmark")
+        deadline = started + self.command_period_sec
+        while monotonic() < deadline:
+            relays = len([output for output in self.simulator.outputs.values() if output])
+            if relays == target and self.__thing.heating_rods_active.get() == target:
+                self.command_latencies.append(monotonic() - started)
+                return
+            sleep(0.005)
+        self.command_timeouts += 1
+
+    @staticmethod
+    def __cpu_secs() -> float:
+        times = os.times()
+        return times.user + times.system
+
+    def __sample(self, started: float, last_sample: float, cpu_secs_before: float):
+        now = monotonic()
+        self.samples.append({"time": round(now - started, 1),
+                             "cpu_percent": round(100 * (self.__cpu_secs() - cpu_secs_before) / max(0.001, now - last_sample), 1),
+                             "rss_kb": rss_kb(),
+                             "requests": self.simulator.total_requests})
+
+    def run(self) -> Dict[str, Any]:
+        self.simulator.start()
+        Thread(target=self.__run_loop, name="benchmark loop", daemon=True).start()
+        sockets = None
+        callback_addr = None
+        if self.push:
+            sockets = bind_sockets(0, "127.0.0.1")
+            callback_addr = "http://127.0.0.1:" + str(sockets[0].getsockname()[1])
+        with tempfile.TemporaryDirectory() as directory:
+            heater = Heater(self.simulator.addr, directory, callback_addr, num_heating_rods=len(self.simulator.switches), state_file=os.path.join(directory, "heater_state.bin"))
+            self.__thing = asyncio.run_coroutine_threadsafe(self.__create_thing(heater, sockets), self.__loop).result()
+            heater.start()
+            self.__instrument_sync(heater)
+            started = monotonic()
+            end = started + self.duration_sec
+            next_command, next_sample = started, started + self.sample_period_sec
+            last_sample, cpu_secs = started, self.__cpu_secs()
+            try:
+                while monotonic() < end:
+                    if monotonic() >= next_command:
+                        self.__command(heater, random.randint(0, heater.heating_rods))
+                        next_command += self.command_period_sec
+                    if monotonic() >= next_sample:
+                        self.__sample(started, last_sample, cpu_secs)
+                        last_sample, cpu_secs = monotonic(), self.__cpu_secs()
+                        next_sample += self.sample_period_sec
+                    sleep(max(0.0, min(next_command, next_sample, end) - monotonic()))
+            finally:
+                heater.stop()
+                self.simulator.stop()
+                self.__loop.call_soon_threadsafe(self.__loop.stop)
+        return self.report()
+
+    def report(self) -> Dict[str, Any]:
+        return {"sync_cycle_latency_ms": percentiles(self.sync_latencies),
+                "requests_per_sync_cycle": round(statistics.mean(self.sync_requests), 2) if len(self.sync_requests) > 0 else None,
+                "command_to_state_latency_ms": percentiles(self.command_latencies),
+                "command_timeouts": self.command_timeouts,
+                "requests": dict(self.simulator.requests),
+                "simulated_errors": self.simulator.errors,
+                "samples": self.samples}
+
+
+if __name__ == '__main__':
+    # e.g. python benchmark.py 60 0.02 0.01 push (duration sec, simulated latency sec, simulated error rate, optional push mode)
+    logging.basicConfig(format='%(asctime)s %(name)-20s: %(levelname)-8s %(message)s', level=logging.WARNING, datefmt='%Y-%m-%d %H:%M:%S')
+    benchmark = Benchmark(duration_sec=float(sys.argv[1]) if len(sys.argv) > 1 else 60,
+                          latency_sec=float(sys.argv[2]) if len(sys.argv) > 2 else 0.02,
+                          error_rate=float(sys.argv[3]) if len(sys.argv) > 3 else 0,
+                          push=len(sys.argv) > 4 and sys.argv[4] == "push")
+    print(json.dumps(benchmark.run(), indent=2))
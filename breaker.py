@@ -0,0 +1,83 @@
+import logging
+from random import uniform
+from threading import Lock
+from time import monotonic
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # protects callers from an unreachable device. After failure_threshold consecutive failures the circuit opens and calls
+    # fail fast. After a backoff (exponential with jitter) the circuit becomes half-open and a single trial call is let through.
+    # If it succeeds the circuit is closed again, otherwise it reopens with an increased backoff
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 2, backoff_sec: float = 2, max_backoff_sec: float = 5 * 60):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.backoff_sec = backoff_sec
+        self.max_backoff_sec = max_backoff_sec
+        self.__lock = Lock()
+        self.__state = self.CLOSED
+        self.__failures = 0
+        self.__openings = 0
+        self.__retry_time = 0.0
+        self.__is_trial_running = False
+        self.__listener = lambda: None    # "empty" listener
+
+    def set_listener(self, listener):
+        self.__listener = listener
+
+    @property
+    def state(self) -> str:
+        with self.__lock:
+            if self.__state == self.OPEN and monotonic() >= self.__retry_time:
+                return self.HALF_OPEN
+            return self.__state
+
+    def before_call(self):
+        # raises CircuitOpenError, if the call is not permitted
+        with self.__lock:
+            if self.__state == self.CLOSED:
+                return
+            if self.__state == self.OPEN and monotonic() >= self.__retry_time:
+                self.__state = self.HALF_OPEN
+            if self.__state == self.HALF_OPEN and not self.__is_trial_running:
+                self.__is_trial_running = True
+                return
+            raise CircuitOpenError("circuit of " + self.name + " is open (retry in " + str(max(0, round(self.__retry_time - monotonic()))) + " sec)")
+
+    def on_success(self):
+        with self.__lock:
+            changed = self.__state != self.CLOSED
+            self.__state = self.CLOSED
+            self.__failures = 0
+            self.__openings = 0
+            self.__is_trial_running = False
+        if changed:
+            logging.info("circuit of " + self.name + " closed")
+            self.__listener()
+
+    def on_failure(self) -> bool:
+        # returns True, if the circuit has been opened
+        with self.__lock:
+            self.__failures += 1
+            self.__is_trial_running = False
+            if self.__state == self.HALF_OPEN or self.__failures >= self.failure_threshold:
+                backoff_sec = min(self.max_backoff_sec, self.backoff_sec * (2 ** self.__openings))
+                backoff_sec = uniform(backoff_sec / 2, backoff_sec)
+                self.__openings += 1
+                self.__retry_time = monotonic() + backoff_sec
+                changed = self.__state != self.OPEN
+                self.__state = self.OPEN
+            else:
+                return False
+        if changed:
+            logging.warning("circuit of " + self.name + " opened (retry in " + str(round(backoff_sec)) + " sec)")
+            self.__listener()
+        return changed
@@ -0,0 +1,40 @@
+import time
+from datetime import datetime
+from threading import Lock
+
+
+class Clock:
+    # source of the current time. Replaced by a VirtualClock to run the heater logic faster than real time (see replay)
+
+    def now(self) -> datetime:
+        return datetime.now()
+
+    def time(self) -> float:
+        return time.time()
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+
+class VirtualClock(Clock):
+    # time advances only by calling advance_to. The monotonic time equals the (virtual) epoch time
+
+    def __init__(self, start: datetime):
+        self.__lock = Lock()
+        self.__time = start.timestamp()
+
+    def now(self) -> datetime:
+        return datetime.fromtimestamp(self.__time)
+
+    def time(self) -> float:
+        return self.__time
+
+    def monotonic(self) -> float:
+        return self.__time
+
+    def advance_to(self, timestamp: float):
+        with self.__lock:
+            self.__time = max(self.__time, timestamp)
+
+
+SYSTEM_CLOCK = Clock()
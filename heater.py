@@ -1,155 +1,483 @@
 import logging
-from datetime import datetime, timedelta
-from typing import List, Optional
-from threading import Thread
+import re
+from os import path
+from datetime import datetime, timedelta, date
+from typing import List, Optional, Dict, Any, Iterator
 from redzoo.math.display import duration
-from time import sleep
 from threading import RLock
-from redzoo.database.simple import SimpleDB
-from shelly import Shelly3Pro, SHELLY_SCRIPT_TEMPLATE
+from concurrent.futures import Future
+from shelly import Shelly3Pro, SwitchStatus, SHELLY_SCRIPT_TEMPLATE, SCRIPT_AUTO_OFF_SEC, HEATER_ROD_POWER
+from scheduler import Scheduler, Job
+from clock import Clock, SYSTEM_CLOCK
+from activity import ActivityLog
+from journal import TransitionJournal
+from state_segment import StateSegment
+from history_export import export
 
 
 
 
 
 class HeatingRod:
+    RETRY_BACKOFF_SEC = 2
+    RETRY_MAX_BACKOFF_SEC = 60
 
-    def __init__(self, shelly: Shelly3Pro, id: int, directory: str):
+    def __init__(self, shelly: Shelly3Pro, id: int, journal: TransitionJournal, clock: Clock = SYSTEM_CLOCK):
         self.__shelly = shelly
-        self.last_activation_time = datetime.now()
-        self.last_deactivation_time = datetime.now()
+        self.__clock = clock
+        self.last_activation_time = self.__clock.now()
+        self.last_deactivation_time = self.__clock.now()
         self.id = id
         self.is_activated = False
-        self.__heating_secs_per_day = SimpleDB("heater_" + str(id), sync_period_sec=60, directory=directory)
-        self.deactivate()
-        self.__minute_of_day_active = [False] * 24*60
-        Thread(target=self.__record_loop, daemon=True).start()
-        Thread(target=self.__clean_loop, daemon=True).start()
-
-    def sync(self):
+        self.__heating_time_listener = lambda heating_rod, heating_secs: None    # "empty" listener
+        self.__energy_listener = lambda heating_rod, energy_wh, counter_wh, is_complete: None    # "empty" listener
+        self.measured_power: Optional[float] = None
+        self.__last_energy_counter: Optional[float] = None
+        self.__journal = journal
+        self.__activity = ActivityLog(clock.time())
+        self.__lock = RLock()
+        self.__observed: Optional[bool] = None       # unknown until the first sync
+        self.__is_command_pending = True             # the rod will be switched off on the first sync, if on
+        self.__retries = 0
+        self.__next_retry_time = self.__clock.now()
+        self.__pending_heating_secs: Optional[float] = None
+        # observations of the device started before this (monotonic) time, i.e. before the last change of the desired state
+        # or the completion of the last command, are outdated. While a command is in flight, observations are ignored
+        self.__last_command_time = float("-inf")
+        self.__commands_in_flight = 0
+
+    def set_heating_time_listener(self, listener):
+        self.__heating_time_listener = listener
+
+    def set_energy_listener(self, listener):
+        self.__energy_listener = listener
+
+    def update_meter(self, status: SwitchStatus):
+        # takes over the power and energy counter measured by the device. After a restart, the energy is counted from the
+        # last journaled counter reading
+        self.measured_power = status.power
+        if status.energy is not None:
+            if self.__last_energy_counter is None:
+                self.__last_energy_counter = self.__journal.energy_counter(self.id)
+            if self.__last_energy_counter is None:
+                # the energy consumed before the first reading is unknown
+                self.__energy_listener(self, 0, status.energy, False)
+            elif status.energy >= self.__last_energy_counter:
+                if status.energy > self.__last_energy_counter:
+                    self.__energy_listener(self, status.energy - self.__last_energy_counter, status.energy, True)
+            else:
+                # the energy consumed between the last reading and the reset is unknown
+                logging.info(self.__str__() + " energy counter has been reset")
+                self.__energy_listener(self, status.energy, status.energy, False)
+            self.__last_energy_counter = status.energy
+
+    def sync(self, new_is_activated: Optional[bool] = None, observed_at: Optional[float] = None):
+        # reconciles the desired state (is_activated) and the state observed on the device. Changes made
+        # on the device (manual switching, firmware auto-off) are taken over, if no command is outstanding.
+        # observed_at is the (monotonic) start time of the query or the receive time of the pushed event
         try:
-            new_is_activated = self.__shelly.query(self.id)
-            if new_is_activated == False and self.is_activated == True:
-                self.deactivate(reason="due to sync")
-            elif new_is_activated == True and self.is_activated == False:
-                self.activate(reason="due to sync")
+            if new_is_activated is None:
+                observed_at = self.__clock.monotonic()
+                new_is_activated = self.__shelly.query(self.id)
+            elif observed_at is None:
+                observed_at = self.__clock.monotonic()
+            with self.__lock:
+                if self.__commands_in_flight > 0 or observed_at < self.__last_command_time:
+                    logging.debug(self.__str__() + " ignoring outdated observation (" + ("on" if new_is_activated else "off") + ")")
+                    return
+                self.__observed = new_is_activated
+                if self.__is_command_pending:
+                    if self.__observed == self.is_activated:
+                        self.__is_command_pending = False
+                        self.__retries = 0
+                elif new_is_activated != self.is_activated:
+                    self.__set_activated(new_is_activated, reason="due to sync")
+            self.__notify()
+            self.reconcile()
         except Exception as e:
             logging.warning("sync failed: " + str(e))
 
-    def activate(self, reason: str = None):
-        self.last_activation_time = datetime.now()
-        if not self.is_activated:
+    def reconcile(self):
+        # sends the switch command only, if the desired state differs from the observed one. Failed commands are retried with backoff.
+        # The lock of the rod is not held while sending
+        is_activated = self.begin_command()
+        if is_activated is None:
+            return
+        try:
+            self.__shelly.switch(self.id, is_activated)
+            self.command_completed(is_activated=is_activated)
+        except Exception as e:
+            self.command_completed(e, is_activated)
+
+    @property
+    def is_command_pending(self) -> bool:
+        return self.__is_command_pending
+
+    def is_command_due(self) -> bool:
+        with self.__lock:
+            if not self.__is_command_pending:
+                return False
+            if self.__observed == self.is_activated:
+                self.__is_command_pending = False
+                self.__retries = 0
+                return False
+            return self.__clock.now() >= self.__next_retry_time
+
+    def begin_command(self) -> Optional[bool]:
+        # returns the state to be sent, if a command is due and no other one is in flight. The caller has to call command_completed
+        with self.__lock:
+            if self.__commands_in_flight > 0 or not self.is_command_due():
+                return None
+            self.__commands_in_flight += 1
+            return self.is_activated
+
+    def command_completed(self, error: Optional[Exception] = None, is_activated: Optional[bool] = None):
+        # is_activated is the state sent by the command (default: the desired state). The desired state may have changed meanwhile
+        with self.__lock:
+            self.__commands_in_flight = max(0, self.__commands_in_flight - 1)
+            self.__last_command_time = self.__clock.monotonic()
+            sent = self.is_activated if is_activated is None else is_activated
+            if error is None:
+                self.__observed = sent
+                if sent == self.is_activated:
+                    self.__is_command_pending = False
+                    self.__retries = 0
+            else:
+                backoff_sec = min(self.RETRY_MAX_BACKOFF_SEC, self.RETRY_BACKOFF_SEC * (2 ** self.__retries))
+                self.__retries += 1
+                self.__next_retry_time = self.__clock.now() + timedelta(seconds=backoff_sec)
+                logging.warning(self.__str__() + " could not be switched " + ("on" if sent else "off") + " (retry in " + str(backoff_sec) + " sec) " + str(error))
+
+    def activate(self, reason: str = None, send: bool = True):
+        # send=False, if the switch command is sent by the caller (see Heater.set_heating_rods_active)
+        with self.__lock:
+            self.__set_activated(True, reason)
+            self.__command()
+        self.__notify()
+        if send:
+            self.reconcile()
+
+    def deactivate(self, reason: str = None, send: bool = True):
+        with self.__lock:
+            self.__set_activated(False, reason)
+            self.__command()
+        self.__notify()
+        if send:
+            self.reconcile()
+
+    def __command(self):
+        self.__last_command_time = self.__clock.monotonic()
+        if self.__observed != self.is_activated:
+            self.__is_command_pending = True
+            self.__next_retry_time = self.__clock.now()
+            self.__retries = 0
+
+    def __notify(self):
+        # the heating time listener takes the lock of the heater. It is called without holding the lock of the rod
+        with self.__lock:
+            heating_secs, self.__pending_heating_secs = self.__pending_heating_secs, None
+        if heating_secs is not None:
+            self.__heating_time_listener(self, heating_secs)
+
+    def __set_activated(self, is_activated: bool, reason: str = None):
+        if is_activated == self.is_activated:
+            return
+        if is_activated:
+            self.last_activation_time = self.__clock.now()
             info = ""
             if reason is not None:
                 info = "(" + reason + ")"
             logging.info(self.__str__() + " activated " + info)
-        self.__shelly.switch(self.id, True)
-        self.is_activated = True
-
-    def deactivate(self, reason: str = None):
-        try:
-            if self.is_activated:
-                self.last_deactivation_time = datetime.now()
-                heating_time = (datetime.now() - self.last_activation_time)
-                day = datetime.now().strftime('%j')
-                self.__heating_secs_per_day.put(day, self.__heating_secs_per_day.get(day, 0) + heating_time.total_seconds(), ttl_sec=366*24*60*60)
-                info = "heating time " + duration(heating_time.total_seconds(), 1)
-                if reason is not None:
-                    info = reason + "; " + info
-                logging.info(self.__str__() + " deactivated (" + info + ")")
-            self.__shelly.switch(self.id, False)
-            self.is_activated = False
-        except Exception as e:
-            logging.warning("error occurred deactivating " + str(e))
-
-    def heating_secs_of_day(self, day_of_year: int) -> Optional[int]:
-        secs = self.__heating_secs_per_day.get(str(day_of_year), -1)
-        if secs > 0:
-            return secs
+            self.__journal.append(self.id, True, self.__clock.time())
+            self.measured_power = None      # unknown until the next reading
+            self.is_activated = True
+            self.__activity.set_active(True, self.__clock.time())
         else:
-            return None
-
-    def __clean_loop(self):
-        while True:
-            try:
-                tomorrow = (datetime.now() + timedelta(days=1)).strftime('%j')
-                self.__heating_secs_per_day.put(tomorrow, 0)
-            except Exception as e:
-                logging.warning(str(e))
-            sleep(59 * 60)
-
+            self.last_deactivation_time = self.__clock.now()
+            heating_time = (self.__clock.now() - self.last_activation_time)
+            info = "heating time " + duration(heating_time.total_seconds(), 1)
+            if reason is not None:
+                info = reason + "; " + info
+            logging.info(self.__str__() + " deactivated (" + info + ")")
+            self.__journal.append(self.id, False, self.__clock.time())
+            self.measured_power = None
+            self.is_activated = False
+            self.__activity.set_active(False, self.__clock.time())
+            self.__pending_heating_secs = heating_time.total_seconds()     # notified by __notify
 
-    def __record_loop(self):
-        while True:
-            try:
-                now = datetime.now()
-                minutes_of_day = now.hour*60 + now.minute
-                self.__minute_of_day_active[minutes_of_day] = self.is_activated
-            except Exception as e:
-                logging.warning(str(e))
-            sleep(35)
+    def heating_secs(self, window_size_minutes: int) -> int:
+        return self.__activity.active_secs(window_size_minutes * 60, self.__clock.time())
 
-    def consumed_power(self, window_size_minutes: int) -> int:
-        now = datetime.now()
-        minutes_of_day = now.hour*60 + now.minute
-        if minutes_of_day > window_size_minutes:
-            watt_minutes= 0
-            for minute in (minutes_of_day-window_size_minutes, minutes_of_day):
-                if self.__minute_of_day_active[minute]:
-                    watt_minutes += 1
-            if watt_minutes > 0:
-                return round(60 * window_size_minutes / watt_minutes)
-        return 0
+    def heating_secs_of_windows(self, windows_minutes: List[int]) -> List[int]:
+        return self.__activity.active_secs_of_windows([window_size_minutes * 60 for window_size_minutes in windows_minutes], self.__clock.time())
 
     def __str__(self):
         return "heating rod " + str(self.id)
 
 
-class Heater:
-    HEATER_ROD_POWER = 500
+class HeaterSnapshot:
+    # immutable state of a heater published by the sync loop. The version is increased, if the state has changed
+
+    def __init__(self,
+                 version: int,
+                 time: datetime,
+                 power: int,
+                 heating_rod_power: int,
+                 heating_rods: int,
+                 heating_rods_active: int,
+                 target_heating_rods_active: int,
+                 heating_rods_activated: Dict[int, bool],
+                 heater_consumption_today: int,
+                 heater_consumption_current_year: int,
+                 device_connection: str,
+                 startup_state: str,
+                 heater_consumption_estimated_year: int = 0,
+                 heater_consumption_last_15_min: int = 0,
+                 heater_consumption_last_30_min: int = 0,
+                 heater_consumption_last_60_min: int = 0,
+                 last_time_power_updated: datetime = None,
+                 last_time_heating: datetime = None):
+        self.version = version
+        self.time = time
+        self.power = power
+        self.heating_rod_power = heating_rod_power
+        self.heating_rods = heating_rods
+        self.heating_rods_active = heating_rods_active
+        self.target_heating_rods_active = target_heating_rods_active
+        self.heating_rods_activated = heating_rods_activated
+        self.heater_consumption_today = heater_consumption_today
+        self.heater_consumption_current_year = heater_consumption_current_year
+        self.device_connection = device_connection
+        self.startup_state = startup_state
+        self.heater_consumption_estimated_year = heater_consumption_estimated_year
+        self.heater_consumption_last_15_min = heater_consumption_last_15_min
+        self.heater_consumption_last_30_min = heater_consumption_last_30_min
+        self.heater_consumption_last_60_min = heater_consumption_last_60_min
+        self.last_time_power_updated = last_time_power_updated
+        self.last_time_heating = last_time_heating
+
+    def same_state(self, other: "HeaterSnapshot") -> bool:
+        return other is not None and \
+               {name: value for name, value in self.__dict__.items() if name not in ["version", "time"]} == \
+               {name: value for name, value in other.__dict__.items() if name not in ["version", "time"]}
 
-    def __init__(self, addr: str, directory: str):
+
+class Heater:
+    HEATER_ROD_POWER = HEATER_ROD_POWER
+    SYNC_PERIOD_SEC = 4              # default floor of the adaptive sync period
+    SYNC_PERIOD_ACTIVE_SEC = 15      # while rods are active
+    SYNC_PERIOD_IDLE_SEC = 5 * 60    # default ceiling of the adaptive sync period
+    SYNC_PERIOD_PUSH_SEC = 90        # default ceiling, if state changes are pushed by the device (safety reconcile)
+    SYNC_IDLE_BACKOFF_RATIO = 0.1    # the longer all rods are off, the less likely is a change
+    COMMAND_SETTLE_SEC = 30          # time after a command, in which the switch states are polled with the floor period
+    AUTO_OFF_WINDOW_SEC = 30         # time around the auto-off deadline of the script, in which the switch states are polled with the floor period
+    JOURNAL_COMMIT_PERIOD_SEC = 5
+    JOURNAL_HEARTBEAT_PERIOD_SEC = 60    # while a rod is on. Bounds the heating time lost by a crash
+    STATE_DIRECTORY = "/dev/shm"     # tmpfs. The state segment is rewritten on each sync
+    STARTUP_WARMING_UP = "warming up"
+    STARTUP_LOADING_HISTORY = "loading history"
+    STARTUP_INITIALIZING_DEVICE = "initializing device"
+    STARTUP_DEVICE_UNREACHABLE = "device unreachable"
+    STARTUP_READY = "ready"
+    AUTO_DECREASE_MIN = 23
+    SCRIPT_DEPLOY_RETRY_SEC = 5 * 60
+
+    def __init__(self,
+                 addr: str,
+                 directory: str,
+                 callback_addr: str = None,
+                 num_heating_rods: int = 3,
+                 scheduler: Scheduler = None,
+                 name: str = None,
+                 min_step_interval_sec: float = 0,
+                 min_sync_period_sec: float = None,
+                 max_sync_period_sec: float = None,
+                 auto_decrease_min: float = AUTO_DECREASE_MIN,
+                 shelly: Shelly3Pro = None,
+                 clock: Clock = SYSTEM_CLOCK,
+                 state_file: str = None):
+        # shelly and clock may be replaced, e.g. to replay traces in virtual time (see replay).
+        # The state is published to state_file (see default_state_file) for out-of-process readers (see StateSegmentReader)
         self.__lock = RLock()
+        self.__command_lock = RLock()     # held while sending switch commands (without holding the lock of the heater)
+        self.__clock = clock
         self.__is_running = True
+        self.name = name
+        self.__callback_addr = callback_addr
+        self.min_sync_period_sec = self.SYNC_PERIOD_SEC if min_sync_period_sec is None else min_sync_period_sec
+        self.max_sync_period_sec = (self.SYNC_PERIOD_IDLE_SEC if callback_addr is None else self.SYNC_PERIOD_PUSH_SEC) if max_sync_period_sec is None else max_sync_period_sec
+        self.__sync_job: Optional[Job] = None
+        self.__scripts_job: Optional[Job] = None
+        self.__deploy: Optional[Future] = None
         self.__listener = lambda: None    # "empty" listener
-        self.__shelly = Shelly3Pro(addr)
-        self.__heating_rods = [HeatingRod(self.__shelly, 0, directory), HeatingRod(self.__shelly, 1, directory), HeatingRod(self.__shelly, 2, directory)]
-        self.last_time_heating = datetime.now()
-        self.__last_time_auto_decreased = datetime.now()
-        self.last_time_power_updated = datetime.now()
+        self.__shelly = Shelly3Pro(addr) if shelly is None else shelly
+        # called on the event loop of the device calls, which must not wait for the lock of the heater
+        self.__shelly.set_breaker_listener(lambda: self.__scheduler.once(self.__job_name("connection change"), self.__on_change))
+        self.__is_scheduler_owner = scheduler is None
+        self.__scheduler = Scheduler("heater scheduler", clock) if scheduler is None else scheduler
+        self.auto_decrease_min = auto_decrease_min
+        self.__jobs = []
+        self.min_step_interval_sec = min_step_interval_sec
+        self.__target_heating_rods_active = 0
+        self.__ramp_job = None
+        self.__ramp_reason: Optional[str] = None
+        self.__last_step_time = float("-inf")        # monotonic
+        self.__directory = directory
+        self.__journal = TransitionJournal(directory, clock=clock)      # loaded on startup (see start)
+        self.startup_state = self.STARTUP_WARMING_UP
+        self.__heating_rods = [HeatingRod(self.__shelly, id, self.__journal, clock) for id in range(0, num_heating_rods)]
+        self.last_time_heating = self.__clock.now()
+        self.__last_time_auto_decreased = self.__clock.now()
+        self.last_time_power_updated = self.__clock.now()
         self.__show_total_status = True
+        self.__aggregated_day = self.__clock.now().date()
+        self.__consumption_before_today = 0
+        self.__consumption_today = 0
+        self.__snapshot: Optional[HeaterSnapshot] = None
+        self.__state_segment = StateSegment(self.default_state_file(directory, name) if state_file is None else state_file)
+        logging.info("state of heater " + ("" if name is None else name + " ") + "is published to " + self.__state_segment.filename)
+        for heating_rod in self.__heating_rods:
+            heating_rod.set_heating_time_listener(self.__on_heating_time)
+            heating_rod.set_energy_listener(self.__on_energy)
 
     def set_listener(self, listener):
         self.__listener = listener
 
-    def __heater_consumption_per_day(self, day_of_year: int) -> int:
-        secs_list = [heating_rod.heating_secs_of_day(day_of_year) for heating_rod in self.__heating_rods]
-        heater_secs_today = sum([secs for secs in secs_list if secs is not None])
-        heater_hours_today = heater_secs_today / (60*60)
-        return int(heater_hours_today * self.HEATER_ROD_POWER)
+    @staticmethod
+    def default_state_file(directory: str, name: str = None) -> str:
+        # on the tmpfs STATE_DIRECTORY, if available. It is shared by the heater processes of the host, so the file name is derived
+        # from the directory, e.g. heater_var_lib_heater_state.bin (fleet: heater_var_lib_heater_<name>_state.bin).
+        # Otherwise heater_state.bin (fleet: heater_<name>_state.bin) in the directory
+        suffix = ("" if name is None else "_" + name) + "_state.bin"
+        if path.isdir(Heater.STATE_DIRECTORY):
+            return path.join(Heater.STATE_DIRECTORY, "heater_" + re.sub("[^A-Za-z0-9]+", "_", path.abspath(directory)).strip("_") + suffix)
+        return path.join(directory, "heater" + suffix)
+
+    def __on_change(self):
+        self.__publish_snapshot()
+        self.__listener()
+
+    def __publish_snapshot(self):
+        with self.__lock:
+            consumed_power_15, consumed_power_30, consumed_power_60 = self.__consumed_powers([15, 30, 60])
+            snapshot = HeaterSnapshot(0 if self.__snapshot is None else self.__snapshot.version,
+                                      self.__clock.now(),
+                                      self.power,
+                                      self.HEATER_ROD_POWER,
+                                      self.heating_rods,
+                                      self.heating_rods_active,
+                                      self.__target_heating_rods_active,
+                                      {heating_rod.id: heating_rod.is_activated for heating_rod in self.__heating_rods},
+                                      self.heater_consumption_today,
+                                      self.heater_consumption_current_year,
+                                      self.device_connection,
+                                      self.startup_state,
+                                      self.heater_consumption_estimated_year,
+                                      consumed_power_15,
+                                      consumed_power_30,
+                                      consumed_power_60,
+                                      self.last_time_power_updated,
+                                      self.last_time_heating)
+            if not snapshot.same_state(self.__snapshot):
+                snapshot.version += 1
+            self.__snapshot = snapshot
+            self.__state_segment.write(snapshot)     # also on unchanged state, to keep the time of the record current
 
     @property
-    def heater_consumption_today(self) -> int:
-        today = int(datetime.now().strftime('%j'))
-        return self.__heater_consumption_per_day(today)
+    def snapshot(self) -> HeaterSnapshot:
+        # the latest published state. Reading it does not touch the device nor the aggregates
+        if self.__snapshot is None:
+            self.__publish_snapshot()
+        return self.__snapshot
+
+    def __import_history(self, directory: str, num_heating_rods: int):
+        # takes over the heating time of the current year recorded by former versions
+        today = self.__clock.now().date()
+        for id in range(0, num_heating_rods):
+            if not path.isfile(path.join(directory, "heater_" + str(id) + ".json.gz")):
+                continue      # e.g. a fresh install. Opening the store would create it
+            from redzoo.database.simple import SimpleDB     # only required once, on migration
+            heating_secs_per_day = SimpleDB("heater_" + str(id), directory=directory)
+            for day_of_year in range(1, today.timetuple().tm_yday + 1):
+                secs = heating_secs_per_day.get(str(day_of_year), 0)
+                if secs > 0:
+                    self.__journal.import_heating_secs(id, date(today.year, 1, 1) + timedelta(days=day_of_year-1), secs)
+        self.__journal.checkpoint()
+
+    def __consumption(self, heating_secs: float) -> int:
+        heater_hours = heating_secs / (60*60)
+        return int(heater_hours * self.HEATER_ROD_POWER)
+
+    def __consumption_of_day(self, day: date) -> int:
+        # measured by the device if available, otherwise estimated by the heating time
+        day_time = datetime.combine(day, datetime.min.time())
+        return int(sum([self.__journal.history.energy(heating_rod.id, "day", day_time, self.HEATER_ROD_POWER) for heating_rod in self.__heating_rods]))
+
+    def __init_consumption_aggregates(self):
+        # the per day history is scanned once. Afterwards, the aggregates are maintained incrementally
+        with self.__lock:
+            today = self.__clock.now().date()
+            self.__aggregated_day = today
+            self.__consumption_before_today = sum([self.__consumption_of_day(date(today.year, 1, 1) + timedelta(days=i)) for i in range(0, today.timetuple().tm_yday - 1)])
+            self.__consumption_today = self.__consumption_of_day(today)
+
+    def __roll_day(self):
+        with self.__lock:
+            today = self.__clock.now().date()
+            if today != self.__aggregated_day:
+                if today.year == self.__aggregated_day.year and today == self.__aggregated_day + timedelta(days=1):
+                    self.__consumption_before_today += self.__consumption_of_day(self.__aggregated_day)
+                    self.__consumption_today = self.__consumption_of_day(today)
+                    self.__aggregated_day = today
+                else:
+                    self.__init_consumption_aggregates()
+
+    def __on_heating_time(self, heating_rod: HeatingRod, heating_secs: float):
+        with self.__lock:
+            self.__roll_day()
+            if heating_rod.last_activation_time.date() < self.__aggregated_day:
+                # the heating session crossed midnight. The journal has split it by day
+                self.__init_consumption_aggregates()
+            else:
+                self.__consumption_today = None      # recomputed on demand
+
+    def __on_energy(self, heating_rod: HeatingRod, energy_wh: float, counter_wh: float, is_complete: bool):
+        with self.__lock:
+            self.__journal.append_energy(heating_rod.id, energy_wh, counter_wh, is_complete, self.__clock.time())
+            self.__roll_day()
+            self.__consumption_today = None      # recomputed on demand. A sync reports the energy of each rod
+
+    def __current_consumption_today(self) -> int:
+        with self.__lock:
+            self.__roll_day()
+            if self.__consumption_today is None:
+                self.__consumption_today = self.__consumption_of_day(self.__aggregated_day)
+            return self.__consumption_today
 
     @property
-    def __heater_consumption_list_current_year(self) -> List[int]:
-        current_day = int(datetime.now().strftime('%j'))
-        consumption_per_day = [self.__heater_consumption_per_day(day_of_year) for day_of_year in range(0, current_day+1)]
-        return [consumption for consumption in consumption_per_day if consumption is not None]
+    def heater_consumption_today(self) -> int:
+        return self.__current_consumption_today()
 
     @property
     def heater_consumption_current_year(self) -> int:
-        return sum(self.__heater_consumption_list_current_year)
+        with self.__lock:
+            return self.__consumption_before_today + self.__current_consumption_today()
 
     @property
     def heater_consumption_estimated_year(self) -> int:
-        consumptions_per_day = self.__heater_consumption_list_current_year
-        if len(consumptions_per_day) > 0:
-            return int(sum(consumptions_per_day) * 365 / len(consumptions_per_day))
-        else:
-            return 0
+        with self.__lock:
+            consumption = self.__consumption_before_today + self.__current_consumption_today()
+            num_days = self.__aggregated_day.timetuple().tm_yday + 1
+            return int(consumption * 365 / num_days)
+
+    def energy_history(self, start: datetime, end: datetime, bucket: str = "day") -> List[Dict[str, Any]]:
+        # consumption (kWh) per rod and in total of each hour, day, week or month bucket within [start, end)
+        return self.__journal.history.query(start, end, bucket, [heating_rod.id for heating_rod in self.__heating_rods], self.HEATER_ROD_POWER)
+
+    def export_history(self, start: datetime, end: datetime, kind: str = "day", format: str = "ndjson") -> Iterator[bytes]:
+        # heating sessions or hour, day, week or month buckets per rod within [start, end), encoded as ndjson, csv or bin
+        # and generated lazily in chunks (see history_export)
+        return export(self.__journal, start, end, kind, format, [heating_rod.id for heating_rod in self.__heating_rods], self.HEATER_ROD_POWER, self.__clock.time())
 
     @property
     def heating_rods_active(self) -> int:
@@ -157,37 +485,95 @@ class Heater:
 
     @property
     def power(self) -> int:
-        return self.HEATER_ROD_POWER * len([heating_rod for heating_rod in self.__heating_rods if heating_rod.is_activated])
+        # measured by the device if available, otherwise the nominal power of the active rods
+        power = 0
+        for heating_rod in self.__heating_rods:
+            if heating_rod.measured_power is not None:
+                power += heating_rod.measured_power
+            elif heating_rod.is_activated:
+                power += self.HEATER_ROD_POWER
+        return int(power)
 
     def consumed_power(self, window_size_minutes: int) -> int:
-        return sum([heating_rod.consumed_power(window_size_minutes) for heating_rod in self.__heating_rods])
+        # consumed energy (watt hours) of the last window_size_minutes (max 24 hours)
+        return self.__consumed_powers([window_size_minutes])[0]
 
-    def set_heating_rods_active(self, new_num: int, reason: str = None):
-        # increase
-        if self.heating_rods_active < new_num:
-            if new_num <= self.heating_rods:
-                for heating_rod in [heating_rod for heating_rod in self.__sorted_heating_rods if not heating_rod.is_activated]:
-                    heating_rod.activate()          # increase heater power (1 heater only)
-                    self.last_time_power_updated = datetime.now()
-                    logging.info(str(self.heating_rods_active) + " rods active")
-                    break
-        # decrease
-        elif new_num < self.heating_rods_active:
-            if new_num >= 0:
-                for heating_rod in [heating_rod for heating_rod in self.__sorted_heating_rods if heating_rod.is_activated]:
-                    heating_rod.deactivate(reason)        # decrease heater power consumption (1 heater only)
-                    self.last_time_power_updated = datetime.now()
-                    logging.info(str(self.heating_rods_active) + " rods active")
-                    break
-
-        if self.heating_rods_active > 0:
-            self.last_time_heating = datetime.now()
+    def __consumed_powers(self, windows_minutes: List[int]) -> List[int]:
+        heating_secs_per_rod = [heating_rod.heating_secs_of_windows(windows_minutes) for heating_rod in self.__heating_rods]
+        return [self.__consumption(sum(heating_secs)) for heating_secs in zip(*heating_secs_per_rod)]
 
+    def set_heating_rods_active(self, new_num: int, reason: str = None):
+        if new_num < 0 or new_num > self.heating_rods:
+            logging.warning("ignoring invalid number of active rods " + str(new_num))
+            return
+        with self.__command_lock:
+            with self.__lock:
+                self.__target_heating_rods_active = new_num
+                if not self.is_history_loaded:
+                    logging.info("heater is " + self.startup_state + ". " + str(new_num) + " rods will be activated after startup")
+                    return
+                self.__ramp_reason = reason
+                if self.__ramp_job is not None:
+                    return      # the pending ramp step heads for the new target
+                wait_sec = self.__last_step_time + self.min_step_interval_sec - self.__clock.monotonic()
+                if wait_sec > 0:
+                    # the last step is too recent. Repeated requests must not bypass the ramp policy
+                    self.__ramp_job = self.__scheduler.once(self.__job_name("ramp step"), self.__step_towards_target, delay_sec=wait_sec)
+                    return
+            self.__step_towards_target()
+        self.__expedite_sync()
+
+    def __step_towards_target(self):
+        # without ramp policy, all required rods are switched at once. Otherwise, one rod per min_step_interval_sec.
+        # The switch commands are sent after releasing the lock of the heater, so that the readers of the heater are not
+        # held up by the device. The command lock keeps the commands in order. The state is published with the desired
+        # state of the rods, i.e. before the commands are sent
+        with self.__command_lock:
+            with self.__lock:
+                self.__ramp_job = None
+                diff = self.__target_heating_rods_active - self.heating_rods_active
+                if diff == 0:
+                    return
+                reason = self.__ramp_reason
+                num_steps = abs(diff) if self.min_step_interval_sec <= 0 else 1
+                if diff > 0:
+                    heating_rods = [heating_rod for heating_rod in self.__sorted_heating_rods if not heating_rod.is_activated][:num_steps]
+                    for heating_rod in heating_rods:
+                        heating_rod.activate(reason, send=False)          # increase heater power
+                else:
+                    heating_rods = [heating_rod for heating_rod in self.__sorted_heating_rods if heating_rod.is_activated][:num_steps]
+                    for heating_rod in heating_rods:
+                        heating_rod.deactivate(reason, send=False)        # decrease heater power consumption
+                self.last_time_power_updated = self.__clock.now()
+                self.__last_step_time = self.__clock.monotonic()
+                logging.info(str(self.heating_rods_active) + " rods active")
+                if self.heating_rods_active > 0:
+                    self.last_time_heating = self.__clock.now()
+                if self.heating_rods_active != self.__target_heating_rods_active:
+                    self.__ramp_job = self.__scheduler.once(self.__job_name("ramp step"), self.__step_towards_target, delay_sec=self.min_step_interval_sec)
+            self.__on_change()
+            self.__switch(heating_rods)
+
+    def __switch(self, heating_rods: List[HeatingRod]):
+        # sends the switch commands of several rods concurrently
+        states = {}
+        for heating_rod in heating_rods:
+            is_activated = heating_rod.begin_command()
+            if is_activated is not None:
+                states[heating_rod.id] = is_activated
+        heating_rods = [heating_rod for heating_rod in heating_rods if heating_rod.id in states.keys()]
+        if len(heating_rods) > 0:
+            try:
+                errors = self.__shelly.switch_all(states)
+            except Exception as e:
+                errors = {id: e for id in states.keys()}
+            for heating_rod in heating_rods:
+                heating_rod.command_completed(errors.get(heating_rod.id), states[heating_rod.id])
 
     @property
     def __sorted_heating_rods(self) -> List[HeatingRod]:
         heating_rod_list = list(self.__heating_rods)
-        for i in range(0, datetime.now().day):
+        for i in range(0, self.__clock.now().day):
             heater = heating_rod_list.pop(0)
             heating_rod_list.append(heater)
         return heating_rod_list
@@ -203,7 +589,7 @@ class Heater:
         return len(self.__heating_rods)
 
     def __seconds_of_day(self) -> int:
-        now = datetime.now()
+        now = self.__clock.now()
         return now.hour * 3600 + now.minute * 60 + now.second
 
     @property
@@ -214,66 +600,195 @@ class Heater:
             pwr ="0 Watt"
         return pwr
 
+    @property
+    def shelly(self) -> Shelly3Pro:
+        return self.__shelly
+
+    @property
+    def device_connection(self) -> str:
+        # state of the circuit breaker of the device: closed (reachable), open or half_open
+        return self.__shelly.breaker_state
+
+    def __job_name(self, name: str) -> str:
+        # the heaters of a fleet share a scheduler
+        return name if self.name is None else self.name + " " + name
+
+    @property
+    def scheduler(self) -> Scheduler:
+        return self.__scheduler
+
+    @property
+    def callback_path(self) -> str:
+        return "/shelly/event" if self.name is None else "/shelly/" + self.name + "/event"
+
+    @property
+    def clock(self) -> Clock:
+        return self.__clock
+
     def __sync(self):
-        for heating_rods in self.__heating_rods:
-            heating_rods.sync()
-        self.__listener()
+        observed_at = self.__clock.monotonic()
+        self.apply_switch_states(self.__shelly.query_all(), observed_at)
+
+    def apply_switch_states(self, states: Dict[int, SwitchStatus], observed_at: float):
+        # observed_at is the (monotonic) start time of the query. Observations older than the last command of a rod are ignored
+        if not self.is_history_loaded:
+            return
+        for heating_rod in self.__heating_rods:
+            status = states.get(heating_rod.id)
+            if status is None:
+                heating_rod.sync()
+            else:
+                heating_rod.sync(status.is_on, observed_at)
+                heating_rod.update_meter(status)
+        if self.startup_state != self.STARTUP_READY:
+            self.startup_state = self.STARTUP_READY
+            logging.info("heater " + ("" if self.name is None else self.name + " ") + "is ready")
+        self.__on_change()
+
+    def on_switch_event(self, id: int, is_activated: bool, observed_at: Optional[float] = None):
+        # observed_at is the (monotonic) receive time of the event (default: now)
+        heating_rod = self.get_heating_rod(id)
+        if not self.is_history_loaded:
+            logging.info("ignoring switch event of heating rod " + str(id) + " (heater is " + self.startup_state + ")")
+        elif heating_rod is None:
+            logging.warning("got switch event of unknown heating rod " + str(id))
+        else:
+            heating_rod.sync(is_activated, self.__clock.monotonic() if observed_at is None else observed_at)
+            self.__on_change()
+            self.__expedite_sync()
+
+    def next_sync_period_sec(self) -> float:
+        # the more likely a state change is, the shorter the period: after commands and around the auto-off deadline
+        # of the script the floor is used. While all rods are off, the period grows with the idle time up to the ceiling
+        now = self.__clock.now()
+        if any([heating_rod.is_command_pending for heating_rod in self.__heating_rods]) or \
+                (now - self.last_time_power_updated).total_seconds() < self.COMMAND_SETTLE_SEC:
+            return self.min_sync_period_sec
+        active_heating_rods = [heating_rod for heating_rod in self.__heating_rods if heating_rod.is_activated]
+        if len(active_heating_rods) > 0:
+            # changes of active rods are pushed by the script, if a callback is registered
+            period_sec = self.SYNC_PERIOD_ACTIVE_SEC if self.__callback_addr is None else self.max_sync_period_sec
+            for heating_rod in active_heating_rods:
+                secs_to_window = (heating_rod.last_activation_time - now).total_seconds() + SCRIPT_AUTO_OFF_SEC - self.AUTO_OFF_WINDOW_SEC
+                if -2 * self.AUTO_OFF_WINDOW_SEC < secs_to_window <= 0:
+                    return self.min_sync_period_sec
+                elif secs_to_window > 0:
+                    period_sec = min(period_sec, secs_to_window)
+        else:
+            idle_secs = min([(now - heating_rod.last_deactivation_time).total_seconds() for heating_rod in self.__heating_rods] + [(now - self.last_time_power_updated).total_seconds()])
+            period_sec = idle_secs * self.SYNC_IDLE_BACKOFF_RATIO
+        return max(self.min_sync_period_sec, min(self.max_sync_period_sec, period_sec))
+
+    def __expedite_sync(self):
+        if self.__sync_job is not None:
+            self.__scheduler.reschedule(self.__sync_job, self.min_sync_period_sec)
 
     def stop(self):
         self.__is_running = False
+        for job in self.__jobs:
+            job.cancel()
+        with self.__lock:
+            if self.__ramp_job is not None:
+                self.__ramp_job.cancel()
+        if self.__is_scheduler_owner:
+            self.__scheduler.stop()
+        self.__journal.close()
+        with self.__lock:
+            self.__state_segment.close()
 
-    def start(self):
-        Thread(target=self.__register_scripts, daemon=True).start()
-        Thread(target=self.__measure, daemon=True).start()
-        Thread(target=self.__statistics, daemon=True).start()
-        Thread(target=self.__auto_decrease, daemon=True).start()
-        Thread(target=self.__auto_restart_scripts, daemon=True).start()
+    @property
+    def is_history_loaded(self) -> bool:
+        return self.__journal.is_loaded
+
+    def start(self, poll: bool = True, sync_job: Job = None):
+        # poll=False, if the switch states are polled externally by the given sync job (see HeaterFleet).
+        # Returns immediately. The history is loaded and the device is initialized in the background (see startup_state)
+        if not poll:
+            self.__sync_job = sync_job
+        self.__jobs.append(self.__scheduler.once(self.__job_name("startup"), lambda: self.__startup(poll)))
+        if self.__is_scheduler_owner:
+            self.__scheduler.start()
+
+    def __set_startup_state(self, startup_state: str):
+        self.startup_state = startup_state
+        self.__on_change()
+
+    def __startup(self, poll: bool):
+        started = self.__clock.time()
+        self.__set_startup_state(self.STARTUP_LOADING_HISTORY)
+        with self.__lock:
+            self.__journal.load()
+            if self.__journal.is_new:
+                self.__import_history(self.__directory, self.heating_rods)
+            self.__init_consumption_aggregates()
+        logging.info("history of heater " + ("" if self.name is None else self.name + " ") + "loaded in " + str(round(self.__clock.time() - started, 2)) + " sec")
+        self.__set_startup_state(self.STARTUP_INITIALIZING_DEVICE)
+        self.__deploy_scripts()
+        if poll:
+            self.__sync_job = self.__scheduler.every(self.__job_name("sync"), self.min_sync_period_sec, self.__measure)
+            self.__jobs.append(self.__sync_job)
+        self.__jobs.append(self.__scheduler.every(self.__job_name("journal commit"), self.JOURNAL_COMMIT_PERIOD_SEC, self.__journal.commit))
+        self.__jobs.append(self.__scheduler.every(self.__job_name("journal heartbeat"), self.JOURNAL_HEARTBEAT_PERIOD_SEC, self.__journal.heartbeat))
+        self.__jobs.append(self.__scheduler.every(self.__job_name("journal checkpoint"), 60 * 60, self.__journal.checkpoint, jitter_sec=60))
+        self.__jobs.append(self.__scheduler.every(self.__job_name("statistics"), 3 * 60 * 60, self.__statistics, jitter_sec=60))
+        self.__jobs.append(self.__scheduler.every(self.__job_name("auto decrease"), 60, self.__auto_decrease))
+        self.__scripts_job = self.__scheduler.every(self.__job_name("auto restart scripts"), 7 * 60 * 60, self.__auto_restart_scripts, jitter_sec=60, initial_delay_sec=60)
+        self.__jobs.append(self.__scripts_job)
+        if self.__target_heating_rods_active > 0:
+            self.set_heating_rods_active(self.__target_heating_rods_active, reason="requested during startup")
 
     def __measure(self):
-        while self.__is_running:
-            try:
-                self.__sync()
-            except Exception as e:
-                logging.warning("error occurred on sync " + str(e))
-            sleep(4)
+        try:
+            self.__sync()
+        except Exception as e:
+            self.on_sync_failed(e)
+        self.__sync_job.interval_sec = self.next_sync_period_sec()
+
+    def on_sync_failed(self, error: Exception):
+        # the switch states could not be queried, by the sync job of the heater or of the fleet (see HeaterFleet)
+        logging.warning("error occurred on sync of heater " + ("" if self.name is None else self.name + " ") + str(error))
+        if self.startup_state == self.STARTUP_INITIALIZING_DEVICE:
+            self.__set_startup_state(self.STARTUP_DEVICE_UNREACHABLE)
 
     def __statistics(self):
-        reported_date = datetime.now() - timedelta(days=1)
-        while self.__is_running:
-            try:
-                now = datetime.now()
-                if now > (reported_date + timedelta(hours=3)):
-                    reported_date = now
-                    logging.info("heater consumption today:          " + str(round(self.heater_consumption_today)) + " Watt")
-                    logging.info("heater consumption current year:   " + str(round(self.heater_consumption_current_year/1000,1)) + " kWh")
-                    logging.info("heater consumption estimated year: " + str(round(self.heater_consumption_estimated_year/1000,1)) + " kWh")
-            except Exception as e:
-                logging.warning("error occurred on statistics " + str(e))
-            sleep(10 * 60)
+        try:
+            logging.info("heater consumption today:          " + str(round(self.heater_consumption_today)) + " Watt")
+            logging.info("heater consumption current year:   " + str(round(self.heater_consumption_current_year/1000,1)) + " kWh")
+            logging.info("heater consumption estimated year: " + str(round(self.heater_consumption_estimated_year/1000,1)) + " kWh")
+        except Exception as e:
+            logging.warning("error occurred on statistics " + str(e))
 
     def __auto_decrease(self):
-        auto_decrease_time_min = 23
-        while self.__is_running:
-            try:
-                if self.heating_rods_active > 0:
-                    if datetime.now() > (self.__last_time_auto_decreased + timedelta(minutes=auto_decrease_time_min)):
-                        self.__last_time_auto_decreased = datetime.now()
-                        self.set_heating_rods_active(self.heating_rods_active - 1, reason="due to auto decrease each " + str(auto_decrease_time_min) + " min")
-            except Exception as e:
-                logging.warning("error occurred on __auto_decrease " + str(e))
-            sleep(60)
+        try:
+            if self.heating_rods_active > 0:
+                if self.__clock.now() > (self.__last_time_auto_decreased + timedelta(minutes=self.auto_decrease_min)):
+                    self.__last_time_auto_decreased = self.__clock.now()
+                    self.set_heating_rods_active(self.heating_rods_active - 1, reason="due to auto decrease each " + str(self.auto_decrease_min) + " min")
+        except Exception as e:
+            logging.warning("error occurred on __auto_decrease " + str(e))
 
     def __auto_restart_scripts(self):
-        while self.__is_running:
-            try:
-                for id in range (0, 3):
-                    self.__shelly.restart_script(id+1)
-            except Exception as e:
-                logging.warning("error occurred on __auto_restart_scripts " + str(e))
-            sleep(7 * 60 * 60)
-
-    def __register_scripts(self):
-        for id in range (0, 3):
-            self.__shelly.upload_script(id+1, SHELLY_SCRIPT_TEMPLATE.substitute({"id": id}))
-
-
+        # (re)deploys the scripts, which restarts stopped ones. If the scripts are up to date, this costs a single Script.List
+        try:
+            self.__deploy_scripts()
+        except Exception as e:
+            logging.warning("error occurred on __auto_restart_scripts " + str(e))
+
+    def __deploy_scripts(self):
+        # the deploy runs on the shared event loop. The scheduler, which may be shared by several heaters, is not blocked
+        # by a slow or unreachable device. A deploy in flight is not started again
+        if self.__deploy is not None and not self.__deploy.done():
+            return
+        callback = "" if self.__callback_addr is None else self.__callback_addr + self.callback_path
+        self.__deploy = self.__shelly.deploy_scripts_async({heating_rod.id+1: ("auto_off_" + str(heating_rod.id),
+                                                                               SHELLY_SCRIPT_TEMPLATE.substitute({"id": heating_rod.id, "callback": callback, "auto_off_ms": SCRIPT_AUTO_OFF_SEC * 1000}))
+                                                            for heating_rod in self.__heating_rods})
+        self.__deploy.add_done_callback(self.__on_scripts_deployed)
+
+    def __on_scripts_deployed(self, deploy: Future):
+        # called on the event loop of the device calls. A failed deploy is retried by the watchdog job
+        error = deploy.exception()
+        if error is not None:
+            logging.warning("could not deploy scripts of heater " + ("" if self.name is None else self.name + " ") + "(retry in " + str(self.SCRIPT_DEPLOY_RETRY_SEC) + " sec) " + str(error))
+            if self.__scripts_job is not None:
+                self.__scheduler.reschedule(self.__scripts_job, self.SCRIPT_DEPLOY_RETRY_SEC)
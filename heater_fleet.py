@@ -0,0 +1,137 @@
+import re
+import json
+import logging
+from os import path
+from time import monotonic
+from threading import Lock
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Dict, Set
+from heater import Heater
+from scheduler import Scheduler
+from shelly import AsyncShelly3Pro, query_all_async
+from surplus import SurplusController, create_surplus_source
+
+
+
+class HeaterConfig:
+
+    def __init__(self,
+                 name: str,
+                 addr: str,
+                 heating_rods: int = 3,
+                 description: str = None,
+                 min_step_interval_sec: float = 0,
+                 surplus_source: str = None,
+                 min_sync_period_sec: float = None,
+                 max_sync_period_sec: float = None,
+                 sync_timeout_sec: float = AsyncShelly3Pro.TIMEOUT_SEC,
+                 state_file: str = None):
+        if re.fullmatch(r'[a-zA-Z0-9_]+', name) is None:
+            raise ValueError("invalid heater name '" + name + "' (only letters, digits and _ are allowed)")
+        self.name = name
+        self.addr = addr
+        self.heating_rods = heating_rods
+        self.description = name if description is None else description
+        self.min_step_interval_sec = min_step_interval_sec
+        self.surplus_source = surplus_source     # see create_surplus_source
+        self.min_sync_period_sec = min_sync_period_sec
+        self.max_sync_period_sec = max_sync_period_sec
+        self.sync_timeout_sec = sync_timeout_sec      # deadline of the status query of the device
+        self.state_file = state_file                  # see Heater.default_state_file
+
+    @staticmethod
+    def load(filename: str) -> List["HeaterConfig"]:
+        # config file example: {"heaters": [{"name": "tank1", "addr": "http://10.1.1.33", "heating_rods": 3}, ...]}
+        with open(filename) as file:
+            conf = json.load(file)
+        configs = [HeaterConfig(**heater_conf) for heater_conf in conf['heaters']]
+        names = [config.name for config in configs]
+        if len(set(names)) != len(names):
+            raise ValueError("duplicated heater name in " + filename)
+        return configs
+
+
+class HeaterFleet:
+    # serves several heaters within one process. All heaters share one scheduler. The switch states are polled
+    # per heater with its own period and deadline, so that a slow device does not delay the sync of the others
+
+    def __init__(self, configs: List[HeaterConfig], directory: str, callback_addr: str = None):
+        self.configs = configs
+        self.__scheduler = Scheduler("fleet scheduler")
+        self.heaters: Dict[str, Heater] = {config.name: Heater(config.addr,
+                                                                path.join(directory, config.name),
+                                                                callback_addr,
+                                                                num_heating_rods=config.heating_rods,
+                                                                scheduler=self.__scheduler,
+                                                                name=config.name,
+                                                                min_step_interval_sec=config.min_step_interval_sec,
+                                                                min_sync_period_sec=config.min_sync_period_sec,
+                                                                max_sync_period_sec=config.max_sync_period_sec,
+                                                                state_file=config.state_file)
+                                           for config in configs}
+        self.__sync_job = None
+        self.__lock = Lock()
+        self.__in_flight: Set[str] = set()
+        self.__last_started: Dict[str, float] = {}
+        # the states are applied on a worker per heater, as the commands of the reconciliation are blocking
+        self.__executor = ThreadPoolExecutor(max_workers=max(1, len(configs)), thread_name_prefix="fleet sync")
+        self.surplus_controllers = [SurplusController(self.heaters[config.name], create_surplus_source(config.surplus_source), self.__scheduler)
+                                    for config in configs if config.surplus_source is not None]
+
+    def __sync(self):
+        # starts the status query of each heater, which is due and whose previous query has completed. The query does
+        # not block the scheduler. Its states are applied as soon as it completes, independent of the other devices
+        now = monotonic()
+        for config in self.configs:
+            heater = self.heaters[config.name]
+            with self.__lock:
+                if config.name in self.__in_flight or now < self.__last_started.get(config.name, 0) + heater.next_sync_period_sec():
+                    continue
+                self.__in_flight.add(config.name)
+                self.__last_started[config.name] = now
+            try:
+                observed_at = heater.clock.monotonic()
+                future = query_all_async(heater.shelly, config.sync_timeout_sec)
+                future.add_done_callback(lambda future, name=config.name, observed_at=observed_at: self.__executor.submit(self.__apply, name, future, observed_at))
+            except Exception as e:
+                logging.warning("could not start sync of heater " + config.name + " " + str(e))
+                self.__completed(config.name)
+
+    def __apply(self, name: str, future: Future, observed_at: float):
+        try:
+            try:
+                states = future.result()
+            except Exception as e:
+                self.heaters[name].on_sync_failed(e)
+                return
+            self.heaters[name].apply_switch_states(states, observed_at)
+        except Exception as e:
+            logging.warning("sync of heater " + name + " failed: " + str(e))
+        finally:
+            self.__completed(name)
+
+    def __completed(self, name: str):
+        with self.__lock:
+            self.__in_flight.discard(name)
+
+    def start(self):
+        # the job checks, which heater is due. It ticks with the shortest floor of the sync periods
+        sync_period_sec = min([heater.min_sync_period_sec for heater in self.heaters.values()])
+        self.__sync_job = self.__scheduler.every("fleet sync", sync_period_sec, self.__sync)
+        for heater in self.heaters.values():
+            heater.start(poll=False, sync_job=self.__sync_job)
+        self.__scheduler.start()
+        for surplus_controller in self.surplus_controllers:
+            surplus_controller.start()
+
+    def stop(self):
+        for surplus_controller in self.surplus_controllers:
+            surplus_controller.stop()
+        for heater in self.heaters.values():
+            heater.stop()
+        self.__scheduler.stop()
+        self.__executor.shutdown(wait=False)
+
+    @staticmethod
+    def load(filename: str, directory: str, callback_addr: str = None) -> "HeaterFleet":
+        return HeaterFleet(HeaterConfig.load(filename), directory, callback_addr)
@@ -1,7 +1,201 @@
+import uuid
+import asyncio
 import logging
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Dict, Optional
 from heater import Heater
 from mcplib.server import MCPServer
 
+
+class HeaterCommands:
+    """
+    Executes the commands of a heater asynchronously on a single worker, so that a tool call returns immediately
+    with a command id. The latest MAX_COMMANDS commands can be awaited or queried.
+    """
+
+    MAX_COMMANDS = 100
+
+    def __init__(self, heater: Heater):
+        self.heater = heater
+        self.__lock = Lock()
+        self.__commands: Dict[str, Future] = OrderedDict()
+        self.__descriptions: Dict[str, str] = {}
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="heater commands")
+
+    def submit_target(self, new_num: int) -> str:
+        def set_target() -> str:
+            old_num = self.heater.heating_rods_active
+            self.heater.set_heating_rods_active(new_num, reason="by mcp")
+            snapshot = self.heater.snapshot
+            return f"Active rods updated from {old_num} to {snapshot.heating_rods_active} (target {new_num}). Current heater consumption is {snapshot.power} W."
+        return self.__submit(f"set active rods to {new_num}", set_target)
+
+    def __submit(self, description: str, func) -> str:
+        with self.__lock:
+            command_id = uuid.uuid4().hex[:8]
+            self.__commands[command_id] = self.__executor.submit(func)
+            self.__descriptions[command_id] = description
+            while len(self.__commands) > self.MAX_COMMANDS:
+                oldest_id, _ = self.__commands.popitem(last=False)
+                self.__descriptions.pop(oldest_id, None)
+            return command_id
+
+    def status(self, command_id: str) -> str:
+        with self.__lock:
+            future = self.__commands.get(command_id)
+            description = self.__descriptions.get(command_id)
+        if future is None:
+            return f"Error: Unknown command {command_id}."
+        if not future.done():
+            return f"Command {command_id} ({description}) is pending."
+        try:
+            return f"Command {command_id} ({description}) completed. {future.result()}"
+        except Exception as e:
+            logging.warning(f"Hardware communication error on command {command_id} ({description}): {e}", exc_info=True)
+            return f"Command {command_id} ({description}) failed. Error: Hardware communication failed. {str(e)}"
+
+    async def wait(self, command_id: str, timeout_sec: float) -> str:
+        with self.__lock:
+            future = self.__commands.get(command_id)
+        if future is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout=timeout_sec)
+            except Exception:
+                pass     # reported by status
+        return self.status(command_id)
+
+
+def format_status(heater: Heater) -> str:
+    snapshot = heater.snapshot
+    return (
+        f"Heater Status Overview (state version {snapshot.version} as of {snapshot.time.strftime('%Y-%m-%dT%H:%M:%S')}):\n"
+        f"- Current Power Draw: {snapshot.power} W\n"
+        f"- Active Rods: {snapshot.heating_rods_active} (target {snapshot.target_heating_rods_active})\n"
+        f"- Power per Rod: {snapshot.heating_rod_power} W\n"
+        f"- Hardware Limit: {snapshot.heating_rods} rods total\n"
+        f"- Consumption Today: {snapshot.heater_consumption_today} Wh\n"
+        f"- Device Connection: {snapshot.device_connection}\n"
+        f"- Startup State: {snapshot.startup_state}"
+    )
+
+
+def format_history(heater: Heater, start: datetime, end: datetime, bucket: str) -> str:
+    if not heater.is_history_loaded:
+        return f"Heating history not available yet (heater is {heater.startup_state}). Please retry in a few seconds."
+    history = heater.energy_history(start, end, bucket)
+    lines = [f"Heating history ({bucket}):"]
+    for entry in history:
+        rods = ", ".join([f"rod {rod_id}: {kwh} kWh" for rod_id, kwh in entry["rods"].items()])
+        lines.append(f"- {entry['start']}: {entry['total']} kWh ({rods})")
+    return "\n".join(lines)
+
+
+def validate_target(heater: Heater, new_num: int) -> Optional[str]:
+    if not (0 <= new_num <= heater.snapshot.heating_rods):
+        return f"Error: Invalid number of rods ({new_num}). Please choose a value between 0 and {heater.snapshot.heating_rods}."
+    return None
+
+
+def register_heater_tools(mcp, heater: Heater, prefix: str = "") -> HeaterCommands:
+    """
+    Registers the tools to control a heater. The prefix separates the tools of several heaters served by one MCP server.
+    The reads are answered by the state snapshot published by the sync loop of the heater. The writes return a command id
+    immediately, which can be awaited.
+    """
+
+    heater_info = "" if prefix == "" else f" of heater '{heater.name}'"
+    commands = HeaterCommands(heater)
+
+    @mcp.tool(name=prefix + "get_heater_status",
+              description="Returns current power (W), active rods, and rod capacity" + heater_info + ".")
+    def get_heater_status() -> str:
+        """
+        Provides a real-time status report of the heating system.
+        Use this to check the current load and physical limits of the heater.
+        """
+        return format_status(heater)
+
+    @mcp.tool(name=prefix + "set_active_heating_rods",
+              description="Sets the number of active heating rods" + heater_info + f" (Allowed: 0 to {heater.heating_rods}). Returns a command id immediately.")
+    def set_active_heating_rods(new_num: int) -> str:
+        """
+        Adjusts the heater load.
+        Each rod increases power consumption by 500W (check status for exact value).
+        The command is executed in the background. Use await_command to wait for its completion.
+
+        Args:
+            new_num: Number of rods to activate (0 to number of rods).
+        """
+        error = validate_target(heater, new_num)
+        if error is not None:
+            return error
+        snapshot = heater.snapshot
+        if snapshot.heating_rods_active == new_num and snapshot.target_heating_rods_active == new_num:
+            return f"No change required. Heater is already at {new_num} rods ({snapshot.power} W)."
+        command_id = commands.submit_target(new_num)
+        return f"Accepted: command {command_id} sets the active rods from {snapshot.heating_rods_active} to {new_num}. Use {prefix}await_command to wait for its completion."
+
+    @mcp.tool(name=prefix + "await_command",
+              description="Waits for the completion of a command" + heater_info + " and returns its result.")
+    async def await_command(command_id: str, timeout_sec: float = 10) -> str:
+        """
+        Waits until the command is completed or the timeout is reached.
+
+        Args:
+            command_id: The id returned by the command.
+            timeout_sec: Max seconds to wait (default 10).
+        """
+        return await commands.wait(command_id, min(max(0.0, timeout_sec), 60))
+
+    @mcp.tool(name=prefix + "get_heating_history",
+              description="Returns the consumed energy (kWh) per rod and in total" + heater_info + " for each hour, day, week or month of a time range.")
+    def get_heating_history(start: str, end: str, bucket: str = "day") -> str:
+        """
+        Reports the heating history based on precomputed rollups.
+
+        Args:
+            start: Start of the time range as ISO 8601 date or date time, e.g. 2026-01-01 (inclusive).
+            end: End of the time range as ISO 8601 date or date time, e.g. 2027-01-01 (exclusive).
+            bucket: One of hour, day, week or month.
+        """
+        try:
+            return format_history(heater, datetime.fromisoformat(start), datetime.fromisoformat(end), bucket)
+        except ValueError as e:
+            return f"Error: {str(e)}"
+
+    @mcp.tool(name=prefix + "run_decision_round",
+              description="Returns the status and the hourly heating history" + heater_info + " and optionally sets the number of active rods, all in one call.")
+    async def run_decision_round(new_num: int = -1, history_hours: int = 24, await_sec: float = 0) -> str:
+        """
+        Batch of the status, the recent history and an optional target, so that a decision costs a single call.
+
+        Args:
+            new_num: Number of rods to activate (0 to number of rods), or -1 to keep the current setting.
+            history_hours: Number of recent hours of the history to report (0 to 168).
+            await_sec: Max seconds to wait for the completion of the command (0 returns immediately).
+        """
+        sections = [format_status(heater)]
+        if history_hours > 0:
+            end = datetime.now()
+            sections.append(format_history(heater, end - timedelta(hours=min(history_hours, 7 * 24)), end, "hour"))
+        if new_num >= 0:
+            error = validate_target(heater, new_num)
+            if error is not None:
+                sections.append(error)
+            else:
+                command_id = commands.submit_target(new_num)
+                if await_sec > 0:
+                    sections.append(await commands.wait(command_id, min(await_sec, 60)))
+                else:
+                    sections.append(f"Accepted: command {command_id} sets the active rods to {new_num}. Use {prefix}await_command to wait for its completion.")
+        return "\n\n".join(sections)
+
+    return commands
+
+
 class HeaterMCPServer(MCPServer):
     """
     MCP Server for controlling a multi-rod water heater.
@@ -11,48 +205,46 @@ class HeaterMCPServer(MCPServer):
     def __init__(self, port: int, heater: Heater):
         super().__init__("pv_heater", port)
         self.heater = heater
+        self.commands = register_heater_tools(self.mcp, heater)
 
-        @self.mcp.tool(name="get_heater_status",
-                       description="Returns current power (W), active rods, and rod capacity.")
-        def get_heater_status() -> str:
+
+class HeaterFleetMCPServer(MCPServer):
+    """
+    MCP Server for controlling several multi-rod water heaters.
+    The tools of each heater are prefixed by the heater name, e.g. tank1_get_heater_status
+    """
+
+    def __init__(self, port: int, heaters: Dict[str, Heater]):
+        super().__init__("pv_heater_fleet", port)
+        self.heaters = heaters
+        self.commands = {name: register_heater_tools(self.mcp, heater, prefix=name + "_") for name, heater in heaters.items()}
+
+        @self.mcp.tool(name="get_fleet_status",
+                       description="Returns the status of all heaters (" + ", ".join(heaters.keys()) + ") in one call.")
+        def get_fleet_status() -> str:
             """
-            Provides a real-time status report of the heating system.
-            Use this to check the current load and physical limits of the heater.
+            Provides the status report of each heater of the fleet.
             """
-            return (
-                f"Heater Status Overview:\n"
-                f"- Current Power Draw: {self.heater.power} W\n"
-                f"- Active Rods: {self.heater.heating_rods_active}\n"
-                f"- Power per Rod: {self.heater.HEATER_ROD_POWER} W\n"
-                f"- Hardware Limit: 3 rods total"
-            )
-
-        @self.mcp.tool(name="set_active_heating_rods",
-                       description="Sets the number of active heating rods (Allowed: 0, 1, 2, or 3).")
-        def set_active_heating_rods(new_num: int) -> str:
+            return "\n\n".join([f"Heater '{name}':\n" + format_status(heater) for name, heater in heaters.items()])
+
+        @self.mcp.tool(name="set_fleet_heating_rods",
+                       description="Sets the number of active heating rods of several heaters in one call, e.g. {\"tank1\": 2, \"tank2\": 0}. Returns a command id per heater.")
+        def set_fleet_heating_rods(targets: Dict[str, int]) -> str:
             """
-            Adjusts the heater load.
-            Each rod increases power consumption by 500W (check status for exact value).
+            Adjusts the load of several heaters. The commands are executed in the background.
 
             Args:
-                new_num: Number of rods to activate (0 to 3).
+                targets: Number of rods to activate per heater name.
             """
-            try:
-                # 1. Validation check
-                if not (0 <= new_num <= self.heater.HEATER_ROD_POWER):
-                    return f"Error: Invalid number of rods ({new_num}). Please choose a value between 0 and {self.heater.HEATER_ROD_POWER}."
-
-                # 2. Skip if already set to the same value
-                old_num = self.heater.heating_rods_active
-                if old_num == new_num:
-                    return f"No change required. Heater is already at {new_num} rods ({self.heater.power} W)."
-
-                # 3. Apply change
-                self.heater.set_heating_rods_active(new_num)
-
-                return (f"Success: Active rods updated from {old_num} to {new_num}. "
-                        f"Current heater consumption is now {self.heater.power} W.")
-
-            except Exception as e:
-                logging.warning(f"Hardware communication error setting rods to {new_num}: {e}", exc_info=True)
-                return f"Error: Hardware communication failed. {str(e)}"
\ No newline at end of file
+            lines = []
+            for name, new_num in targets.items():
+                heater = heaters.get(name)
+                if heater is None:
+                    lines.append(f"- {name}: Error: Unknown heater.")
+                    continue
+                error = validate_target(heater, new_num)
+                if error is not None:
+                    lines.append(f"- {name}: {error}")
+                else:
+                    lines.append(f"- {name}: Accepted: command {self.commands[name].submit_target(new_num)} sets the active rods to {new_num}. Use {name}_await_command to wait for its completion.")
+            return "\n".join(lines)
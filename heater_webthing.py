@@ -1,9 +1,26 @@
-from webthing import (SingleThing, Property, Thing, Value, WebThingServer)
+from webthing import (SingleThing, MultipleThings, Property, Thing, Value, WebThingServer)
+from webthing.server import ThingHandler, PropertiesHandler, PropertyHandler
 import sys
+import json
 import logging
+from os import path
 import tornado.ioloop
-from heater import Heater
-from heater_mcp import HeaterMCPServer
+import tornado.web
+import tornado.websocket
+import tornado.gen
+from tornado.iostream import StreamClosedError
+from datetime import datetime, timedelta
+from time import monotonic
+from typing import Dict, Callable, Any, Tuple, List, Union
+from uuid import uuid4
+from collections import OrderedDict
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from heater import Heater, HeaterSnapshot
+from heater_fleet import HeaterFleet
+from history_export import CONTENT_TYPES
+from surplus import SurplusController, create_surplus_source
+from metrics import MetricsHandler, VALUE_CHANGED_DURATION, WEBSOCKET_SUBSCRIBERS, THING_RESPONSE_CACHE
 
 
 
@@ -13,19 +30,30 @@ class HeaterThing(Thing):
     # regarding capabilities refer https://iot.mozilla.org/schemas
     # there is also another schema registry http://iotschema.org/docs/full.html not used by webthing
 
-    def __init__(self, description: str, heater: Heater):
+    MIN_NOTIFY_INTERVAL_SEC = 1
+    MAX_CACHED_DESCRIPTIONS = 8
+
+    def __init__(self, description: str, heater: Heater, id: str = 'urn:dev:ops:heater-1', title: str = 'Heater'):
         Thing.__init__(
             self,
-            'urn:dev:ops:heater-1',
-            'Heater',
+            id,
+            title,
             ['MultiLevelSensor'],
             description
         )
         self.ioloop = tornado.ioloop.IOLoop.current()
         self.heater = heater
-        self.heater.set_listener(self.on_value_changed)
-
-        self.power = Value(heater.power)
+        # the device commands are blocking. They must not be executed on the ioloop
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="thing commands")
+        snapshot = heater.snapshot
+        self.version = 0        # increased on each change of a property value. Keys the cached responses (see cached_response)
+        self.__etag_prefix = uuid4().hex[:8]      # the version restarts with the process
+        self.__responses: Dict[str, Tuple[int, str, bytes]] = {}
+        # the description contains no property values. It is versioned on its own (see cached_description)
+        self.description_version = 0
+        self.__descriptions: Dict[str, Tuple[int, bytes]] = OrderedDict()
+
+        self.power = Value(snapshot.power)
         self.add_property(
             Property(self,
                      'power',
@@ -37,7 +65,7 @@ class HeaterThing(Thing):
                          'readOnly': True,
                      }))
 
-        self.heating_rod_power = Value(heater.HEATER_ROD_POWER)
+        self.heating_rod_power = Value(snapshot.heating_rod_power)
         self.add_property(
             Property(self,
                      'heating_rod_power',
@@ -49,7 +77,7 @@ class HeaterThing(Thing):
                          'readOnly': True,
                      }))
 
-        self.heating_rods = Value(heater.heating_rods)
+        self.heating_rods = Value(snapshot.heating_rods)
         self.add_property(
             Property(self,
                      'heating_rods',
@@ -61,7 +89,7 @@ class HeaterThing(Thing):
                          'readOnly': True,
                      }))
 
-        self.heating_rods_active = Value(heater.heating_rods_active, heater.set_heating_rods_active)
+        self.heating_rods_active = Value(snapshot.heating_rods_active, lambda new_num: self.__executor.submit(heater.set_heating_rods_active, new_num))
         self.add_property(
             Property(self,
                      'heating_rods_active',
@@ -74,43 +102,21 @@ class HeaterThing(Thing):
                      }))
 
 
-        self.heating_rod0_activated = Value(heater.get_heating_rod(0))
-        self.add_property(
-            Property(self,
-                     'heating_rod0_activated',
-                     self.heating_rod0_activated,
-                     metadata={
-                         'title': 'heating_rod0_activated',
-                         "type": "boolean",
-                         'description': 'true, if heating rod 0 is activated',
-                         'readOnly': True,
-                     }))
-
-        self.heating_rod1_activated = Value(heater.get_heating_rod(1))
-        self.add_property(
-            Property(self,
-                     'heating_rod1_activated',
-                     self.heating_rod1_activated,
-                     metadata={
-                         'title': 'heating_rod1_activated',
-                         "type": "boolean",
-                         'description': 'true, if heating rod 1 is activated',
-                         'readOnly': True,
-                     }))
-
-        self.heating_rod2_activated = Value(heater.get_heating_rod(2))
-        self.add_property(
-            Property(self,
-                     'heating_rod2_activated',
-                     self.heating_rod2_activated,
-                     metadata={
-                         'title': 'heating_rod2_activated',
-                         "type": "boolean",
-                         'description': 'true, if heating rod 2 is activated',
-                         'readOnly': True,
-                     }))
-
-        self.heater_status = Value(heater.status)
+        self.heating_rod_activated = {}
+        for id in range(0, snapshot.heating_rods):
+            self.heating_rod_activated[id] = Value(snapshot.heating_rods_activated[id])
+            self.add_property(
+                Property(self,
+                         'heating_rod' + str(id) + '_activated',
+                         self.heating_rod_activated[id],
+                         metadata={
+                             'title': 'heating_rod' + str(id) + '_activated',
+                             "type": "boolean",
+                             'description': 'true, if heating rod ' + str(id) + ' is activated',
+                             'readOnly': True,
+                         }))
+
+        self.heater_status = Value(self.__status(snapshot))
         self.add_property(
             Property(self,
                      'status',
@@ -122,7 +128,7 @@ class HeaterThing(Thing):
                          'readOnly': True,
                      }))
 
-        self.heater_consumption_today = Value(heater.heater_consumption_today)
+        self.heater_consumption_today = Value(snapshot.heater_consumption_today)
         self.add_property(
             Property(self,
                      'heater_consumption_today',
@@ -134,7 +140,7 @@ class HeaterThing(Thing):
                          'readOnly': True,
                      }))
 
-        self.heater_consumption_current_year = Value(heater.heater_consumption_current_year)
+        self.heater_consumption_current_year = Value(snapshot.heater_consumption_current_year)
         self.add_property(
             Property(self,
                      'heater_consumption_current_year',
@@ -146,7 +152,7 @@ class HeaterThing(Thing):
                          'readOnly': True,
                      }))
 
-        self.heater_consumption_estimated_year = Value(heater.heater_consumption_estimated_year)
+        self.heater_consumption_estimated_year = Value(snapshot.heater_consumption_estimated_year)
         self.add_property(
             Property(self,
                      'heater_consumption_estimated_year',
@@ -159,7 +165,7 @@ class HeaterThing(Thing):
                      }))
 
 
-        self.last_time_power_updated = Value(heater.last_time_power_updated.strftime("%Y-%m-%dT%H:%M"))
+        self.last_time_power_updated = Value(snapshot.last_time_power_updated.strftime("%Y-%m-%dT%H:%M"))
         self.add_property(
             Property(self,
                      'last_time_power_updated',
@@ -172,7 +178,7 @@ class HeaterThing(Thing):
                      }))
 
 
-        self.last_time_heating = Value(heater.last_time_heating.strftime("%Y-%m-%dT%H:%M"))
+        self.last_time_heating = Value(snapshot.last_time_heating.strftime("%Y-%m-%dT%H:%M"))
         self.add_property(
             Property(self,
                      'last_time_heating',
@@ -184,7 +190,7 @@ class HeaterThing(Thing):
                          'readOnly': True,
                      }))
 
-        self.heater_consumption_last_15_min = Value(heater.consumed_power(15))
+        self.heater_consumption_last_15_min = Value(snapshot.heater_consumption_last_15_min)
         self.add_property(
             Property(self,
                      'heater_consumption_last_15_min',
@@ -192,11 +198,11 @@ class HeaterThing(Thing):
                      metadata={
                          'title': 'heater_consumption_last_15_min',
                          "type": "number",
-                         'description': 'the consumed power of last 15 min)',
+                         'description': 'the consumed energy of last 15 min (watt hours)',
                          'readOnly': True,
                      }))
 
-        self.heater_consumption_last_30_min = Value(heater.consumed_power(30))
+        self.heater_consumption_last_30_min = Value(snapshot.heater_consumption_last_30_min)
         self.add_property(
             Property(self,
                      'heater_consumption_last_30_min',
@@ -204,11 +210,11 @@ class HeaterThing(Thing):
                      metadata={
                          'title': 'heater_consumption_last_30_min',
                          "type": "number",
-                         'description': 'the consumed power of last 30 min)',
+                         'description': 'the consumed energy of last 30 min (watt hours)',
                          'readOnly': True,
                      }))
 
-        self.heater_consumption_last_60_min = Value(heater.consumed_power(60))
+        self.heater_consumption_last_60_min = Value(snapshot.heater_consumption_last_60_min)
         self.add_property(
             Property(self,
                      'heater_consumption_last_60_min',
@@ -216,53 +222,425 @@ class HeaterThing(Thing):
                      metadata={
                          'title': 'heater_consumption_last_60_min',
                          "type": "number",
-                         'description': 'the consumed power of last 60 min)',
+                         'description': 'the consumed energy of last 60 min (watt hours)',
+                         'readOnly': True,
+                     }))
+
+        self.device_connection = Value(snapshot.device_connection)
+        self.add_property(
+            Property(self,
+                     'device_connection',
+                     self.device_connection,
+                     metadata={
+                         'title': 'device_connection',
+                         "type": "string",
+                         'enum': ['closed', 'open', 'half_open'],
+                         'description': 'circuit breaker state of the shelly device (closed: reachable)',
                          'readOnly': True,
                      }))
 
+        self.startup_state = Value(snapshot.startup_state)
+        self.add_property(
+            Property(self,
+                     'startup_state',
+                     self.startup_state,
+                     metadata={
+                         'title': 'startup_state',
+                         "type": "string",
+                         'enum': [Heater.STARTUP_WARMING_UP, Heater.STARTUP_LOADING_HISTORY, Heater.STARTUP_INITIALIZING_DEVICE, Heater.STARTUP_DEVICE_UNREACHABLE, Heater.STARTUP_READY],
+                         'description': 'startup state of the heater. The values are preliminary until ready',
+                         'readOnly': True,
+                     }))
+
+        self.__last_snapshot = self.__snapshot()
+        self.__values = {name: self.find_property(name).value for name in self.__last_snapshot.keys()}
+        self.__update_scheduled = False
+        self.__batch = None
+        self.__pending = {}
+        self.__flush_scheduled = set()
+        self.__last_sent = {}
+        self.heater.set_listener(self.on_value_changed)
+        WEBSOCKET_SUBSCRIBERS.set_function(lambda: len(self.subscribers), self.id)
+
+    @staticmethod
+    def __status(snapshot: HeaterSnapshot) -> str:
+        return str(int(snapshot.power)) + " Watt"
+
+    def __snapshot(self) -> Dict:
+        # rendered from the state published by the heater, which is read without waiting for the lock of the heater
+        snapshot = self.heater.snapshot
+        values = {'power': snapshot.power,
+                  'heating_rods': snapshot.heating_rods,
+                  'heating_rods_active': snapshot.heating_rods_active,
+                  'status': self.__status(snapshot),
+                  'heater_consumption_today': snapshot.heater_consumption_today,
+                  'heater_consumption_current_year': snapshot.heater_consumption_current_year,
+                  'heater_consumption_estimated_year': snapshot.heater_consumption_estimated_year,
+                  'last_time_power_updated': snapshot.last_time_power_updated.strftime("%Y-%m-%dT%H:%M"),
+                  'last_time_heating': snapshot.last_time_heating.strftime("%Y-%m-%dT%H:%M"),
+                  'heater_consumption_last_15_min': snapshot.heater_consumption_last_15_min,
+                  'heater_consumption_last_30_min': snapshot.heater_consumption_last_30_min,
+                  'heater_consumption_last_60_min': snapshot.heater_consumption_last_60_min,
+                  'device_connection': snapshot.device_connection,
+                  'startup_state': snapshot.startup_state}
+        for id in self.heating_rod_activated.keys():
+            values['heating_rod' + str(id) + '_activated'] = snapshot.heating_rods_activated[id]
+        return values
 
     def on_value_changed(self):
-        self.ioloop.add_callback(self._on_value_changed)
+        # several changes until the ioloop runs the update are coalesced into a single update
+        if not self.__update_scheduled:
+            self.__update_scheduled = True
+            self.ioloop.add_callback(self._on_value_changed)
 
     def _on_value_changed(self):
-        self.power.notify_of_external_update(self.heater.power)
-        self.heating_rods.notify_of_external_update(self.heater.heating_rods)
-        self.heating_rods_active.notify_of_external_update(self.heater.heating_rods_active)
-        self.heating_rod0_activated.notify_of_external_update(self.heater.get_heating_rod(0).is_activated)
-        self.heating_rod1_activated.notify_of_external_update(self.heater.get_heating_rod(1).is_activated)
-        self.heating_rod2_activated.notify_of_external_update(self.heater.get_heating_rod(2).is_activated)
-        self.heater_consumption_today.notify_of_external_update(self.heater.heater_consumption_today)
-        self.heater_consumption_today.notify_of_external_update(self.heater.heater_consumption_today)
-        self.last_time_power_updated.notify_of_external_update(self.heater.last_time_power_updated.strftime("%Y-%m-%dT%H:%M"))
-        self.heater_consumption_current_year.notify_of_external_update(self.heater.heater_consumption_current_year)
-        self.heater_consumption_estimated_year.notify_of_external_update(self.heater.heater_consumption_estimated_year)
-        self.last_time_heating.notify_of_external_update(self.heater.last_time_heating.strftime("%Y-%m-%dT%H:%M"))
-        self.heater_consumption_last_15_min.notify_of_external_update(self.heater.consumed_power(15))
-        self.heater_consumption_last_30_min.notify_of_external_update(self.heater.consumed_power(30))
-        self.heater_consumption_last_60_min.notify_of_external_update(self.heater.consumed_power(60))
-        self.heater_status.notify_of_external_update(self.heater.status)
-
-
-def run_server(description: str, port: int, addr: str, directory: str):
-    heater = Heater(addr, directory)
-
-    mcp_server = HeaterMCPServer(port+1, heater)
-    server = WebThingServer(SingleThing(HeaterThing(description, heater)), port=port, disable_host_validation=True)
+        started = monotonic()
+        try:
+            self.__update()
+        finally:
+            VALUE_CHANGED_DURATION.observe(monotonic() - started, self.id)
+
+    def __update(self):
+        self.__update_scheduled = False
+        snapshot = self.__snapshot()
+        changed = {name: value for name, value in snapshot.items() if value != self.__last_snapshot.get(name)}
+        self.__last_snapshot = snapshot
+        if len(changed) > 0:
+            # the property notifications of the changed values are collected and sent as one message
+            self.__batch = {}
+            try:
+                for name, value in changed.items():
+                    self.__values[name].notify_of_external_update(value)
+            finally:
+                batch, self.__batch = self.__batch, None
+            if len(batch) > 0:
+                self.__publish(batch)
+
+    def cached_response(self, key: str, render: Callable[[], Any]) -> Tuple[str, bytes]:
+        # the etag and the serialized json of a read of the properties or a property. It is rendered
+        # once per version, i.e. until a property value changes. Called on the ioloop, as the property updates
+        entry = self.__responses.get(key)
+        if entry is not None and entry[0] == self.version:
+            THING_RESPONSE_CACHE.inc(self.id, "hit")
+        else:
+            entry = (self.version, '"' + self.__etag_prefix + "-" + str(self.version) + '"', json.dumps(render()).encode("utf-8"))
+            self.__responses[key] = entry
+            THING_RESPONSE_CACHE.inc(self.id, "miss")
+        return entry[1], entry[2]
+
+    def cached_description(self, base: str, render: Callable[[], Any]) -> Tuple[str, bytes]:
+        # the etag and the serialized json of the thing description requested by the base url (protocol and host). The host
+        # header is supplied by the client, so only the MAX_CACHED_DESCRIPTIONS most recently requested ones are kept
+        etag = '"' + self.__etag_prefix + "-d" + str(self.description_version) + '"'
+        entry = self.__descriptions.get(base)
+        if entry is not None and entry[0] == self.description_version:
+            self.__descriptions.move_to_end(base)
+            THING_RESPONSE_CACHE.inc(self.id, "hit")
+        else:
+            entry = (self.description_version, json.dumps(render()).encode("utf-8"))
+            self.__descriptions[base] = entry
+            if len(self.__descriptions) > self.MAX_CACHED_DESCRIPTIONS:
+                self.__descriptions.popitem(last=False)
+            THING_RESPONSE_CACHE.inc(self.id, "miss")
+        return etag, entry[1]
+
+    def set_href_prefix(self, prefix):
+        Thing.set_href_prefix(self, prefix)
+        self.description_version += 1
+
+    def set_ui_href(self, href):
+        Thing.set_ui_href(self, href)
+        self.description_version += 1
+
+    def property_notify(self, property_):
+        self.version += 1
+        if self.__batch is None:
+            self.__publish({property_.name: property_.get_value()})
+        else:
+            self.__batch[property_.name] = property_.get_value()
+
+    def __publish(self, data: Dict):
+        # messages to a subscriber are sent at most each MIN_NOTIFY_INTERVAL_SEC. Updates in between are merged
+        now = self.ioloop.time()
+        for subscriber in list(self.subscribers):
+            self.__pending.setdefault(subscriber, {}).update(data)
+            if subscriber not in self.__flush_scheduled:
+                self.__flush_scheduled.add(subscriber)
+                delay = max(0, self.__last_sent.get(subscriber, 0) + self.MIN_NOTIFY_INTERVAL_SEC - now)
+                self.ioloop.call_later(delay, self.__flush, subscriber)
+
+    def __flush(self, subscriber):
+        self.__flush_scheduled.discard(subscriber)
+        data = self.__pending.pop(subscriber, None)
+        if data and subscriber in self.subscribers:
+            self.__last_sent[subscriber] = self.ioloop.time()
+            try:
+                subscriber.write_message(json.dumps({'messageType': 'propertyStatus', 'data': data}))
+            except tornado.websocket.WebSocketClosedError:
+                pass
+
+    def remove_subscriber(self, subscriber):
+        Thing.remove_subscriber(self, subscriber)
+        self.__pending.pop(subscriber, None)
+        self.__last_sent.pop(subscriber, None)
+
+
+def write_cached(handler: tornado.web.RequestHandler, thing: HeaterThing, response: Tuple[str, bytes]):
+    # response: the etag and the serialized json (see HeaterThing.cached_response)
+    etag, data = response
+    handler.set_header('Content-Type', 'application/json')
+    handler.set_header('Cache-Control', 'no-cache')
+    handler.set_header('Etag', etag)
+    if handler.check_etag_header():
+        THING_RESPONSE_CACHE.inc(thing.id, "not_modified")
+        handler.set_status(304)
+    else:
+        handler.write(data)
+
+
+class CachedThingHandler(ThingHandler):
+    # serves the thing description from the response cache of the thing. Websocket requests are handled by webthing
+
+    @tornado.gen.coroutine
+    def get(self, thing_id='0'):
+        if self.request.headers.get('Upgrade', '').lower() == 'websocket':
+            yield ThingHandler.get(self, thing_id)
+            return
+        thing = self.get_thing(thing_id)
+        if thing is None:
+            self.set_status(404)
+            return
+        protocol, host = self.request.protocol, self.request.headers.get('Host', '')
+        write_cached(self, thing, thing.cached_description(protocol + "://" + host, lambda: self.__description(thing, protocol, host)))
+
+    @staticmethod
+    def __description(thing: HeaterThing, protocol: str, host: str) -> Dict[str, Any]:
+        # see ThingHandler.get
+        description = thing.as_thing_description()
+        description['links'].append({'rel': 'alternate', 'href': ('wss' if protocol == 'https' else 'ws') + '://' + host + thing.get_href()})
+        description['base'] = protocol + '://' + host + thing.get_href()
+        description['securityDefinitions'] = {'nosec_sc': {'scheme': 'nosec'}}
+        description['security'] = 'nosec_sc'
+        return description
+
+
+class CachedPropertiesHandler(PropertiesHandler):
+
+    def get(self, thing_id='0'):
+        thing = self.get_thing(thing_id)
+        if thing is None:
+            self.set_status(404)
+            return
+        write_cached(self, thing, thing.cached_response("properties", thing.get_properties))
+
+
+class CachedPropertyHandler(PropertyHandler):
+    # property writes are handled by webthing
+
+    def get(self, thing_id='0', property_name=None):
+        thing = self.get_thing(thing_id)
+        if thing is None or not thing.has_property(property_name):
+            self.set_status(404)
+            return
+        write_cached(self, thing, thing.cached_response("property " + property_name, lambda: {property_name: thing.get_property(property_name)}))
+
+
+def cached_thing_routes(things: Union[SingleThing, MultipleThings]) -> List:
+    # replace the handlers of webthing for the reads of the thing description and the properties (additional routes take precedence)
+    prefix = r'/(?P<thing_id>\d+)' if isinstance(things, MultipleThings) else ''
+    args = dict(things=things, hosts=[], disable_host_validation=True)
+    return [(prefix + r'/?', CachedThingHandler, args),
+            (prefix + r'/properties/?', CachedPropertiesHandler, args),
+            (prefix + r'/properties/(?P<property_name>[^/]+)/?', CachedPropertyHandler, args)]
+
+
+class ShellyEventHandler(tornado.web.RequestHandler):
+    # receives the switch state changes pushed by the shelly script (see SHELLY_SCRIPT_TEMPLATE). The events of a heater
+    # are applied by a single worker in the order received, so that a later state is not overwritten by an earlier one
+
+    def initialize(self, heaters: Dict[str, Heater], executors: Dict[str, ThreadPoolExecutor]):
+        self.heaters = heaters
+        self.executors = executors
+
+    @staticmethod
+    def args(heaters: Dict[str, Heater]) -> Dict[str, Any]:
+        return dict(heaters=heaters, executors={name: ThreadPoolExecutor(max_workers=1, thread_name_prefix="shelly events") for name in heaters.keys()})
+
+    async def get(self, name: str = None):
+        heater = self.heaters.get(name)
+        if heater is None:
+            raise tornado.web.HTTPError(404, "unknown heater " + str(name))
+        try:
+            id = int(self.get_argument('id'))
+            is_activated = self.get_argument('on') == 'true'
+        except Exception as e:
+            raise tornado.web.HTTPError(400, str(e))
+        observed_at = heater.clock.monotonic()
+        await tornado.ioloop.IOLoop.current().run_in_executor(self.executors[name], heater.on_switch_event, id, is_activated, observed_at)
+        self.set_status(204)
+
+
+class HistoryHandler(tornado.web.RequestHandler):
+    # e.g. /history?start=2026-01-01&end=2027-01-01&bucket=month (default: last 30 days by day)
+
+    def initialize(self, heaters: Dict[str, Heater]):
+        self.heaters = heaters
+
+    def get(self, name: str = None):
+        heater = self.heaters.get(name)
+        if heater is None:
+            raise tornado.web.HTTPError(404, "unknown heater " + str(name))
+        if not heater.is_history_loaded:
+            self.set_status(503)
+            self.set_header('Retry-After', '5')
+            self.write("heater is " + heater.startup_state)
+            return
+        try:
+            end = datetime.fromisoformat(self.get_argument('end')) if self.get_argument('end', None) is not None else datetime.now()
+            start = datetime.fromisoformat(self.get_argument('start')) if self.get_argument('start', None) is not None else end - timedelta(days=30)
+            history = heater.energy_history(start, end, self.get_argument('bucket', 'day'))
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(history))
+
+
+class HistoryExportHandler(tornado.web.RequestHandler):
+    # e.g. /history/export?start=2024-01-01&end=2026-01-01&kind=sessions&format=csv (default: last 365 days by day as ndjson).
+    # The chunks are generated on the executor and flushed one by one, so that neither the memory nor the ioloop is held by large ranges
+
+    def initialize(self, heaters: Dict[str, Heater]):
+        self.heaters = heaters
+
+    async def get(self, name: str = None):
+        heater = self.heaters.get(name)
+        if heater is None:
+            raise tornado.web.HTTPError(404, "unknown heater " + str(name))
+        if not heater.is_history_loaded:
+            self.set_status(503)
+            self.set_header('Retry-After', '5')
+            self.write("heater is " + heater.startup_state)
+            return
+        format = self.get_argument('format', 'ndjson')
+        try:
+            end = datetime.fromisoformat(self.get_argument('end')) if self.get_argument('end', None) is not None else datetime.now()
+            start = datetime.fromisoformat(self.get_argument('start')) if self.get_argument('start', None) is not None else end - timedelta(days=365)
+            chunks = heater.export_history(start, end, self.get_argument('kind', 'day'), format)
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        self.set_header('Content-Type', CONTENT_TYPES[format])
+        self.set_header('Content-Disposition', 'attachment; filename="heater_history.' + format + '"')
+        try:
+            while True:
+                chunk = await tornado.ioloop.IOLoop.current().run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                self.write(chunk)
+                await self.flush()
+        except StreamClosedError:
+            logging.info("history export aborted by the client")
+        finally:
+            chunks.close()
+
+
+class BackgroundMCPServer:
+    # the mcp libraries take a while to import. To serve the webthing endpoints first, the mcp server
+    # is imported, created and started in the background once the ioloop runs
+
+    def __init__(self, create: Callable[[], Any]):
+        self.__create = create
+        self.server = None
+
+    def start(self):
+        tornado.ioloop.IOLoop.current().add_callback(lambda: Thread(target=self.__start, name="mcp startup", daemon=True).start())
+
+    def __start(self):
+        try:
+            self.server = self.__create()
+            self.server.start()
+        except Exception as e:
+            logging.warning("could not start mcp server " + str(e))
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop()
+
+
+def create_mcp_server(port: int, heater: Heater):
+    from heater_mcp import HeaterMCPServer
+    return HeaterMCPServer(port, heater)
+
+
+def create_fleet_mcp_server(port: int, heaters: Dict[str, Heater]):
+    from heater_mcp import HeaterFleetMCPServer
+    return HeaterFleetMCPServer(port, heaters)
+
+
+def run_server(description: str, port: int, addr: str, directory: str, callback_addr: str = None, surplus_source: str = None, state_file: str = None):
+    heater = Heater(addr, directory, callback_addr, state_file=state_file)
+    surplus_controller = None if surplus_source is None else SurplusController(heater, create_surplus_source(surplus_source), heater.scheduler)
+
+    mcp_server = BackgroundMCPServer(lambda: create_mcp_server(port+1, heater))
+    things = SingleThing(HeaterThing(description, heater))
+    server = WebThingServer(things,
+                            port=port,
+                            disable_host_validation=True,
+                            additional_routes=cached_thing_routes(things) +
+                                              [(r'/shelly/event', ShellyEventHandler, ShellyEventHandler.args({None: heater})),
+                                               (r'/history', HistoryHandler, dict(heaters={None: heater})),
+                                               (r'/history/export', HistoryExportHandler, dict(heaters={None: heater})),
+                                               (r'/metrics', MetricsHandler)])
     try:
-        logging.info('starting the server http://localhost:' + str(port) + " (addr=" + addr + ")")
+        logging.info('starting the server http://localhost:' + str(port) + " (addr=" + addr + ", callback_addr=" + str(callback_addr) + ")")
         heater.start()
+        if surplus_controller is not None:
+            surplus_controller.start()
         mcp_server.start()
         server.start()
     except KeyboardInterrupt:
         logging.info('stopping the server')
+        if surplus_controller is not None:
+            surplus_controller.stop()
         heater.stop()
         mcp_server.stop()
         server.stop()
         logging.info('done')
 
 
+def run_fleet_server(config_file: str, port: int, directory: str, callback_addr: str = None):
+    fleet = HeaterFleet.load(config_file, directory, callback_addr)
+
+    mcp_server = BackgroundMCPServer(lambda: create_fleet_mcp_server(port+1, fleet.heaters))
+    things = [HeaterThing(config.description, fleet.heaters[config.name], 'urn:dev:ops:heater-' + config.name, 'Heater ' + config.name) for config in fleet.configs]
+    multiple_things = MultipleThings(things, 'Heaters')
+    server = WebThingServer(multiple_things,
+                            port=port,
+                            disable_host_validation=True,
+                            additional_routes=cached_thing_routes(multiple_things) +
+                                              [(r'/shelly/([a-zA-Z0-9_]+)/event', ShellyEventHandler, ShellyEventHandler.args(fleet.heaters)),
+                                               (r'/history/([a-zA-Z0-9_]+)', HistoryHandler, dict(heaters=fleet.heaters)),
+                                               (r'/history/([a-zA-Z0-9_]+)/export', HistoryExportHandler, dict(heaters=fleet.heaters)),
+                                               (r'/metrics', MetricsHandler)])
+    try:
+        logging.info('starting the server http://localhost:' + str(port) + " (" + str(len(things)) + " heaters of " + config_file + ", callback_addr=" + str(callback_addr) + ")")
+        fleet.start()
+        mcp_server.start()
+        server.start()
+    except KeyboardInterrupt:
+        logging.info('stopping the server')
+        fleet.stop()
+        mcp_server.stop()
+        server.stop()
+        logging.info('done')
+
+
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s %(name)-20s: %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
     logging.getLogger('tornado.access').setLevel(logging.ERROR)
     logging.getLogger('urllib3.connectionpool').setLevel(logging.WARNING)
-    run_server("description", int(sys.argv[1]), sys.argv[2], sys.argv[3])
+    # the addr argument may refer to a fleet config file instead of a single shelly device
+    if path.isfile(sys.argv[2]):
+        run_fleet_server(sys.argv[2], int(sys.argv[1]), sys.argv[3], sys.argv[4] if len(sys.argv) > 4 and sys.argv[4] != "" else None)
+    else:
+        run_server("description", int(sys.argv[1]), sys.argv[2], sys.argv[3], sys.argv[4] if len(sys.argv) > 4 and sys.argv[4] != "" else None, sys.argv[5] if len(sys.argv) > 5 and sys.argv[5] != "" else None,
+                   sys.argv[6] if len(sys.argv) > 6 and sys.argv[6] != "" else None)
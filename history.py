@@ -0,0 +1,179 @@
+from datetime import datetime, timedelta
+from functools import lru_cache
+from threading import RLock
+from typing import Dict, List, Tuple, Any, Iterator, Set
+from clock import Clock, SYSTEM_CLOCK
+
+
+BUCKETS = ["hour", "day", "week", "month"]
+
+
+def bucket_start(time: datetime, bucket: str) -> datetime:
+    if bucket == "hour":
+        return time.replace(minute=0, second=0, microsecond=0)
+    day = time.replace(hour=0, minute=0, second=0, microsecond=0)
+    if bucket == "day":
+        return day
+    elif bucket == "week":
+        return day - timedelta(days=day.weekday())
+    elif bucket == "month":
+        return day.replace(day=1)
+    raise ValueError("unsupported bucket " + bucket + " (supported: " + ", ".join(BUCKETS) + ")")
+
+
+def next_bucket_start(start: datetime, bucket: str) -> datetime:
+    if bucket == "hour":
+        return start + timedelta(hours=1)
+    elif bucket == "day":
+        return start + timedelta(days=1)
+    elif bucket == "week":
+        return start + timedelta(weeks=1)
+    elif bucket == "month":
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    raise ValueError("unsupported bucket " + bucket + " (supported: " + ", ".join(BUCKETS) + ")")
+
+
+def bucket_key(time: datetime, bucket: str) -> str:
+    return _bucket_key(time.year, time.month, time.day, time.hour if bucket == "hour" else 0, bucket)
+
+
+@lru_cache(maxsize=1024)
+def _bucket_keys(year: int, month: int, day: int, hour: int) -> Tuple[Tuple[str, str], ...]:
+    # the (bucket, key) pairs of all buckets of an hour
+    time = datetime(year, month, day, hour)
+    return tuple([(bucket, bucket_key(time, bucket)) for bucket in BUCKETS])
+
+
+@lru_cache(maxsize=4096)
+def _bucket_key(year: int, month: int, day: int, hour: int, bucket: str) -> str:
+    # the keys are requested for each heating session and energy reading. Formatting them is comparatively expensive
+    return bucket_start(datetime(year, month, day, hour), bucket).strftime('%Y-%m-%dT%H' if bucket == "hour" else '%Y-%m-%d')
+
+
+class HeatingHistory:
+    # heating seconds and measured energy per rod, rolled up by hour, day, week and month. The rollups are updated
+    # incrementally for each heating session and energy counter reading, so that a query costs one lookup per bucket and rod.
+    # Buckets whose measurement is incomplete (e.g. the counter has been reset) are estimated by the heating time
+
+    MAX_QUERY_BUCKETS = 2 * 366 * 24
+    HOURLY_RETENTION_DAYS = 400
+
+    def __init__(self, clock: Clock = SYSTEM_CLOCK):
+        self.__lock = RLock()
+        self.__clock = clock      # the hourly buckets older than HOURLY_RETENTION_DAYS are dropped on to_dict
+        self.__rollups: Dict[str, Dict[Tuple[int, str], float]] = {bucket: {} for bucket in BUCKETS}
+        self.__energy_rollups: Dict[str, Dict[Tuple[int, str], float]] = {bucket: {} for bucket in BUCKETS}
+        self.__energy_incomplete: Dict[str, Set[Tuple[int, str]]] = {bucket: set() for bucket in BUCKETS}
+
+    def add(self, rod_id: int, start: float, end: float):
+        # splits the heating session (epoch secs) by hour
+        with self.__lock:
+            while start < end:
+                start_time = datetime.fromtimestamp(start)
+                chunk_end = min(end, next_bucket_start(bucket_start(start_time, "hour"), "hour").timestamp())
+                for bucket in BUCKETS:
+                    self.__add(rod_id, bucket, bucket_key(start_time, bucket), chunk_end - start)
+                start = chunk_end
+
+    def add_day(self, rod_id: int, day: datetime, heating_secs: float):
+        # for imported day totals without hourly resolution
+        with self.__lock:
+            for bucket in ["day", "week", "month"]:
+                self.__add(rod_id, bucket, bucket_key(day, bucket), heating_secs)
+
+    def add_energy(self, rod_id: int, timestamp: float, energy_wh: float, is_complete: bool = True):
+        # energy (delta of the device counter) measured at the given time (epoch secs). is_complete=False, if energy consumed
+        # before has not been measured. The buckets of the time are estimated by the heating time then
+        with self.__lock:
+            time = datetime.fromtimestamp(timestamp)
+            for bucket, bucket_key_of_time in _bucket_keys(time.year, time.month, time.day, time.hour):
+                rollup = self.__energy_rollups[bucket]
+                key = (rod_id, bucket_key_of_time)
+                rollup[key] = rollup.get(key, 0) + energy_wh
+                if not is_complete:
+                    self.__energy_incomplete[bucket].add(key)
+
+    def __add(self, rod_id: int, bucket: str, key: str, heating_secs: float):
+        rollup = self.__rollups[bucket]
+        rollup[(rod_id, key)] = rollup.get((rod_id, key), 0) + heating_secs
+
+    def heating_secs(self, rod_id: int, bucket: str, time: datetime) -> float:
+        return self.__rollups[bucket].get((rod_id, bucket_key(time, bucket)), 0)
+
+    def energy(self, rod_id: int, bucket: str, time: datetime, rod_power_watt: int) -> float:
+        # watt hours. Measured by the device if available and complete, otherwise estimated by the heating time and the nominal rod power
+        return self.__energy(rod_id, bucket, bucket_key(time, bucket), rod_power_watt)
+
+    def __energy(self, rod_id: int, bucket: str, key: str, rod_power_watt: int) -> float:
+        measured = self.__energy_rollups[bucket].get((rod_id, key), None)
+        if measured is not None and (rod_id, key) not in self.__energy_incomplete[bucket]:
+            return measured
+        return self.__rollups[bucket].get((rod_id, key), 0) * rod_power_watt / (60*60)
+
+    def query(self, start: datetime, end: datetime, bucket: str, rod_ids: List[int], rod_power_watt: int) -> List[Dict[str, Any]]:
+        # consumption (kWh) per rod and in total of each bucket within [start, end)
+        with self.__lock:
+            if bucket not in BUCKETS:
+                raise ValueError("unsupported bucket " + bucket + " (supported: " + ", ".join(BUCKETS) + ")")
+            result = []
+            current = bucket_start(start, bucket)
+            while current < end:
+                if len(result) >= self.MAX_QUERY_BUCKETS:
+                    raise ValueError("query exceeds " + str(self.MAX_QUERY_BUCKETS) + " buckets")
+                key = bucket_key(current, bucket)
+                rods = {rod_id: round(self.__energy(rod_id, bucket, key, rod_power_watt) / 1000, 3) for rod_id in rod_ids}
+                result.append({"start": current.isoformat(),
+                               "rods": rods,
+                               "total": round(sum(rods.values()), 3)})
+                current = next_bucket_start(current, bucket)
+            return result
+
+    @property
+    def rod_ids(self) -> List[int]:
+        with self.__lock:
+            return sorted({rod_id for rod_id, _ in self.__rollups["month"].keys()} | {rod_id for rod_id, _ in self.__energy_rollups["month"].keys()})
+
+    def rows(self, start: datetime, end: datetime, bucket: str, rod_ids: List[int], rod_power_watt: int) -> Iterator[Tuple[int, datetime, datetime, float, float]]:
+        # unbounded counterpart of query: (rod id, bucket start, bucket end, heating secs, energy wh) of each bucket within [start, end),
+        # generated bucket by bucket. The arguments are validated on call, not on iteration
+        if bucket not in BUCKETS:
+            raise ValueError("unsupported bucket " + bucket + " (supported: " + ", ".join(BUCKETS) + ")")
+        return self.__rows(start, end, bucket, rod_ids, rod_power_watt)
+
+    def __rows(self, start: datetime, end: datetime, bucket: str, rod_ids: List[int], rod_power_watt: int) -> Iterator[Tuple[int, datetime, datetime, float, float]]:
+        current = bucket_start(start, bucket)
+        while current < end:
+            following = next_bucket_start(current, bucket)
+            key = bucket_key(current, bucket)
+            with self.__lock:
+                values = [(rod_id, self.__rollups[bucket].get((rod_id, key), 0), self.__energy(rod_id, bucket, key, rod_power_watt)) for rod_id in rod_ids]
+            for rod_id, heating_secs, energy_wh in values:
+                yield rod_id, current, following, heating_secs, energy_wh
+            current = following
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self.__lock:
+            min_hour_key = bucket_key(self.__clock.now() - timedelta(days=self.HOURLY_RETENTION_DAYS), "hour")
+            for rollups in [self.__rollups, self.__energy_rollups]:
+                for key in [key for key in rollups["hour"].keys() if key[1] < min_hour_key]:
+                    del rollups["hour"][key]
+            self.__energy_incomplete["hour"] = {key for key in self.__energy_incomplete["hour"] if key[1] >= min_hour_key}
+            data = {bucket: {str(rod_id) + "/" + key: secs for (rod_id, key), secs in rollup.items()} for bucket, rollup in self.__rollups.items()}
+            data["energy_wh"] = {bucket: {str(rod_id) + "/" + key: wh for (rod_id, key), wh in rollup.items()} for bucket, rollup in self.__energy_rollups.items()}
+            data["energy_incomplete"] = {bucket: sorted([str(rod_id) + "/" + key for rod_id, key in keys]) for bucket, keys in self.__energy_incomplete.items()}
+            return data
+
+    @staticmethod
+    def from_dict(data: Dict[str, Any], clock: Clock = SYSTEM_CLOCK) -> "HeatingHistory":
+        history = HeatingHistory(clock)
+        for bucket in BUCKETS:
+            for rod_key, secs in data[bucket].items():
+                rod_id, key = rod_key.split("/", 1)
+                history.__rollups[bucket][(int(rod_id), key)] = secs
+            for rod_key, wh in data.get("energy_wh", {}).get(bucket, {}).items():
+                rod_id, key = rod_key.split("/", 1)
+                history.__energy_rollups[bucket][(int(rod_id), key)] = wh
+            for rod_key in data.get("energy_incomplete", {}).get(bucket, []):
+                rod_id, key = rod_key.split("/", 1)
+                history.__energy_incomplete[bucket].add((int(rod_id), key))
+        return history
@@ -0,0 +1,125 @@
+import sys
+import json
+import struct
+from datetime import datetime
+from time import time
+from typing import Dict, List, Iterator, Tuple
+from journal import TransitionJournal
+from history import BUCKETS
+from shelly import SCRIPT_AUTO_OFF_SEC, HEATER_ROD_POWER
+
+
+KINDS = ["sessions"] + BUCKETS
+FORMATS = ["ndjson", "csv", "bin"]
+CONTENT_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv", "bin": "application/octet-stream"}
+CHUNK_SIZE = 64 * 1024
+BIN_HEADER = struct.Struct('<4sH')          # magic, layout version
+BIN_MAGIC = b"HTRX"
+BIN_ROW = struct.Struct('<Bdddd')           # rod id, start, end (epoch secs), heating secs, energy wh
+
+Row = Tuple[int, float, float, float, float]
+
+
+def sessions(journal: TransitionJournal, start: datetime, end: datetime, rod_power_watt: int, now: float = None) -> Iterator[Row]:
+    # the heating sessions of the journal within [start, end). Sessions crossing the range are clipped. The energy
+    # is estimated by the heating time and the nominal rod power (the device counters are not recorded per session).
+    # Sessions left open by a crash end SCRIPT_AUTO_OFF_SEC after switching on at the latest (see TransitionJournal).
+    # So, the records of SCRIPT_AUTO_OFF_SEC before the range are read as well, to find the sessions running at its start
+    start_secs, end_secs = start.timestamp(), end.timestamp()
+    now = time() if now is None else now
+    switched_on: Dict[int, float] = {}
+    for timestamp, rod_id, is_activated in journal.records(start_secs - SCRIPT_AUTO_OFF_SEC, end_secs):
+        if is_activated:
+            if rod_id in switched_on:
+                yield from _clipped(rod_id, switched_on[rod_id], min(timestamp, switched_on[rod_id] + SCRIPT_AUTO_OFF_SEC), start_secs, rod_power_watt)
+            switched_on[rod_id] = timestamp
+        elif rod_id in switched_on:
+            yield from _clipped(rod_id, switched_on.pop(rod_id), timestamp, start_secs, rod_power_watt)
+        elif timestamp > start_secs:
+            yield _session(rod_id, start_secs, timestamp, rod_power_watt)       # the on record is missing, e.g. in a truncated journal
+    for rod_id, on_timestamp in sorted(switched_on.items()):
+        yield from _clipped(rod_id, on_timestamp, min(end_secs, now, on_timestamp + SCRIPT_AUTO_OFF_SEC), start_secs, rod_power_watt)
+
+
+def _clipped(rod_id: int, on_timestamp: float, off_timestamp: float, start_secs: float, rod_power_watt: int) -> Iterator[Row]:
+    # the session, if it ends within the range. It is clipped to the start of the range
+    if off_timestamp > start_secs:
+        yield _session(rod_id, max(start_secs, on_timestamp), off_timestamp, rod_power_watt)
+
+
+def _session(rod_id: int, on_timestamp: float, off_timestamp: float, rod_power_watt: int) -> Row:
+    return rod_id, on_timestamp, off_timestamp, off_timestamp - on_timestamp, (off_timestamp - on_timestamp) * rod_power_watt / (60*60)
+
+
+def buckets(journal: TransitionJournal, start: datetime, end: datetime, bucket: str, rod_ids: List[int], rod_power_watt: int) -> Iterator[Row]:
+    # the heating time and energy per rod of each bucket within [start, end), including the imported history of former versions
+    for rod_id, bucket_start, bucket_end, heating_secs, energy_wh in journal.history.rows(start, end, bucket, rod_ids, rod_power_watt):
+        yield rod_id, bucket_start.timestamp(), bucket_end.timestamp(), heating_secs, energy_wh
+
+
+def _ndjson(row: Row) -> bytes:
+    rod_id, start, end, heating_secs, energy_wh = row
+    return (json.dumps({"rod": rod_id,
+                        "start": datetime.fromtimestamp(start).isoformat(),
+                        "end": datetime.fromtimestamp(end).isoformat(),
+                        "heating_secs": round(heating_secs, 1),
+                        "energy_wh": round(energy_wh, 3)}) + "\n").encode("utf-8")
+
+
+def _csv(row: Row) -> bytes:
+    rod_id, start, end, heating_secs, energy_wh = row
+    return (str(rod_id) + "," + datetime.fromtimestamp(start).isoformat() + "," + datetime.fromtimestamp(end).isoformat() + "," +
+            str(round(heating_secs, 1)) + "," + str(round(energy_wh, 3)) + "\n").encode("utf-8")
+
+
+def _bin(row: Row) -> bytes:
+    return BIN_ROW.pack(*row)
+
+
+ENCODERS = {"ndjson": _ndjson, "csv": _csv, "bin": _bin}
+PREAMBLES = {"ndjson": b"", "csv": b"rod,start,end,heating_secs,energy_wh\n", "bin": BIN_HEADER.pack(BIN_MAGIC, 1)}
+
+
+def export(journal: TransitionJournal, start: datetime, end: datetime, kind: str, format: str, rod_ids: List[int], rod_power_watt: int, now: float = None) -> Iterator[bytes]:
+    # the encoded rows in chunks of about CHUNK_SIZE bytes. The rows are generated lazily, so that the memory
+    # stays flat for any range. The arguments are validated on call, not on iteration
+    if kind not in KINDS:
+        raise ValueError("unsupported kind " + kind + " (supported: " + ", ".join(KINDS) + ")")
+    if format not in FORMATS:
+        raise ValueError("unsupported format " + format + " (supported: " + ", ".join(FORMATS) + ")")
+    if kind == "sessions":
+        rows = sessions(journal, start, end, rod_power_watt, now)
+    else:
+        rows = buckets(journal, start, end, kind, rod_ids, rod_power_watt)
+    return _chunks(rows, ENCODERS[format], PREAMBLES[format])
+
+
+def _chunks(rows: Iterator[Row], encode, preamble: bytes) -> Iterator[bytes]:
+    chunk, size = [preamble], len(preamble)
+    for row in rows:
+        data = encode(row)
+        chunk.append(data)
+        size += len(data)
+        if size >= CHUNK_SIZE:
+            yield b"".join(chunk)
+            chunk, size = [], 0
+    if size > 0:
+        yield b"".join(chunk)
+
+
+if __name__ == '__main__':
+    # e.g. python history_export.py /var/lib/heater 2024-01-01 2026-01-01 day csv > history.csv (directory, start, end, kind, format,
+    # optionally the rod power in watt). The journal is read without modifying it, so the heater may keep running
+    journal = TransitionJournal(sys.argv[1])
+    kind = sys.argv[4] if len(sys.argv) > 4 else "day"
+    if kind != "sessions":
+        journal.load(read_only=True)
+    for chunk in export(journal,
+                        datetime.fromisoformat(sys.argv[2]),
+                        datetime.fromisoformat(sys.argv[3]) if len(sys.argv) > 3 else datetime.now(),
+                        kind,
+                        sys.argv[5] if len(sys.argv) > 5 else "csv",
+                        journal.history.rod_ids,
+                        int(sys.argv[6]) if len(sys.argv) > 6 else HEATER_ROD_POWER):
+        sys.stdout.buffer.write(chunk)
+    sys.stdout.flush()
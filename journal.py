@@ -0,0 +1,262 @@
+import os
+import json
+import struct
+import logging
+from datetime import datetime, date
+from threading import RLock
+from time import time
+from typing import Dict, List, Optional, Iterator, Tuple
+from history import HeatingHistory
+from clock import Clock, SYSTEM_CLOCK
+from shelly import SCRIPT_AUTO_OFF_SEC
+
+
+class TransitionJournal:
+    # append-only journal of the on/off transitions of the heating rods. Each transition is stored as a fixed size
+    # binary record (timestamp, rod id, state). Records are buffered and written with a single fsync per commit (group commit).
+    # The heating history per rod (see HeatingHistory) is derived from the journal. To keep the startup fast, the derived totals
+    # are stored periodically as checkpoint, so that only the records after the checkpoint have to be replayed.
+    # The journal is loaded by load(), e.g. in the background after startup. Before, the history is empty.
+    # The energy measured by the device is journaled the same way in a second file, including the last counter reading per rod,
+    # so that the energy consumed between the last commit and a restart is accounted by the first reading after the restart.
+    # While a session is open, the time is committed periodically as heartbeat (see heartbeat). A session left open by a crash
+    # is closed at the last heartbeat then
+
+    RECORD = struct.Struct('<dBB')   # timestamp (epoch secs), rod id, state (1=on, 0=off)
+    ENERGY_RECORD = struct.Struct('<dBBdd')   # timestamp (epoch secs), rod id, flags (1=measurement incomplete), energy (watt hours), counter (watt hours)
+    HEARTBEAT = struct.Struct('<d')   # last alive time (epoch secs), overwritten in place
+
+    def __init__(self, directory: str, name: str = "heater", clock: Clock = SYSTEM_CLOCK):
+        self.__lock = RLock()
+        self.__clock = clock
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.filename = os.path.join(directory, name + "_journal.bin")
+        self.energy_filename = os.path.join(directory, name + "_energy.bin")
+        self.checkpoint_filename = os.path.join(directory, name + "_journal_checkpoint.json")
+        self.heartbeat_filename = os.path.join(directory, name + "_heartbeat.bin")
+        self.__pending: List[bytes] = []
+        self.__pending_energy: List[bytes] = []
+        self.__committed_size = 0
+        self.__committed_energy_size = 0
+        self.__energy_counters: Dict[int, float] = {}            # rod id -> last counter reading (watt hours)
+        self.history = HeatingHistory(clock)
+        self.__switched_on: Dict[int, float] = {}                # rod id -> on timestamp of open sessions
+        self.is_new = not os.path.isfile(self.filename) and not os.path.isfile(self.checkpoint_filename)
+        self.is_loaded = False
+        self.__file = None
+        self.__energy_file = None
+        self.__heartbeat_fd: Optional[int] = None
+
+    def load(self, read_only: bool = False):
+        # read_only=True, if the journal is owned by another process (e.g. the export command line). Nothing is written then
+        with self.__lock:
+            if not self.is_loaded:
+                self.__load(read_only)
+                if not read_only:
+                    self.__file = open(self.filename, "ab")
+                    self.__energy_file = open(self.energy_filename, "ab")
+                    self.__heartbeat_fd = os.open(self.heartbeat_filename, os.O_RDWR | os.O_CREAT, 0o644)
+                    self.checkpoint()      # persists the sessions closed on load
+                self.is_loaded = True
+
+    def __load(self, read_only: bool):
+        started = time()
+        offset, energy_offset = 0, 0
+        checkpoint_time = 0
+        if os.path.isfile(self.checkpoint_filename):
+            try:
+                with open(self.checkpoint_filename) as file:
+                    checkpoint = json.load(file)
+                offset = checkpoint['offset']
+                energy_offset = checkpoint.get('energy_offset', 0)
+                checkpoint_time = checkpoint.get('time', os.path.getmtime(self.checkpoint_filename))
+                self.history = HeatingHistory.from_dict(checkpoint['history'], self.__clock)
+                self.__switched_on = {int(rod_id): timestamp for rod_id, timestamp in checkpoint['switched_on'].items()}
+                self.__energy_counters = {int(rod_id): counter for rod_id, counter in checkpoint.get('energy_counters', {}).items()}
+            except Exception as e:
+                logging.warning("could not load journal checkpoint " + self.checkpoint_filename + " " + str(e) + ". Replaying the complete journal")
+                offset, energy_offset = 0, 0
+                self.__reset()
+        # the journal files are modified on each commit. Read before a partial record is truncated
+        last_commit_time = max([checkpoint_time, self.__last_heartbeat()] + [os.path.getmtime(filename) for filename in [self.filename, self.energy_filename] if os.path.isfile(filename)])
+        valid_size = self.__valid_size(self.filename, self.RECORD, read_only)
+        valid_energy_size = self.__valid_size(self.energy_filename, self.ENERGY_RECORD, read_only)
+        if offset > valid_size or energy_offset > valid_energy_size:
+            logging.warning("journal checkpoint is ahead of journal " + self.filename + ". Replaying the complete journal")
+            offset, energy_offset = 0, 0
+            self.__reset()
+        num_records = 0
+        for timestamp, rod_id, state in self.RECORD.iter_unpack(self.__read(self.filename, offset, valid_size)):
+            self.__apply(timestamp, rod_id, state == 1)
+            num_records += 1
+        for timestamp, rod_id, flags, energy_wh, counter_wh in self.ENERGY_RECORD.iter_unpack(self.__read(self.energy_filename, energy_offset, valid_energy_size)):
+            self.__apply_energy(timestamp, rod_id, energy_wh, counter_wh, flags & 1 == 0)
+            num_records += 1
+        self.__committed_size = valid_size
+        self.__committed_energy_size = valid_energy_size
+        # the off time of sessions open on shutdown or crash is unknown. They are closed at the last heartbeat, commit or checkpoint,
+        # but not later than SCRIPT_AUTO_OFF_SEC after switching on (the script of the device switches the rod off then)
+        for rod_id, on_timestamp in self.__switched_on.items():
+            self.history.add(rod_id, on_timestamp, self.__open_session_end(on_timestamp, last_commit_time))
+        self.__switched_on = {}
+        logging.info("journal " + self.filename + " loaded (" + str(num_records) + " records replayed in " + str(round(time() - started, 2)) + " sec)")
+
+    def __reset(self):
+        self.history = HeatingHistory(self.__clock)
+        self.__switched_on = {}
+        self.__energy_counters = {}
+
+    def __valid_size(self, filename: str, record: struct.Struct, read_only: bool) -> int:
+        # the size of the complete records. A partial record left by a crash is truncated
+        if not os.path.isfile(filename):
+            return 0
+        size = os.path.getsize(filename)
+        valid_size = size - (size % record.size)
+        if valid_size != size and not read_only:
+            logging.warning("journal " + filename + " ends with a partial record. Truncating it")
+            with open(filename, "r+b") as file:
+                file.truncate(valid_size)
+        return valid_size
+
+    def __last_heartbeat(self) -> float:
+        try:
+            with open(self.heartbeat_filename, "rb") as file:
+                data = file.read(self.HEARTBEAT.size)
+            return self.HEARTBEAT.unpack(data)[0] if len(data) == self.HEARTBEAT.size else 0
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def __read(filename: str, offset: int, size: int) -> bytes:
+        if size <= offset:
+            return b""
+        with open(filename, "rb") as file:
+            file.seek(offset)
+            return file.read(size - offset)
+
+    @staticmethod
+    def __open_session_end(on_timestamp: float, last_alive: float) -> float:
+        return max(on_timestamp, min(last_alive, on_timestamp + SCRIPT_AUTO_OFF_SEC))
+
+    def __apply(self, timestamp: float, rod_id: int, is_activated: bool):
+        if is_activated:
+            on_timestamp = self.__switched_on.get(rod_id, None)
+            if on_timestamp is not None:
+                # switched on again by a restarted process, whose predecessor left the session open (replayed without checkpoint)
+                self.history.add(rod_id, on_timestamp, self.__open_session_end(on_timestamp, timestamp))
+            self.__switched_on[rod_id] = timestamp
+        else:
+            on_timestamp = self.__switched_on.pop(rod_id, None)
+            if on_timestamp is not None:
+                self.history.add(rod_id, on_timestamp, timestamp)
+
+    def __apply_energy(self, timestamp: float, rod_id: int, energy_wh: float, counter_wh: float, is_complete: bool):
+        self.__energy_counters[rod_id] = counter_wh
+        self.history.add_energy(rod_id, timestamp, energy_wh, is_complete)
+
+    def append_energy(self, rod_id: int, energy_wh: float, counter_wh: float, is_complete: bool = True, timestamp: Optional[float] = None):
+        # energy_wh is the delta of the device counter since the last reading. is_complete=False, if energy has not been measured
+        # before this reading (no previous reading, or the counter has been reset)
+        with self.__lock:
+            timestamp = self.__clock.time() if timestamp is None else timestamp
+            self.__pending_energy.append(self.ENERGY_RECORD.pack(timestamp, rod_id, 0 if is_complete else 1, energy_wh, counter_wh))
+            self.__apply_energy(timestamp, rod_id, energy_wh, counter_wh, is_complete)
+
+    def energy_counter(self, rod_id: int) -> Optional[float]:
+        # the last counter reading of the rod (watt hours), or None if not known
+        with self.__lock:
+            return self.__energy_counters.get(rod_id, None)
+
+    def append(self, rod_id: int, is_activated: bool, timestamp: Optional[float] = None):
+        with self.__lock:
+            timestamp = self.__clock.time() if timestamp is None else timestamp
+            self.__pending.append(self.RECORD.pack(timestamp, rod_id, 1 if is_activated else 0))
+            self.__apply(timestamp, rod_id, is_activated)
+
+    def records(self, start: float, end: float, chunk_records: int = 4096) -> Iterator[Tuple[float, int, bool]]:
+        # the committed records (timestamp, rod id, state) within [start, end), read in chunks to keep the memory flat
+        # for any range. The records are appended in time order, so the first one is located by binary search
+        with self.__lock:
+            size = self.__committed_size if self.__file is not None else (os.path.getsize(self.filename) if os.path.isfile(self.filename) else 0)
+        num_records = size // self.RECORD.size
+        if num_records == 0:
+            return
+        with open(self.filename, "rb") as file:
+            low, high = 0, num_records
+            while low < high:
+                middle = (low + high) // 2
+                file.seek(middle * self.RECORD.size)
+                if self.RECORD.unpack(file.read(self.RECORD.size))[0] < start:
+                    low = middle + 1
+                else:
+                    high = middle
+            file.seek(low * self.RECORD.size)
+            remaining = num_records - low
+            while remaining > 0:
+                data = file.read(min(remaining, chunk_records) * self.RECORD.size)
+                if len(data) == 0:
+                    return
+                remaining -= len(data) // self.RECORD.size
+                for timestamp, rod_id, state in self.RECORD.iter_unpack(data[:len(data) - (len(data) % self.RECORD.size)]):
+                    if timestamp >= end:
+                        return
+                    yield timestamp, rod_id, state == 1
+
+    def import_heating_secs(self, rod_id: int, day: date, heating_secs: float):
+        self.history.add_day(rod_id, datetime.combine(day, datetime.min.time()), heating_secs)
+
+    def commit(self):
+        with self.__lock:
+            if len(self.__pending) > 0 and self.__file is not None:
+                self.__committed_size += self.__write(self.__file, self.__pending)
+                self.__pending = []
+            if len(self.__pending_energy) > 0 and self.__energy_file is not None:
+                self.__committed_energy_size += self.__write(self.__energy_file, self.__pending_energy)
+                self.__pending_energy = []
+
+    def heartbeat(self):
+        # commits the current time, while a session is open. Otherwise, a crash loses nothing but the pending records
+        with self.__lock:
+            if self.__heartbeat_fd is None or len(self.__switched_on) == 0:
+                return
+            self.commit()
+            os.pwrite(self.__heartbeat_fd, self.HEARTBEAT.pack(self.__clock.time()), 0)
+            os.fsync(self.__heartbeat_fd)
+
+    @staticmethod
+    def __write(file, records: List[bytes]) -> int:
+        data = b"".join(records)
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+        return len(data)
+
+    def checkpoint(self):
+        with self.__lock:
+            if self.__file is None:
+                return
+            self.commit()
+            checkpoint = {"time": time(),
+                          "offset": self.__committed_size,
+                          "energy_offset": self.__committed_energy_size,
+                          "history": self.history.to_dict(),
+                          "switched_on": {str(rod_id): timestamp for rod_id, timestamp in self.__switched_on.items()},
+                          "energy_counters": {str(rod_id): counter for rod_id, counter in self.__energy_counters.items()}}
+            tmp_filename = self.checkpoint_filename + ".tmp"
+            with open(tmp_filename, "w") as file:
+                json.dump(checkpoint, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_filename, self.checkpoint_filename)
+
+    def close(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.checkpoint()
+                self.__file.close()
+                self.__file = None
+                self.__energy_file.close()
+                self.__energy_file = None
+                os.close(self.__heartbeat_fd)
+                self.__heartbeat_fd = None
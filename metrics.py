@@ -0,0 +1,162 @@
+from bisect import bisect_left
+from threading import Lock
+from typing import Dict, List, Tuple, Callable, Optional
+import tornado.web
+
+
+class Metric:
+    # a metric family of the prometheus text format. The values are kept per tuple of label values
+
+    TYPE = "untyped"
+
+    def __init__(self, name: str, help: str, label_names: List[str] = None, registry: "Registry" = None):
+        self.name = name
+        self.help = help
+        self.label_names = [] if label_names is None else label_names
+        self._lock = Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._keys: Dict[Tuple, Tuple[str, ...]] = {}      # label values -> key. Metrics are updated on hot paths
+        (REGISTRY if registry is None else registry).register(self)
+
+    def _key(self, label_values) -> Tuple[str, ...]:
+        key = self._keys.get(label_values)
+        if key is None:
+            if len(label_values) != len(self.label_names):
+                raise ValueError(self.name + " requires the labels " + ", ".join(self.label_names))
+            key = tuple([str(value) for value in label_values])
+            self._keys[label_values] = key
+        return key
+
+    def _labels(self, key: Tuple[str, ...], extra: Dict[str, str] = None) -> str:
+        pairs = list(zip(self.label_names, key)) + ([] if extra is None else list(extra.items()))
+        if len(pairs) == 0:
+            return ""
+        return "{" + ",".join([name + '="' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for name, value in pairs]) + "}"
+
+    def _samples(self) -> List[str]:
+        return []
+
+    def render(self) -> str:
+        return "\n".join(["# HELP " + self.name + " " + self.help, "# TYPE " + self.name + " " + self.TYPE] + self._samples())
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, *label_values, amount: float = 1):
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [self.name + self._labels(key) + " " + repr(float(value)) for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def set(self, value: float, *label_values):
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, func: Callable[[], float], *label_values):
+        # the value is computed on each scrape
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = func
+
+    def remove(self, *label_values):
+        with self._lock:
+            self._values.pop(self._key(label_values), None)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        samples = []
+        for key, value in values:
+            try:
+                samples.append(self.name + self._labels(key) + " " + repr(float(value() if callable(value) else value)))
+            except Exception:
+                pass
+        return samples
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self, name: str, help: str, label_names: List[str] = None, buckets: List[float] = None, registry: "Registry" = None):
+        super().__init__(name, help, label_names, registry)
+        self.buckets = sorted(self.DEFAULT_BUCKETS if buckets is None else buckets)
+
+    def observe(self, value: float, *label_values):
+        key = self._key(label_values)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1) + [0.0]     # count per bucket, +Inf bucket, sum
+                self._values[key] = counts
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def _samples(self) -> List[str]:
+        samples = []
+        with self._lock:
+            for key, counts in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + [float("inf")], counts[:-1]):
+                    cumulative += count
+                    samples.append(self.name + "_bucket" + self._labels(key, {"le": "+Inf" if bound == float("inf") else repr(float(bound))}) + " " + str(cumulative))
+                samples.append(self.name + "_sum" + self._labels(key) + " " + repr(float(counts[-1])))
+                samples.append(self.name + "_count" + self._labels(key) + " " + str(cumulative))
+        return samples
+
+
+class Registry:
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        with self.__lock:
+            if metric.name in self.__metrics.keys():
+                raise ValueError("duplicated metric " + metric.name)
+            self.__metrics[metric.name] = metric
+
+    def get(self, name: str) -> Optional[Metric]:
+        return self.__metrics.get(name)
+
+    def render(self) -> str:
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+        return "\n".join([metric.render() for metric in metrics]) + "\n"
+
+
+REGISTRY = Registry()
+
+SHELLY_RPC_LATENCY = Histogram("heater_shelly_rpc_latency_seconds", "latency of the rpc requests to the shelly device", ["device", "method"])
+SHELLY_RPC_ERRORS = Counter("heater_shelly_rpc_errors_total", "failed rpc requests to the shelly device (transport errors and http status >= 400)", ["device", "method"])
+SHELLY_CIRCUIT_OPENINGS = Counter("heater_shelly_circuit_openings_total", "openings of the circuit breaker of the shelly device", ["device"])
+SHELLY_CIRCUIT_REJECTIONS = Counter("heater_shelly_circuit_rejections_total", "rpc requests rejected by the open circuit breaker", ["device"])
+SHELLY_SCRIPT_UPLOADS = Counter("heater_shelly_script_uploads_total", "uploads of shelly scripts (content changed or missing)", ["device"])
+SWITCH_COMMANDS = Counter("heater_switch_commands_total", "switch commands sent per switch (rod)", ["device", "switch", "state"])
+JOB_LAG = Gauge("heater_job_lag_seconds", "delay of the last run of a scheduled job behind its due time", ["scheduler", "job"])
+JOB_DURATION = Gauge("heater_job_duration_seconds", "duration of the last run of a scheduled job", ["scheduler", "job"])
+JOB_OVERRUNS = Counter("heater_job_overruns_total", "runs of a periodic job taking longer than its interval", ["scheduler", "job"])
+JOB_ERRORS = Counter("heater_job_errors_total", "runs of a scheduled job raising an error", ["scheduler", "job"])
+VALUE_CHANGED_DURATION = Histogram("heater_thing_update_seconds", "duration of the ioloop callback updating the properties of a thing", ["thing"],
+                                   buckets=[0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25])
+WEBSOCKET_SUBSCRIBERS = Gauge("heater_thing_websocket_subscribers", "number of websocket subscribers of a thing", ["thing"])
+THING_RESPONSE_CACHE = Counter("heater_thing_response_cache_total", "reads of the thing description and properties by result (hit, miss or not_modified)", ["thing", "result"])
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    # serves the metrics in the prometheus text format, e.g. /metrics
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(REGISTRY.render())
@@ -0,0 +1,205 @@
+import os
+import sys
+import csv
+import json
+import logging
+import tempfile
+from time import time
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from typing import List, Dict, Any, Optional, Tuple
+from clock import VirtualClock
+from heater import Heater
+from scheduler import Scheduler
+from shelly import SwitchStatus, SCRIPT_AUTO_OFF_SEC
+from surplus import SurplusController, StubSurplusSource
+
+
+class TraceEvent:
+
+    def __init__(self, time: datetime, kind: str, value: float):
+        self.time = time
+        self.kind = kind        # "surplus" (watt exported to the grid) or "rods" (command of the number of active rods)
+        self.value = value
+
+    @staticmethod
+    def load(filename: str) -> List["TraceEvent"]:
+        # csv file of time (iso format or epoch secs), kind and value, e.g. 2025-06-01T10:00:00,surplus,1250
+        events = []
+        with open(filename) as file:
+            for row in csv.reader(file):
+                if len(row) < 3 or row[0].startswith("#") or row[0] == "time":
+                    continue
+                try:
+                    timestamp = datetime.fromtimestamp(float(row[0]))
+                except ValueError:
+                    timestamp = datetime.fromisoformat(row[0])
+                if row[1] not in ["surplus", "rods"]:
+                    raise ValueError("unsupported event kind " + row[1] + " in " + filename)
+                events.append(TraceEvent(timestamp, row[1], float(row[2])))
+        return sorted(events, key=lambda event: event.time)
+
+
+class InlineExecutor:
+    # runs the submitted functions on the calling thread, to keep the replay deterministic
+
+    def submit(self, func, *args):
+        func(*args)
+
+    def shutdown(self, wait: bool = True):
+        pass
+
+
+class VirtualShelly3Pro:
+    # in-memory replacement of Shelly3Pro running on the virtual clock. The auto-off timer of the script is emulated
+
+    def __init__(self, clock: VirtualClock, num_switches: int, power_watt: float = Heater.HEATER_ROD_POWER, auto_off_sec: float = SCRIPT_AUTO_OFF_SEC):
+        self.clock = clock
+        self.power_watt = power_watt
+        self.auto_off_sec = auto_off_sec
+        self.outputs = {id: False for id in range(0, num_switches)}
+        self.on_since = {id: 0.0 for id in range(0, num_switches)}
+        self.heating_secs = {id: 0.0 for id in range(0, num_switches)}
+        self.switch_ons = {id: 0 for id in range(0, num_switches)}
+        self.auto_offs = {id: 0 for id in range(0, num_switches)}
+        self.commands = 0
+        self.breaker_state = "closed"
+
+    def __apply_auto_off(self):
+        for id, output in self.outputs.items():
+            if output and self.clock.time() >= self.on_since[id] + self.auto_off_sec:
+                self.__set(id, False, self.on_since[id] + self.auto_off_sec)
+                self.auto_offs[id] += 1
+
+    def __set(self, id: int, on: bool, timestamp: float):
+        if self.outputs[id] == on:
+            return
+        self.outputs[id] = on
+        if on:
+            self.on_since[id] = timestamp
+            self.switch_ons[id] += 1
+        else:
+            self.heating_secs[id] += timestamp - self.on_since[id]
+
+    def energy_wh(self, id: int) -> float:
+        secs = self.heating_secs[id] + (self.clock.time() - self.on_since[id] if self.outputs[id] else 0)
+        return secs * self.power_watt / (60*60)
+
+    @property
+    def power(self) -> float:
+        self.__apply_auto_off()
+        return len([output for output in self.outputs.values() if output]) * self.power_watt
+
+    def set_breaker_listener(self, listener):
+        pass
+
+    def query(self, id: int) -> bool:
+        self.__apply_auto_off()
+        return self.outputs[id]
+
+    def query_all(self) -> Dict[int, SwitchStatus]:
+        self.__apply_auto_off()
+        return {id: SwitchStatus(id, output, self.power_watt if output else 0.0, self.energy_wh(id)) for id, output in self.outputs.items()}
+
+    def switch(self, id: int, on: bool):
+        self.__apply_auto_off()
+        self.commands += 1
+        self.__set(id, on, self.clock.time())
+
+    def switch_all(self, states: Dict[int, bool]) -> Dict[int, Optional[Exception]]:
+        for id, on in states.items():
+            self.switch(id, on)
+        return {id: None for id in states.keys()}
+
+    def deploy_scripts_async(self, scripts: Dict[int, Tuple[str, str]]) -> Future:
+        future = Future()
+        future.set_result([])
+        return future
+
+
+class ReplayEngine:
+    # feeds a recorded trace through the real heater logic (Heater, HeatingRod, SurplusController and Scheduler) on a
+    # virtual clock, and reports the consumed energy, the wear balance of the rods and the switch counts. By default, the
+    # surplus of the trace is taken as recorded without the heater, i.e. the power of the heater is subtracted before
+    # it is passed to the controller
+
+    INTEGRATION_STEP_SEC = 60
+
+    def __init__(self,
+                 events: List[TraceEvent],
+                 num_heating_rods: int = 3,
+                 auto_decrease_min: float = Heater.AUTO_DECREASE_MIN,
+                 min_step_interval_sec: float = 0,
+                 hysteresis_watt: int = 100,
+                 surplus_includes_heater: bool = False):
+        if len(events) == 0:
+            raise ValueError("empty trace")
+        self.events = events
+        self.num_heating_rods = num_heating_rods
+        self.auto_decrease_min = auto_decrease_min
+        self.min_step_interval_sec = min_step_interval_sec
+        self.hysteresis_watt = hysteresis_watt
+        self.surplus_includes_heater = surplus_includes_heater
+
+    def run(self) -> Dict[str, Any]:
+        started = time()
+        start = self.events[0].time
+        end = self.events[-1].time + timedelta(hours=1)
+        clock = VirtualClock(start)
+        scheduler = Scheduler("replay scheduler", clock)
+        shelly = VirtualShelly3Pro(clock, self.num_heating_rods)
+        surplus_wh, grid_wh = 0.0, 0.0
+        with tempfile.TemporaryDirectory() as directory:
+            heater = Heater("virtual", directory, num_heating_rods=self.num_heating_rods, scheduler=scheduler, min_step_interval_sec=self.min_step_interval_sec,
+                            auto_decrease_min=self.auto_decrease_min, shelly=shelly, clock=clock, state_file=os.path.join(directory, "heater_state.bin"))
+            source = StubSurplusSource()
+            controller = SurplusController(heater, source, scheduler, hysteresis_watt=self.hysteresis_watt, executor=InlineExecutor(), clock=clock)
+            heater.start()
+            controller.start()
+            scheduler.run_until(clock.time())     # startup
+            for job in scheduler.jobs:
+                if job.name in ["journal commit", "journal heartbeat", "journal checkpoint"]:
+                    job.cancel()      # the journal is not durable in replay. It is committed on stop
+            surplus: Optional[float] = None
+            try:
+                for event in self.events + [TraceEvent(end, "end", 0)]:
+                    # the scheduled jobs are run until the event. Meanwhile, the used surplus and grid energy is integrated
+                    event_time = event.time.timestamp()
+                    while clock.time() < event_time:
+                        step_end = min(event_time, clock.time() + self.INTEGRATION_STEP_SEC)
+                        power, step_sec = shelly.power, step_end - clock.time()
+                        available = 0 if surplus is None else max(0.0, surplus)
+                        surplus_wh += min(power, available) * step_sec / (60*60)
+                        grid_wh += max(0.0, power - available) * step_sec / (60*60)
+                        scheduler.run_until(step_end)
+                    if event.kind == "surplus":
+                        surplus = event.value
+                        source.set_surplus(surplus if self.surplus_includes_heater else surplus - shelly.power)
+                    elif event.kind == "rods":
+                        heater.set_heating_rods_active(int(event.value), reason="due to replay")
+            finally:
+                controller.stop()
+                heater.stop()
+        heating_hours = {id: round(secs / (60*60), 2) for id, secs in shelly.heating_secs.items()}
+        return {"start": start.isoformat(),
+                "end": end.isoformat(),
+                "events": len(self.events),
+                "wall_time_sec": round(time() - started, 2),
+                "speedup": int((end - start).total_seconds() / max(0.001, time() - started)),
+                "energy_kwh": round(sum([shelly.energy_wh(id) for id in shelly.outputs.keys()]) / 1000, 3),
+                "surplus_energy_kwh": round(surplus_wh / 1000, 3),
+                "grid_energy_kwh": round(grid_wh / 1000, 3),
+                "switch_commands": shelly.commands,
+                "rods": {id: {"heating_hours": heating_hours[id],
+                              "switch_ons": shelly.switch_ons[id],
+                              "auto_offs": shelly.auto_offs[id]} for id in shelly.outputs.keys()},
+                # 1.0 if the heating time is distributed evenly over the rods
+                "wear_balance": round(min(heating_hours.values()) / max(heating_hours.values()), 3) if max(heating_hours.values()) > 0 else 1.0}
+
+
+if __name__ == '__main__':
+    # e.g. python replay.py surplus_2025.csv 23 (trace file, auto decrease minutes)
+    logging.basicConfig(format='%(asctime)s %(name)-20s: %(levelname)-8s %(message)s', level=logging.WARNING, datefmt='%Y-%m-%d %H:%M:%S')
+    engine = ReplayEngine(TraceEvent.load(sys.argv[1]),
+                          auto_decrease_min=float(sys.argv[2]) if len(sys.argv) > 2 else Heater.AUTO_DECREASE_MIN)
+    print(json.dumps(engine.run(), indent=2))
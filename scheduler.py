@@ -0,0 +1,157 @@
+import logging
+import heapq
+from random import uniform
+from threading import Thread, Condition
+from typing import Callable, List, Optional
+from clock import Clock, SYSTEM_CLOCK
+from metrics import JOB_LAG, JOB_DURATION, JOB_OVERRUNS, JOB_ERRORS
+
+
+class Job:
+
+    def __init__(self, name: str, func: Callable[[], None], interval_sec: Optional[float], jitter_sec: float = 0):
+        self.name = name
+        self.func = func
+        self.interval_sec = interval_sec      # None for one-shot jobs
+        self.jitter_sec = jitter_sec
+        self.next_run = 0.0
+        self.runs = 0
+        self.overruns = 0
+        self.last_lag_sec = 0.0
+        self.last_duration_sec = 0.0
+        self.is_cancelled = False
+
+    def cancel(self):
+        self.is_cancelled = True
+
+    def __str__(self):
+        return "job " + self.name
+
+
+class Scheduler:
+    # runs all periodic jobs on a single thread, ordered by a heap of due times. With a VirtualClock, the
+    # jobs are run by run_until instead of the thread, advancing the clock from due time to due time
+
+    def __init__(self, name: str = "scheduler", clock: Clock = SYSTEM_CLOCK):
+        self.name = name
+        self.clock = clock
+        self.__heap: List = []
+        self.__seq = 0
+        self.__condition = Condition()
+        self.__is_running = False
+        self.__thread = None
+
+    def every(self, name: str, interval_sec: float, func: Callable[[], None], jitter_sec: float = 0, initial_delay_sec: float = 0) -> Job:
+        job = Job(name, func, interval_sec, jitter_sec)
+        self.__schedule(job, self.clock.monotonic() + initial_delay_sec)
+        return job
+
+    def once(self, name: str, func: Callable[[], None], delay_sec: float = 0) -> Job:
+        job = Job(name, func, None)
+        self.__schedule(job, self.clock.monotonic() + delay_sec)
+        return job
+
+    def reschedule(self, job: Job, delay_sec: float):
+        # brings the next run of the job forward, e.g. if the state is expected to change soon. A later run is not postponed
+        with self.__condition:
+            due = self.clock.monotonic() + delay_sec
+            if not job.is_cancelled and due < job.next_run:
+                self.__schedule(job, due)
+
+    def __schedule(self, job: Job, due: float):
+        with self.__condition:
+            job.next_run = due
+            self.__seq += 1
+            heapq.heappush(self.__heap, (due, self.__seq, job))
+            self.__condition.notify()
+
+    def start(self):
+        with self.__condition:
+            if self.__is_running:
+                return
+            self.__is_running = True
+        self.__thread = Thread(target=self.__loop, name=self.name, daemon=True)
+        self.__thread.start()
+
+    def stop(self, timeout_sec: float = 5):
+        with self.__condition:
+            self.__is_running = False
+            self.__condition.notify()
+        if self.__thread is not None:
+            self.__thread.join(timeout_sec)
+
+    @property
+    def is_running(self) -> bool:
+        return self.__is_running
+
+    @property
+    def jobs(self) -> List[Job]:
+        with self.__condition:
+            return [job for due, _, job in self.__heap if due == job.next_run]
+
+    def __next_due_job(self) -> Optional[Job]:
+        with self.__condition:
+            while self.__is_running:
+                if len(self.__heap) == 0:
+                    self.__condition.wait()
+                    continue
+                due, _, job = self.__heap[0]
+                if job.is_cancelled or due != job.next_run:   # cancelled or rescheduled
+                    heapq.heappop(self.__heap)
+                    continue
+                wait_sec = due - self.clock.monotonic()
+                if wait_sec > 0:
+                    self.__condition.wait(wait_sec)
+                    continue
+                heapq.heappop(self.__heap)
+                return job
+            return None
+
+    def run_until(self, until: float):
+        # runs the jobs due until the given (monotonic) time on the calling thread. Used with a VirtualClock
+        while True:
+            with self.__condition:
+                while len(self.__heap) > 0 and (self.__heap[0][2].is_cancelled or self.__heap[0][0] != self.__heap[0][2].next_run):
+                    heapq.heappop(self.__heap)
+                if len(self.__heap) == 0 or self.__heap[0][0] > until:
+                    break
+                due, _, job = heapq.heappop(self.__heap)
+            if due > self.clock.monotonic():
+                self.clock.advance_to(due)
+            self.__run(job)
+        if until > self.clock.monotonic():
+            self.clock.advance_to(until)
+
+    def __loop(self):
+        while True:
+            job = self.__next_due_job()
+            if job is None:
+                return
+            self.__run(job)
+
+    def __run(self, job: Job):
+        started = self.clock.monotonic()
+        job.last_lag_sec = started - job.next_run
+        try:
+            job.func()
+        except Exception as e:
+            JOB_ERRORS.inc(self.name, job.name)
+            logging.warning("error occurred on " + str(job) + " " + str(e))
+        job.runs += 1
+        job.last_duration_sec = self.clock.monotonic() - started
+        JOB_LAG.set(job.last_lag_sec, self.name, job.name)
+        JOB_DURATION.set(job.last_duration_sec, self.name, job.name)
+        if job.interval_sec is not None:
+            if job.last_duration_sec > job.interval_sec:
+                job.overruns += 1
+                JOB_OVERRUNS.inc(self.name, job.name)
+                logging.warning(str(job) + " overrun (took " + str(round(job.last_duration_sec, 1)) + " sec, interval " + str(job.interval_sec) + " sec)")
+            # next run is based on the planned time to avoid drift. If overrun, skip the missed runs.
+            # The interval may have been changed by the job itself (adaptive period)
+            next_run = job.next_run + job.interval_sec
+            if next_run < self.clock.monotonic():
+                next_run = self.clock.monotonic() + job.interval_sec
+            if job.jitter_sec > 0:
+                next_run += uniform(0, job.jitter_sec)
+            if not job.is_cancelled:
+                self.__schedule(job, next_run)
@@ -1,115 +1,295 @@
 import json
-from requests import Session
+import asyncio
+import hashlib
+from threading import Thread, Lock
+from concurrent.futures import Future
 from string import Template
+from typing import Dict, List, Optional, Tuple
+from tornado.httpclient import AsyncHTTPClient, HTTPResponse
+try:
+    # keeps the connections to the devices alive (optional, requires pycurl)
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+    import pycurl  # noqa: F401
+except ImportError:
+    CurlAsyncHTTPClient = None
+from time import monotonic
+from breaker import CircuitBreaker, CircuitOpenError
+from metrics import SHELLY_RPC_LATENCY, SHELLY_RPC_ERRORS, SHELLY_CIRCUIT_OPENINGS, SHELLY_CIRCUIT_REJECTIONS, SHELLY_SCRIPT_UPLOADS, SWITCH_COMMANDS
 import logging
 
 
+SCRIPT_AUTO_OFF_SEC = 45 * 60     # the script switches a rod off after this time, even if the heater is not reachable
+HEATER_ROD_POWER = 500            # nominal power (watt) of a heating rod switched by the device
+
 SHELLY_SCRIPT_TEMPLATE = Template('''
     Shelly.addStatusHandler(function(e) {
      if (e.component === "switch:$id") {
         if (e.delta.output === true) {
           print("heater $id is on");
-          Timer.set(45*60*1000, false, function (ud) {
+          Timer.set($auto_off_ms, false, function (ud) {
                  Shelly.call("Switch.set", {'id': $id, 'on': false});
               }, null);
         } else {
           print("heater $id is off");
         }
+        if (e.delta.output !== undefined && "$callback" !== "") {
+          Shelly.call("HTTP.GET", {'url': "$callback?id=$id&on=" + JSON.stringify(e.delta.output)});
+        }
       }
     });
 ''')
 
 
 
-class Shelly3Pro:
+class SwitchStatus:
+
+    def __init__(self, id: int, is_on: bool, power: Optional[float] = None, energy: Optional[float] = None):
+        self.id = id
+        self.is_on = is_on
+        self.power = power      # current active power (watt) as measured by the device
+        self.energy = energy    # cumulative active energy counter (watt hours) as measured by the device
+
+    @staticmethod
+    def from_dict(data: Dict) -> "SwitchStatus":
+        power = data.get('apower', None)
+        energy = data.get('aenergy', {}).get('total', None)
+        return SwitchStatus(int(data['id']),
+                            bool(data['output']),
+                            None if power is None else float(power),
+                            None if energy is None else float(energy))
+
+    def __str__(self):
+        return "switch " + str(self.id) + " " + ("on" if self.is_on else "off") + " (power=" + str(self.power) + "W, energy=" + str(self.energy) + "Wh)"
+
+
+class AsyncShelly3Pro:
+    MAX_CONNECTIONS = 4
+    TIMEOUT_SEC = 10
 
-    def __init__(self, addr: str):
-        self.__session = Session()
+    def __init__(self, addr: str, max_connections: int = MAX_CONNECTIONS, timeout_sec: int = TIMEOUT_SEC):
         self.addr = addr
+        self.__max_connections = max_connections
+        self.__timeout_sec = timeout_sec
+        self.__client = None
+        self.breaker = CircuitBreaker(addr)
 
-    def query(self, id: int) -> bool:
-        uri = self.addr + '/rpc/Switch.GetStatus?id=' + str(id)
+    @property
+    def __http_client(self) -> AsyncHTTPClient:
+        # created lazily to bind the client to the ioloop the requests are running on. The curl client keeps up to max_connections
+        # connections alive. Without pycurl, the simple client of tornado opens a new connection per rpc (about 1 ms per rpc on
+        # loopback, measured against the simulator, plus the tcp handshake with the device)
+        if self.__client is None:
+            if CurlAsyncHTTPClient is None:
+                self.__client = AsyncHTTPClient(force_instance=True, max_clients=self.__max_connections)
+            else:
+                self.__client = CurlAsyncHTTPClient(force_instance=True, max_clients=self.__max_connections)
+        return self.__client
+
+    async def __fetch(self, uri: str, timeout_sec: int = None, **kwargs) -> HTTPResponse:
+        # fails fast, if the device is unreachable (see CircuitBreaker)
+        method = uri[len(self.addr):].split('?')[0][len('/rpc/'):]
         try:
-            resp = self.__session.get(uri, timeout=10)
-            try:
-                data = resp.json()
-                return bool(data['output'])
-            except Exception as e:
-                raise Exception("called " + uri + " got " + str(resp.status_code) + " " + resp.text + " " + str(e))
+            self.breaker.before_call()
+        except CircuitOpenError as e:
+            SHELLY_CIRCUIT_REJECTIONS.inc(self.addr)
+            raise e
+        started = monotonic()
+        try:
+            resp = await self.__http_client.fetch(uri, request_timeout=timeout_sec or self.__timeout_sec, raise_error=False, **kwargs)
         except Exception as e:
-            self.__renew_session()
+            SHELLY_RPC_ERRORS.inc(self.addr, method)
+            if self.breaker.on_failure():
+                SHELLY_CIRCUIT_OPENINGS.inc(self.addr)
             raise e
+        finally:
+            SHELLY_RPC_LATENCY.observe(monotonic() - started, self.addr, method)
+        if resp.code >= 400:
+            SHELLY_RPC_ERRORS.inc(self.addr, method)
+        # any http response, including rpc errors, proves that the device is reachable
+        self.breaker.on_success()
+        return resp
 
-    def switch(self, id: int, on: bool):
+    async def __get(self, uri: str, timeout_sec: int = None) -> HTTPResponse:
+        return await self.__fetch(uri, timeout_sec)
+
+    async def __post(self, uri: str, data: dict, timeout_sec: int = None) -> HTTPResponse:
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        return await self.__fetch(uri, timeout_sec, method='POST', body=body)
+
+    @staticmethod
+    def __text(resp: HTTPResponse) -> str:
+        return "" if resp.body is None else resp.body.decode("utf-8", errors="replace")
+
+    async def query(self, id: int) -> bool:
+        uri = self.addr + '/rpc/Switch.GetStatus?id=' + str(id)
+        resp = await self.__get(uri)
+        try:
+            data = json.loads(resp.body)
+            return bool(data['output'])
+        except Exception as e:
+            raise Exception("called " + uri + " got " + str(resp.code) + " " + self.__text(resp) + " " + str(e))
+
+    async def query_all(self, timeout_sec: float = None) -> Dict[int, SwitchStatus]:
+        uri = self.addr + '/rpc/Shelly.GetStatus'
+        resp = await self.__get(uri, timeout_sec)
+        try:
+            data = json.loads(resp.body)
+            return {int(key[len('switch:'):]): SwitchStatus.from_dict(status) for key, status in data.items() if key.startswith('switch:')}
+        except Exception as e:
+            raise Exception("called " + uri + " got " + str(resp.code) + " " + self.__text(resp) + " " + str(e))
+
+    async def switch(self, id: int, on: bool):
         uri = self.addr + '/rpc/Switch.Set?id=' + str(id) + '&on=' + ('true' if on else 'false')
+        SWITCH_COMMANDS.inc(self.addr, id, 'on' if on else 'off')
         try:
-            resp = self.__session.get(uri, timeout=10)
-            if resp.status_code != 200:
-                raise Exception("called " + uri + " got " + str(resp.status_code) + " " + resp.text)
+            resp = await self.__get(uri)
         except Exception as e:
-            self.__renew_session()
             raise Exception("called " + uri + " got " + str(e))
+        if resp.code != 200:
+            raise Exception("called " + uri + " got " + str(resp.code) + " " + self.__text(resp))
 
-    def upload_script(self, id: int, code: str):
-        uri = self.addr + '/rpc/Script.GetStatus?id=' + str(id)
-        resp = self.__session.get(uri)
-        script_exists = resp.status_code == 200
+    @staticmethod
+    def script_name(name: str, code: str) -> str:
+        # the name of a deployed script contains the hash of its code. A script with unchanged code is not uploaded again
+        return name + "_" + hashlib.sha1(code.encode("utf-8")).hexdigest()[:8]
+
+    async def list_scripts(self) -> Dict[int, Dict]:
+        # script id -> {"id", "name", "enable", "running"}
+        uri = self.addr + '/rpc/Script.List'
+        resp = await self.__get(uri)
+        try:
+            return {int(script['id']): script for script in json.loads(resp.body)['scripts']}
+        except Exception as e:
+            raise Exception("called " + uri + " got " + str(resp.code) + " " + self.__text(resp) + " " + str(e))
+
+    async def deploy_scripts(self, scripts: Dict[int, Tuple[str, str]]) -> List[int]:
+        # script id -> (name, code). Uploads the scripts, whose code has changed, concurrently and (re)starts stopped ones.
+        # Returns the ids of the uploaded scripts
+        deployed = await self.list_scripts()
+        outdated = {id: (self.script_name(name, code), code) for id, (name, code) in scripts.items()
+                    if deployed.get(id, {}).get('name') != self.script_name(name, code)}
+        results = await asyncio.gather(*[self.upload_script(id, code, name) for id, (name, code) in outdated.items()], return_exceptions=True)
+        for id, result in zip(outdated.keys(), results):
+            if isinstance(result, Exception):
+                logging.warning("could not deploy shelly script " + str(id) + " " + str(result))
+        up_to_date = [id for id in scripts.keys() if id not in outdated.keys()]
+        if len(up_to_date) > 0:
+            logging.info("shelly scripts " + ", ".join([str(id) for id in up_to_date]) + " are up to date")
+            await self.start_scripts([id for id in up_to_date if not deployed[id].get('enable', False) or not deployed[id].get('running', False)])
+        return [id for id, result in zip(outdated.keys(), results) if not isinstance(result, Exception)]
+
+    async def upload_script(self, id: int, code: str, name: str = None):
+        name = "auto_off_" + str(id-1) if name is None else name
+        resp = await self.__get(self.addr + '/rpc/Script.GetStatus?id=' + str(id))
+        script_exists = resp.code == 200
         if script_exists:
-            uri = self.addr + '/rpc/Script.Stop?id=' + str(id)
-            resp  = self.__session.get(uri)
-            if resp.status_code == 200:
-                logging.debug("shelly script " + str(id) + " stopped " + resp.text)
+            resp = await self.__get(self.addr + '/rpc/Script.Stop?id=' + str(id))
+            if resp.code == 200:
+                logging.debug("shelly script " + str(id) + " stopped " + self.__text(resp))
             else:
-                logging.warning("could not stop shelly script " + str(id) + " " + resp.text)
+                logging.warning("could not stop shelly script " + str(id) + " " + self.__text(resp))
         else:
-            uri = self.addr + '/rpc/Script.Create?'
-            req_data = json.dumps({"id": id, "name": "auto_off_" + str(id-1)}, ensure_ascii=False)
-            resp = self.__session.post(uri, data=req_data.encode("utf-8"), timeout=15)
-            if resp.status_code == 200:
-                logging.debug("shelly script " + str(id) + " created " + resp.text)
+            resp = await self.__post(self.addr + '/rpc/Script.Create?', {"id": id, "name": name}, timeout_sec=15)
+            if resp.code == 200:
+                logging.debug("shelly script " + str(id) + " created " + self.__text(resp))
             else:
-                logging.warning("could not create shelly script " + str(id) + " " + resp.text)
+                logging.warning("could not create shelly script " + str(id) + " " + self.__text(resp))
 
-            uri = self.addr + '/rpc/Script.PutCode'
-            req_data = json.dumps({"id": id, "code": code, "append": False}, ensure_ascii=False)
-            resp = self.__session.post(uri, data=req_data.encode("utf-8"), timeout=15)
-            if resp.status_code == 200:
-                logging.info("shelly script " + str(id) + " uploaded")
-            else:
-                logging.warning("could not upload shelly script " + str(id) + " " + resp.text)
+        resp = await self.__post(self.addr + '/rpc/Script.PutCode', {"id": id, "code": code, "append": False}, timeout_sec=15)
+        if resp.code == 200:
+            logging.info("shelly script " + str(id) + " uploaded")
+            SHELLY_SCRIPT_UPLOADS.inc(self.addr)
+        else:
+            raise Exception("could not upload shelly script " + str(id) + " " + self.__text(resp))
 
-        self.enable_script(id)
-        self.restart_script(id)
+        # the name is set after the code has been uploaded successfully. Otherwise, the upload is repeated on the next deploy
+        await self.enable_script(id, name)
+        await self.restart_script(id)
 
-    def enable_script(self, id: int):
-        uri = self.addr + '/rpc/Script.SetConfig?id=' + str(id) + "&config={%22enable%22:true}"
-        resp = self.__session.get(uri, timeout=15)
-        if resp.status_code == 200:
-            logging.debug("shelly script " + str(id) + " enabled " + resp.text)
+    async def enable_script(self, id: int, name: str = None):
+        config = {"enable": True} if name is None else {"enable": True, "name": name}
+        resp = await self.__post(self.addr + '/rpc/Script.SetConfig', {"id": id, "config": config}, timeout_sec=15)
+        if resp.code == 200:
+            logging.debug("shelly script " + str(id) + " enabled " + self.__text(resp))
         else:
-            logging.debug("could not enable shelly script " + str(id) + " " + resp.text)
+            logging.debug("could not enable shelly script " + str(id) + " " + self.__text(resp))
 
-
-    def restart_script(self, id: int):
+    async def restart_script(self, id: int):
         uri = self.addr + '/rpc/Script.GetStatus?id=' + str(id)
         try:
-            resp = self.__session.get(uri)
-            if not resp.json()['running']:
-                resp  = self.__session.get(self.addr + '/rpc/Script.Start?id=' + str(id))
-                if resp.status_code == 200:
-                    logging.info("shelly script " + str(id) + " (re)started")
-                else:
-                    logging.debug("could not (re)start shelly script " + str(id) + " " + resp.text)
+            resp = await self.__get(uri)
+            if not json.loads(resp.body)['running']:
+                await self.__start_script(id)
         except Exception as e:
-            self.__renew_session()
             logging.warning("called " + uri + " got " + str(e))
 
-    def __renew_session(self):
-        logging.info("renew session")
-        try:
-            self.__session.close()
-        except Exception as e:
-            logging.warning(str(e))
-        self.__session = Session()
+    async def start_scripts(self, ids: List[int]):
+        for id in ids:
+            await self.enable_script(id)
+        await asyncio.gather(*[self.__start_script(id) for id in ids])
+
+    async def __start_script(self, id: int):
+        resp = await self.__get(self.addr + '/rpc/Script.Start?id=' + str(id))
+        if resp.code == 200:
+            logging.info("shelly script " + str(id) + " (re)started")
+        else:
+            logging.debug("could not (re)start shelly script " + str(id) + " " + self.__text(resp))
+
+
+_shared_loop = None
+_shared_loop_lock = Lock()
+
+
+def shared_event_loop() -> asyncio.AbstractEventLoop:
+    # one event loop thread serves the device calls of all Shelly3Pro instances of the process
+    global _shared_loop
+    with _shared_loop_lock:
+        if _shared_loop is None:
+            _shared_loop = asyncio.new_event_loop()
+            Thread(target=_shared_loop.run_forever, name="shelly loop", daemon=True).start()
+        return _shared_loop
+
+
+class Shelly3Pro:
+    # blocking facade of AsyncShelly3Pro. All calls of all threads are performed on one shared event loop,
+    # sharing the bounded connection pool of the async client. A failed call does not affect calls in flight
+
+    def __init__(self, addr: str, max_connections: int = AsyncShelly3Pro.MAX_CONNECTIONS, timeout_sec: int = AsyncShelly3Pro.TIMEOUT_SEC):
+        self.addr = addr
+        self.async_shelly = AsyncShelly3Pro(addr, max_connections, timeout_sec)
+        self.__loop = shared_event_loop()
+
+    def __call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.__loop).result()
+
+    @property
+    def breaker_state(self) -> str:
+        return self.async_shelly.breaker.state
+
+    def set_breaker_listener(self, listener):
+        self.async_shelly.breaker.set_listener(listener)
+
+    def query(self, id: int) -> bool:
+        return self.__call(self.async_shelly.query(id))
+
+    def query_all(self) -> Dict[int, SwitchStatus]:
+        return self.__call(self.async_shelly.query_all())
+
+    def switch(self, id: int, on: bool):
+        self.__call(self.async_shelly.switch(id, on))
+
+    def switch_all(self, states: Dict[int, bool]) -> Dict[int, Optional[Exception]]:
+        # switches several switches concurrently. Returns the error per switch, if failed
+        async def switch_all():
+            return await asyncio.gather(*[self.async_shelly.switch(id, on) for id, on in states.items()], return_exceptions=True)
+        results = self.__call(switch_all())
+        return {id: (result if isinstance(result, Exception) else None) for id, result in zip(states.keys(), results)}
+
+    def deploy_scripts_async(self, scripts: Dict[int, Tuple[str, str]]) -> Future:
+        # deploys the scripts on the shared event loop without waiting for the result (see AsyncShelly3Pro.deploy_scripts)
+        return asyncio.run_coroutine_threadsafe(self.async_shelly.deploy_scripts(scripts), self.__loop)
 
 
+def query_all_async(shelly: Shelly3Pro, timeout_sec: float = None) -> Future:
+    # queries the switch states on the shared event loop without waiting for the result
+    return asyncio.run_coroutine_threadsafe(shelly.async_shelly.query_all(timeout_sec), shared_event_loop())
@@ -0,0 +1,249 @@
+import re
+import sys
+import json
+import random
+import asyncio
+import logging
+from threading import Thread, Lock
+from time import monotonic, sleep
+from typing import Dict, Any, Optional
+from collections import Counter
+import tornado.web
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+
+
+class SimulatedSwitch:
+
+    def __init__(self, id: int, power_watt: float):
+        self.id = id
+        self.power_watt = power_watt
+        self.output = False
+        self.energy_wh = 0.0
+        self.__last_update = monotonic()
+        self.auto_off_handle: Optional[asyncio.TimerHandle] = None
+
+    def update_energy(self):
+        now = monotonic()
+        if self.output:
+            self.energy_wh += self.power_watt * (now - self.__last_update) / (60*60)
+        self.__last_update = now
+
+    def status(self) -> Dict[str, Any]:
+        self.update_energy()
+        return {"id": self.id,
+                "source": "simulator",
+                "output": self.output,
+                "apower": self.power_watt if self.output else 0.0,
+                "aenergy": {"total": round(self.energy_wh, 3)}}
+
+
+class ShellySimulator:
+    # local stand-in of a Shelly Pro 3 serving the /rpc/Switch.*, /rpc/Shelly.GetStatus and /rpc/Script.* endpoints used by
+    # Shelly3Pro. The latency and the error rate of the responses are configurable. The behaviour of an uploaded and running
+    # script (see SHELLY_SCRIPT_TEMPLATE) is emulated: switches are turned off after the timer of the script (or auto_off_sec,
+    # if set) and state changes are pushed to the callback of the script
+
+    def __init__(self,
+                 port: int = 0,
+                 num_switches: int = 3,
+                 power_watt: float = 500,
+                 latency_sec: float = 0,
+                 latency_jitter_sec: float = 0,
+                 error_rate: float = 0,
+                 auto_off_sec: float = None):
+        self.port = port
+        self.latency_sec = latency_sec
+        self.latency_jitter_sec = latency_jitter_sec
+        self.error_rate = error_rate                  # share of requests answered by 503
+        self.auto_off_sec = auto_off_sec              # overrides the timer of the script, e.g. to shorten benchmarks
+        self.switches = {id: SimulatedSwitch(id, power_watt) for id in range(0, num_switches)}
+        self.scripts: Dict[int, Dict[str, Any]] = {}
+        self.requests = Counter()                     # rpc method -> number of requests
+        self.errors = 0
+        self.__lock = Lock()
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__server: Optional[HTTPServer] = None
+
+    @property
+    def addr(self) -> str:
+        return "http://127.0.0.1:" + str(self.port)
+
+    @property
+    def total_requests(self) -> int:
+        with self.__lock:
+            return sum(self.requests.values())
+
+    @property
+    def outputs(self) -> Dict[int, bool]:
+        return {id: switch.output for id, switch in self.switches.items()}
+
+    def start(self):
+        sockets = bind_sockets(self.port, "127.0.0.1")
+        self.port = sockets[0].getsockname()[1]
+        self.__loop = asyncio.new_event_loop()
+        started = Lock()
+        started.acquire()
+
+        def run():
+            asyncio.set_event_loop(self.__loop)
+            app = tornado.web.Application([(r'/rpc/([A-Za-z.]+)', RpcHandler, dict(simulator=self))], log_function=lambda handler: None)
+            self.__server = HTTPServer(app)
+            self.__server.add_sockets(sockets)
+            started.release()
+            self.__loop.run_forever()
+
+        Thread(target=run, name="shelly simulator", daemon=True).start()
+        started.acquire()
+        logging.info("shelly simulator listening on " + self.addr)
+
+    def stop(self):
+        if self.__loop is not None:
+            self.__loop.call_soon_threadsafe(self.__server.stop)
+            self.__loop.call_soon_threadsafe(self.__loop.stop)
+
+    async def handle(self, method: str, params: Dict[str, Any]):
+        # returns (http status, response)
+        with self.__lock:
+            self.requests[method] += 1
+        delay = self.latency_sec + random.uniform(0, self.latency_jitter_sec)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.error_rate > 0 and random.random() < self.error_rate:
+            self.errors += 1
+            return 503, {"code": -1, "message": "simulated error"}
+        handler = getattr(self, "_rpc_" + method.replace(".", "_"), None)
+        if handler is None:
+            return 404, {"code": 404, "message": "No handler for " + method}
+        try:
+            return 200, handler(params)
+        except KeyError as e:
+            return 500, {"code": -105, "message": "Argument " + str(e) + " not found!"}
+
+    def _rpc_Shelly_GetStatus(self, params):
+        return {"switch:" + str(id): switch.status() for id, switch in self.switches.items()}
+
+    def _rpc_Switch_GetStatus(self, params):
+        return self.switches[int(params['id'])].status()
+
+    def _rpc_Switch_Set(self, params):
+        switch = self.switches[int(params['id'])]
+        on = params['on'] in [True, 'true']
+        was_on = switch.output
+        self.__set_output(switch, on)
+        return {"was_on": was_on}
+
+    def __set_output(self, switch: SimulatedSwitch, on: bool):
+        switch.update_energy()
+        if switch.output == on:
+            return
+        switch.output = on
+        script = self.__running_script_of(switch.id)
+        if switch.auto_off_handle is not None:
+            switch.auto_off_handle.cancel()
+            switch.auto_off_handle = None
+        if script is not None:
+            # emulates the status handler of the script: auto-off timer and push of the change
+            if on:
+                auto_off_sec = script['auto_off_sec'] if self.auto_off_sec is None else self.auto_off_sec
+                if auto_off_sec is not None:
+                    switch.auto_off_handle = self.__loop.call_later(auto_off_sec, self.__set_output, switch, False)
+            if script['callback'] is not None:
+                self.__loop.create_task(self.__push(script['callback'] + "?id=" + str(switch.id) + "&on=" + ("true" if on else "false")))
+
+    def __running_script_of(self, switch_id: int) -> Optional[Dict[str, Any]]:
+        for script in self.scripts.values():
+            if script['running'] and script['switch_id'] == switch_id:
+                return script
+        return None
+
+    async def __push(self, uri: str):
+        try:
+            await AsyncHTTPClient().fetch(uri, request_timeout=5)
+        except Exception as e:
+            logging.warning("simulator could not push " + uri + " " + str(e))
+
+    def _rpc_Script_List(self, params):
+        return {"scripts": [{"id": script['id'], "name": script['name'], "enable": script['enable'], "running": script['running']}
+                            for script in self.scripts.values()]}
+
+    def _rpc_Script_GetStatus(self, params):
+        script = self.scripts[int(params['id'])]
+        return {"id": script['id'], "running": script['running']}
+
+    def _rpc_Script_Create(self, params):
+        id = int(params.get('id', max(list(self.scripts.keys()) + [0]) + 1))
+        self.scripts[id] = {"id": id, "name": params.get('name', ""), "enable": False, "running": False, "code": "",
+                            "switch_id": None, "auto_off_sec": None, "callback": None}
+        return {"id": id}
+
+    def _rpc_Script_PutCode(self, params):
+        script = self.scripts[int(params['id'])]
+        script['code'] = (script['code'] if params.get('append', False) else "") + params['code']
+        # the parts of the rendered SHELLY_SCRIPT_TEMPLATE emulated by the simulator
+        switch_id = re.search(r'"switch:(\d+)"', script['code'])
+        timer = re.search(r'Timer\.set\((\d+)', script['code'])
+        callback = re.search(r'"url": "([^"?]+)\?id=', script['code'].replace("'url'", '"url"'))
+        script['switch_id'] = None if switch_id is None else int(switch_id.group(1))
+        script['auto_off_sec'] = None if timer is None else int(timer.group(1)) / 1000
+        script['callback'] = None if callback is None else callback.group(1)
+        return {"len": len(script['code'])}
+
+    def _rpc_Script_SetConfig(self, params):
+        script = self.scripts[int(params['id'])]
+        config = params['config']
+        config = json.loads(config) if isinstance(config, str) else config
+        for key in ['name', 'enable']:
+            if key in config:
+                script[key] = config[key]
+        return {"restart_required": False}
+
+    def _rpc_Script_Start(self, params):
+        script = self.scripts[int(params['id'])]
+        was_running = script['running']
+        script['running'] = True
+        return {"was_running": was_running}
+
+    def _rpc_Script_Stop(self, params):
+        script = self.scripts[int(params['id'])]
+        was_running = script['running']
+        script['running'] = False
+        return {"was_running": was_running}
+
+
+class RpcHandler(tornado.web.RequestHandler):
+
+    def initialize(self, simulator: ShellySimulator):
+        self.simulator = simulator
+
+    async def get(self, method: str):
+        await self.__handle(method, {name: self.get_argument(name) for name in self.request.arguments.keys()})
+
+    async def post(self, method: str):
+        try:
+            params = json.loads(self.request.body) if len(self.request.body) > 0 else {}
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        await self.__handle(method, params)
+
+    async def __handle(self, method: str, params: Dict[str, Any]):
+        status, response = await self.simulator.handle(method, params)
+        self.set_status(status)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(response))
+
+
+if __name__ == '__main__':
+    # e.g. python shelly_simulator.py 8080 0.05 0.01 (port, latency sec, error rate)
+    logging.basicConfig(format='%(asctime)s %(name)-20s: %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
+    simulator = ShellySimulator(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8080,
+                                latency_sec=float(sys.argv[2]) if len(sys.argv) > 2 else 0,
+                                error_rate=float(sys.argv[3]) if len(sys.argv) > 3 else 0)
+    simulator.start()
+    try:
+        while True:
+            sleep(60)
+            logging.info(str(simulator.total_requests) + " requests " + str(dict(simulator.requests)))
+    except KeyboardInterrupt:
+        simulator.stop()
@@ -0,0 +1,138 @@
+import os
+import sys
+import json
+import mmap
+import fcntl
+import struct
+from datetime import datetime
+from time import sleep
+from typing import Dict, Any, Optional
+
+
+class StateSegment:
+    # fixed-layout record of the heater state in a memory-mapped file, to be read by co-located processes without
+    # requesting the webthing server (see StateSegmentReader). The record is protected by a sequence lock: the writer
+    # sets the sequence number to an odd value, updates the record and sets it to the next even value. A reader copies
+    # the record and accepts the copy only, if the sequence number has been even and unchanged meanwhile.
+    # Placing the file on a tmpfs (e.g. /dev/shm) keeps the page cache from being written back to disk.
+    # The writer holds an exclusive flock on the file, so that a second writer of the same file fails instead of clobbering the record
+
+    MAGIC = b"HTRS"
+    LAYOUT_VERSION = 1
+    MAX_HEATING_RODS = 32
+    HEADER = struct.Struct('<4sHHQ')          # magic, layout version, max heating rods, sequence number
+    SEQUENCE_OFFSET = 8
+    SEQUENCE = struct.Struct('<Q')
+    # version, time (epoch secs), power (watt), heating rod power (watt), heating rods, heating rods active, target heating rods active,
+    # consumption today (watt hours), consumption current year (watt hours), device connection, startup state, state per rod (1=activated, 0=deactivated)
+    RECORD = struct.Struct('<QdiIHHHxxqq24s24s' + str(MAX_HEATING_RODS) + 's')
+    SIZE = HEADER.size + RECORD.size
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        directory = os.path.dirname(filename)
+        if directory != "" and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.__fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self.__fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self.__fd)
+            raise ValueError(filename + " is written by another heater (configure a dedicated state file per heater)")
+        if os.fstat(self.__fd).st_size != self.SIZE:
+            os.ftruncate(self.__fd, self.SIZE)
+        self.__mmap = mmap.mmap(self.__fd, self.SIZE, access=mmap.ACCESS_WRITE)
+        sequence = self.SEQUENCE.unpack_from(self.__mmap, self.SEQUENCE_OFFSET)[0]
+        # an odd sequence number is left by a writer, which has been terminated while writing
+        self.__sequence = sequence + (sequence % 2)
+        self.HEADER.pack_into(self.__mmap, 0, self.MAGIC, self.LAYOUT_VERSION, self.MAX_HEATING_RODS, self.__sequence)
+
+    def write(self, snapshot):
+        # snapshot: HeaterSnapshot. Must not be called concurrently (the heater writes under its lock)
+        if self.__mmap is None:
+            return
+        rods = bytearray(self.MAX_HEATING_RODS)
+        for id, is_activated in snapshot.heating_rods_activated.items():
+            if id < self.MAX_HEATING_RODS:
+                rods[id] = 1 if is_activated else 0
+        record = self.RECORD.pack(snapshot.version,
+                                  snapshot.time.timestamp(),
+                                  snapshot.power,
+                                  snapshot.heating_rod_power,
+                                  snapshot.heating_rods,
+                                  snapshot.heating_rods_active,
+                                  snapshot.target_heating_rods_active,
+                                  snapshot.heater_consumption_today,
+                                  snapshot.heater_consumption_current_year,
+                                  snapshot.device_connection.encode("ascii")[:24],
+                                  snapshot.startup_state.encode("ascii")[:24],
+                                  bytes(rods))
+        self.SEQUENCE.pack_into(self.__mmap, self.SEQUENCE_OFFSET, self.__sequence + 1)
+        self.__mmap[self.HEADER.size:self.SIZE] = record
+        self.__sequence += 2
+        self.SEQUENCE.pack_into(self.__mmap, self.SEQUENCE_OFFSET, self.__sequence)
+
+    def close(self):
+        # the file is kept. Readers detect a stopped heater by the time of the record, which is updated on each sync
+        if self.__mmap is not None:
+            self.__mmap.close()
+            self.__mmap = None
+            os.close(self.__fd)      # releases the lock
+
+
+class StateSegmentReader:
+    # reads the state record written by StateSegment. Once mapped, a read does not require any syscall
+
+    MAX_SPINS = 100000
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        with open(filename, "rb") as file:
+            self.__mmap = mmap.mmap(file.fileno(), StateSegment.SIZE, access=mmap.ACCESS_READ)
+        magic, layout_version, max_heating_rods, _ = StateSegment.HEADER.unpack_from(self.__mmap, 0)
+        if magic != StateSegment.MAGIC or layout_version != StateSegment.LAYOUT_VERSION or max_heating_rods != StateSegment.MAX_HEATING_RODS:
+            self.__mmap.close()
+            raise ValueError(filename + " is not a heater state segment of layout version " + str(StateSegment.LAYOUT_VERSION))
+
+    @property
+    def sequence(self) -> int:
+        # changes on each write, i.e. on each sync of the heater. Changes of the state are indicated by the version
+        return StateSegment.SEQUENCE.unpack_from(self.__mmap, StateSegment.SEQUENCE_OFFSET)[0]
+
+    def read(self) -> Optional[Dict[str, Any]]:
+        # returns the state (the fields of HeaterSnapshot stored in the record), or None if no state has been written yet
+        for spin in range(0, self.MAX_SPINS):
+            sequence = StateSegment.SEQUENCE.unpack_from(self.__mmap, StateSegment.SEQUENCE_OFFSET)[0]
+            if sequence % 2 == 0:
+                record = StateSegment.RECORD.unpack_from(self.__mmap, StateSegment.HEADER.size)
+                if sequence == StateSegment.SEQUENCE.unpack_from(self.__mmap, StateSegment.SEQUENCE_OFFSET)[0]:
+                    return None if sequence == 0 else self.__to_dict(record)
+            if spin > 100:
+                sleep(0)      # the writer may have been preempted while writing
+        raise TimeoutError("could not read a consistent state of " + self.filename + " (writer terminated while writing?)")
+
+    @staticmethod
+    def __to_dict(record) -> Dict[str, Any]:
+        (version, time, power, heating_rod_power, heating_rods, heating_rods_active, target_heating_rods_active,
+         consumption_today, consumption_current_year, device_connection, startup_state, rods) = record
+        return {"version": version,
+                "time": datetime.fromtimestamp(time).isoformat(),
+                "power": power,
+                "heating_rod_power": heating_rod_power,
+                "heating_rods": heating_rods,
+                "heating_rods_active": heating_rods_active,
+                "target_heating_rods_active": target_heating_rods_active,
+                "heating_rods_activated": {id: rods[id] == 1 for id in range(0, min(heating_rods, StateSegment.MAX_HEATING_RODS))},
+                "heater_consumption_today": consumption_today,
+                "heater_consumption_current_year": consumption_current_year,
+                "device_connection": device_connection.rstrip(b"\x00").decode("ascii"),
+                "startup_state": startup_state.rstrip(b"\x00").decode("ascii")}
+
+    def close(self):
+        self.__mmap.close()
+
+
+if __name__ == '__main__':
+    # e.g. python state_segment.py /dev/shm/heater_state.bin
+    reader = StateSegmentReader(sys.argv[1])
+    print(json.dumps(reader.read(), indent=2))
@@ -0,0 +1,225 @@
+import json
+import logging
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor
+from datetime import timedelta
+from threading import Lock
+from typing import Callable, Optional
+from tornado.httpclient import AsyncHTTPClient
+from tornado.websocket import websocket_connect
+from heater import Heater
+from scheduler import Scheduler, Job
+from shelly import shared_event_loop
+from clock import Clock, SYSTEM_CLOCK
+
+
+class SurplusSource:
+    # feed of the pv surplus (watt exported to the grid). Calls the listener on each new value
+
+    def __init__(self):
+        self._listener: Callable[[float], None] = lambda surplus: None
+
+    def start(self, listener: Callable[[float], None]):
+        self._listener = listener
+
+    def stop(self):
+        pass
+
+
+class StubSurplusSource(SurplusSource):
+    # e.g. for local tests. The surplus is set by calling set_surplus
+
+    def set_surplus(self, surplus: float):
+        self._listener(surplus)
+
+
+class WebthingSurplusSource(SurplusSource):
+    # subscribes a property of a webthing via websocket, e.g. ws://10.1.1.22:8080/0#surplus
+
+    RECONNECT_DELAY_SEC = 5
+
+    def __init__(self, uri: str, property_name: str, invert: bool = False):
+        super().__init__()
+        self.uri = uri
+        self.property_name = property_name
+        self.invert = invert   # True, if the property reports the grid power (import positive)
+        self.__is_running = False
+
+    def start(self, listener: Callable[[float], None]):
+        super().start(listener)
+        self.__is_running = True
+        asyncio.run_coroutine_threadsafe(self.__listen(), shared_event_loop())
+
+    def stop(self):
+        self.__is_running = False
+
+    async def __listen(self):
+        while self.__is_running:
+            try:
+                connection = await websocket_connect(self.uri)
+                logging.info("surplus source connected to " + self.uri)
+                while self.__is_running:
+                    message = await connection.read_message()
+                    if message is None:
+                        break
+                    msg = json.loads(message)
+                    if msg.get('messageType') == 'propertyStatus' and self.property_name in msg.get('data', {}):
+                        value = float(msg['data'][self.property_name])
+                        self._listener(-value if self.invert else value)
+                connection.close()
+            except Exception as e:
+                logging.warning("surplus source " + self.uri + " error " + str(e))
+            if self.__is_running:
+                await asyncio.sleep(self.RECONNECT_DELAY_SEC)
+
+
+class HttpSurplusSource(SurplusSource):
+    # polls a json endpoint, e.g. http://10.1.1.22:8080/0/properties/surplus#surplus
+
+    def __init__(self, uri: str, field: str, invert: bool = False, period_sec: float = 1):
+        super().__init__()
+        self.uri = uri
+        self.field = field
+        self.invert = invert
+        self.period_sec = period_sec
+        self.__is_running = False
+
+    def start(self, listener: Callable[[float], None]):
+        super().start(listener)
+        self.__is_running = True
+        asyncio.run_coroutine_threadsafe(self.__poll(), shared_event_loop())
+
+    def stop(self):
+        self.__is_running = False
+
+    async def __poll(self):
+        client = AsyncHTTPClient(force_instance=True, max_clients=1)
+        while self.__is_running:
+            try:
+                resp = await client.fetch(self.uri, request_timeout=max(1.0, self.period_sec * 2))
+                value = float(json.loads(resp.body)[self.field])
+                self._listener(-value if self.invert else value)
+            except Exception as e:
+                logging.warning("surplus source " + self.uri + " error " + str(e))
+            await asyncio.sleep(self.period_sec)
+
+
+def create_surplus_source(spec: str) -> SurplusSource:
+    # <uri>#<property>, e.g. ws://10.1.1.22:8080/0#surplus or http://10.1.1.22:8080/0/properties/surplus#surplus
+    # a leading - inverts the value, e.g. -ws://10.1.1.22:8080/0#grid_power
+    invert = spec.startswith("-")
+    uri, name = spec.lstrip("-").rsplit("#", 1)
+    if uri.startswith("ws://") or uri.startswith("wss://"):
+        return WebthingSurplusSource(uri, name, invert)
+    else:
+        return HttpSurplusSource(uri, name, invert)
+
+
+class SurplusController:
+    # sets the number of active rods according to the pv surplus. To avoid flapping, a hysteresis
+    # as well as a min on time (before decreasing) and a min off time (before increasing) are applied.
+    # The surplus feed reflects a command only after a while. Until then, the power of a just switched rod would
+    # be counted twice (as consumed by the heater and as surplus). So, after each command the controller waits for
+    # settle_sec, ignores the samples taken before the command plus feed_latency_sec and increases at most each increase_interval_sec
+
+    def __init__(self,
+                 heater: Heater,
+                 source: SurplusSource,
+                 scheduler: Scheduler,
+                 hysteresis_watt: int = 100,
+                 min_on_sec: int = 60,
+                 min_off_sec: int = 60,
+                 settle_sec: int = 15,
+                 feed_latency_sec: int = 5,
+                 increase_interval_sec: int = 60,
+                 executor: Executor = None,
+                 clock: Clock = SYSTEM_CLOCK):
+        self.__clock = clock
+        self.heater = heater
+        self.source = source
+        self.hysteresis_watt = hysteresis_watt
+        self.min_on_sec = min_on_sec
+        self.min_off_sec = min_off_sec
+        self.settle_sec = settle_sec
+        self.feed_latency_sec = feed_latency_sec
+        self.increase_interval_sec = increase_interval_sec
+        self.surplus: Optional[float] = None
+        self.last_time_updated = self.__clock.now() - timedelta(days=1)
+        self.__scheduler = scheduler
+        self.__recheck_job: Optional[Job] = None
+        self.__recheck_job_name = ("" if heater.name is None else heater.name + " ") + "surplus recheck"     # the heaters of a fleet share a scheduler
+        self.__last_time_increased = self.__clock.now() - timedelta(days=1)
+        self.__last_time_decreased = self.__clock.now() - timedelta(days=1)
+        self.__last_time_commanded = self.__clock.now() - timedelta(days=1)
+        self.__lock = Lock()
+        # the device commands are blocking. They must not be executed on the event loop of the source
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="surplus controller") if executor is None else executor
+
+    def start(self):
+        self.source.start(self.on_surplus)
+
+    def stop(self):
+        self.source.stop()
+        if self.__recheck_job is not None:
+            self.__recheck_job.cancel()
+        self.__executor.shutdown(wait=False)
+
+    def on_surplus(self, surplus: float):
+        with self.__lock:
+            self.surplus = surplus
+            self.last_time_updated = self.__clock.now()
+        self.__executor.submit(self.__control)
+
+    def target_heating_rods(self, surplus: float, active: int) -> int:
+        # the power currently consumed by the heater is available as well. The surplus must reflect the current
+        # state of the heater (see __control)
+        available = surplus + self.heater.power
+        rod_power = self.heater.HEATER_ROD_POWER
+        up = int((available - self.hysteresis_watt) // rod_power)
+        down = int((available + self.hysteresis_watt) // rod_power)
+        if up > active:
+            target = up
+        elif down < active:
+            target = down
+        else:
+            target = active
+        return max(0, min(self.heater.heating_rods, target))
+
+    def __control(self):
+        try:
+            with self.__lock:
+                surplus, sample_time = self.surplus, self.last_time_updated
+            if surplus is None:
+                return
+            if sample_time < self.__last_time_commanded + timedelta(seconds=self.feed_latency_sec):
+                # the sample does not reflect the last command yet. The next one is awaited
+                return
+            active = self.heater.heating_rods_active
+            target = self.target_heating_rods(surplus, active)
+            if target == active:
+                return
+            now = self.__clock.now()
+            wait_until = self.__last_time_commanded + timedelta(seconds=self.settle_sec)
+            if target > active:
+                wait_until = max(wait_until,
+                                 self.__last_time_decreased + timedelta(seconds=self.min_off_sec),
+                                 self.__last_time_increased + timedelta(seconds=self.increase_interval_sec))
+            else:
+                wait_until = max(wait_until, self.__last_time_increased + timedelta(seconds=self.min_on_sec))
+            if now < wait_until:
+                # re-evaluated with the latest surplus, when the settle and min on/off times are passed
+                delay_sec = (wait_until - now).total_seconds()
+                if self.__recheck_job is None or self.__recheck_job.is_cancelled or self.__recheck_job.runs > 0:
+                    self.__recheck_job = self.__scheduler.once(self.__recheck_job_name, lambda: self.__executor.submit(self.__control), delay_sec=delay_sec)
+                else:
+                    # the newer sample may allow an earlier re-evaluation. A later one is left to the pending recheck, which reschedules itself
+                    self.__scheduler.reschedule(self.__recheck_job, delay_sec)
+                return
+            if target > active:
+                self.__last_time_increased = now
+            else:
+                self.__last_time_decreased = now
+            self.__last_time_commanded = now
+            self.heater.set_heating_rods_active(target, reason="due to pv surplus " + str(int(surplus)) + " W")
+        except Exception as e:
+            logging.warning("error occurred on surplus control " + str(e))
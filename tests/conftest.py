@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of the heater are located in the parent directory (flat layout)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,76 @@
+import random
+from activity import ActivityLog
+
+
+START = 1_700_000_000
+
+
+def reference_active_secs(transitions, window_secs: int, now: int) -> int:
+    # transitions: (time, is_active) in time order, starting inactive
+    start = now - min(window_secs, ActivityLog.SECONDS)
+    active_secs, is_active, since = 0, False, START
+    for time, state in transitions + [(now, None)]:
+        if is_active:
+            active_secs += max(0, min(time, now) - max(since, start))
+        if state is not None:
+            is_active, since = state, time
+    return active_secs
+
+
+def test_no_activity():
+    log = ActivityLog(START)
+    assert not log.is_active
+    assert log.active_secs(60, START + 1000) == 0
+
+
+def test_ongoing_activity_is_counted_until_now():
+    log = ActivityLog(START)
+    log.set_active(True, START + 100)
+    assert log.is_active
+    assert log.active_secs(60, START + 130) == 30
+    assert log.active_secs(60, START + 1000) == 60
+    assert log.active_secs(10 * 60 * 60, START + 1000) == 900
+
+
+def test_windows_within_blocks():
+    log = ActivityLog(START)
+    log.set_active(True, START + 3)
+    log.set_active(False, START + 5)
+    log.set_active(True, START + 70)
+    log.set_active(False, START + 200)
+    assert log.active_secs(1, START + 4) == 1
+    assert log.active_secs(200, START + 200) == 132
+    assert log.active_secs(131, START + 200) == 130
+    assert log.active_secs(100, START + 300) == 0
+
+
+def test_window_is_limited_to_a_day():
+    log = ActivityLog(START)
+    log.set_active(True, START)
+    log.set_active(False, START + 2 * ActivityLog.SECONDS)
+    now = START + 2 * ActivityLog.SECONDS
+    assert log.active_secs(3 * ActivityLog.SECONDS, now) == ActivityLog.SECONDS
+    assert log.active_secs(60, now + 30) == 30
+
+
+def test_prefix_sums_match_a_reference_over_several_days():
+    rnd = random.Random(7)
+    log = ActivityLog(START)
+    transitions, time, is_active = [], START, False
+    while time < START + 3 * ActivityLog.SECONDS:
+        time += rnd.choice([1, 7, 63, 64, 65, 200, 3600, 5 * 3600])
+        is_active = not is_active
+        log.set_active(is_active, time)
+        transitions.append((time, is_active))
+        for window_secs in [1, 59, 64, 900, 3600, 6 * 3600, ActivityLog.SECONDS]:
+            now = time + rnd.randint(0, 100)
+            assert log.active_secs(window_secs, now) == reference_active_secs(transitions, window_secs, now), (window_secs, now)
+
+
+def test_repeated_state_is_ignored():
+    log = ActivityLog(START)
+    log.set_active(True, START + 10)
+    log.set_active(True, START + 20)
+    log.set_active(False, START + 30)
+    log.set_active(False, START + 40)
+    assert log.active_secs(100, START + 100) == 20
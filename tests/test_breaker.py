@@ -0,0 +1,99 @@
+import pytest
+import breaker
+from breaker import CircuitBreaker, CircuitOpenError
+
+
+class FakeMonotonic:
+
+    def __init__(self):
+        self.time = 1000.0
+
+    def __call__(self) -> float:
+        return self.time
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeMonotonic()
+    monkeypatch.setattr(breaker, "monotonic", fake)
+    monkeypatch.setattr(breaker, "uniform", lambda low, high: high)     # no jitter
+    return fake
+
+
+def test_opens_after_consecutive_failures(clock):
+    changes = []
+    circuit = CircuitBreaker("test", failure_threshold=2, backoff_sec=2)
+    circuit.set_listener(lambda: changes.append(circuit.state))
+    circuit.before_call()
+    assert not circuit.on_failure()
+    assert circuit.state == CircuitBreaker.CLOSED
+    circuit.before_call()
+    assert circuit.on_failure()
+    assert circuit.state == CircuitBreaker.OPEN
+    assert changes == [CircuitBreaker.OPEN]
+    with pytest.raises(CircuitOpenError):
+        circuit.before_call()
+
+
+def test_success_resets_the_failure_count(clock):
+    circuit = CircuitBreaker("test", failure_threshold=2)
+    circuit.on_failure()
+    circuit.on_success()
+    assert not circuit.on_failure()
+    assert circuit.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_lets_a_single_trial_through(clock):
+    circuit = CircuitBreaker("test", failure_threshold=1, backoff_sec=2)
+    circuit.on_failure()
+    clock.time += 1.9
+    assert circuit.state == CircuitBreaker.OPEN
+    clock.time += 0.1
+    assert circuit.state == CircuitBreaker.HALF_OPEN
+    circuit.before_call()
+    with pytest.raises(CircuitOpenError):
+        circuit.before_call()
+
+
+def test_successful_trial_closes_the_circuit(clock):
+    changes = []
+    circuit = CircuitBreaker("test", failure_threshold=1, backoff_sec=2)
+    circuit.set_listener(lambda: changes.append(circuit.state))
+    circuit.on_failure()
+    clock.time += 2
+    circuit.before_call()
+    circuit.on_success()
+    assert circuit.state == CircuitBreaker.CLOSED
+    assert changes == [CircuitBreaker.OPEN, CircuitBreaker.CLOSED]
+    circuit.before_call()
+    circuit.before_call()
+
+
+def test_failed_trial_reopens_with_increased_backoff(clock):
+    circuit = CircuitBreaker("test", failure_threshold=1, backoff_sec=2, max_backoff_sec=5)
+    circuit.on_failure()
+    clock.time += 2
+    circuit.before_call()
+    circuit.on_failure()
+    assert circuit.state == CircuitBreaker.OPEN
+    clock.time += 3.9
+    assert circuit.state == CircuitBreaker.OPEN
+    clock.time += 0.1
+    circuit.before_call()
+    circuit.on_failure()
+    clock.time += 4.9      # capped by max_backoff_sec
+    assert circuit.state == CircuitBreaker.OPEN
+    clock.time += 0.1
+    assert circuit.state == CircuitBreaker.HALF_OPEN
+
+
+def test_backoff_is_reset_after_closing(clock):
+    circuit = CircuitBreaker("test", failure_threshold=1, backoff_sec=2)
+    for _ in range(0, 3):
+        circuit.on_failure()
+        clock.time += 100
+        circuit.before_call()
+    circuit.on_success()
+    circuit.on_failure()
+    clock.time += 2
+    assert circuit.state == CircuitBreaker.HALF_OPEN
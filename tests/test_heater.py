@@ -0,0 +1,114 @@
+import json
+from datetime import datetime, timedelta
+from typing import Dict
+from clock import VirtualClock
+from heater import Heater
+from replay import VirtualShelly3Pro
+from scheduler import Scheduler
+
+
+START = datetime(2025, 6, 1, 8, 0)
+
+
+def started_heater(tmp_path, shelly_class=VirtualShelly3Pro, **kwargs):
+    clock = VirtualClock(START)
+    scheduler = Scheduler("test scheduler", clock)
+    shelly = shelly_class(clock, 3)
+    heater = Heater("test", str(tmp_path), num_heating_rods=3, scheduler=scheduler, shelly=shelly, clock=clock,
+                    state_file=str(tmp_path / "heater_state.bin"), **kwargs)
+    heater.start()
+    scheduler.run_until(clock.time())
+    assert heater.is_history_loaded
+    return heater, shelly, clock, scheduler
+
+
+def sessions(heater: Heater, clock: VirtualClock):
+    chunks = heater.export_history(START - timedelta(days=1), clock.now() + timedelta(days=1), kind="sessions")
+    return [json.loads(line) for line in b"".join(chunks).decode().splitlines()]
+
+
+def test_outdated_observation_does_not_revert_the_desired_state(tmp_path):
+    heater, shelly, clock, scheduler = started_heater(tmp_path)
+    try:
+        observed_at = clock.monotonic()
+        outdated = shelly.query_all()      # all rods off
+        clock.advance_to(clock.time() + 1)
+        heater.set_heating_rods_active(2)
+        assert heater.heating_rods_active == 2
+        commands = shelly.commands
+        active = [id for id, output in shelly.outputs.items() if output]
+
+        heater.apply_switch_states(outdated, observed_at)
+        heater.on_switch_event(active[0], False, observed_at)
+        assert heater.heating_rods_active == 2
+        assert shelly.commands == commands
+        scheduler.run_until(clock.time() + 60)      # journal commit
+        assert [session["end"] for session in sessions(heater, clock)] == [clock.now().isoformat()] * 2       # still running
+
+        # a current observation is taken over
+        heater.on_switch_event(active[0], False)
+        assert heater.heating_rods_active == 1
+    finally:
+        heater.stop()
+
+
+class InterleavingShelly(VirtualShelly3Pro):
+    # delivers an outdated observation while the switch commands are in flight
+
+    def __init__(self, clock: VirtualClock, num_switches: int):
+        super().__init__(clock, num_switches)
+        self.interleave = None
+
+    def switch_all(self, states: Dict[int, bool]):
+        if self.interleave is not None:
+            interleave, self.interleave = self.interleave, None
+            interleave()
+        return super().switch_all(states)
+
+
+def test_observation_during_a_command_in_flight_sends_no_duplicate(tmp_path):
+    heater, shelly, clock, scheduler = started_heater(tmp_path, shelly_class=InterleavingShelly)
+    try:
+        observed_at = clock.monotonic()
+        outdated = shelly.query_all()
+        shelly.interleave = lambda: heater.apply_switch_states(outdated, observed_at)
+        heater.set_heating_rods_active(3)
+        assert shelly.commands == 3
+        assert shelly.switch_ons == {0: 1, 1: 1, 2: 1}
+        assert heater.heating_rods_active == 3
+    finally:
+        heater.stop()
+
+
+def test_repeated_requests_keep_the_min_step_interval(tmp_path):
+    heater, shelly, clock, scheduler = started_heater(tmp_path, min_step_interval_sec=60)
+    try:
+        start = clock.time()
+        for offset_sec in [0, 1, 2]:
+            scheduler.run_until(start + offset_sec)
+            heater.set_heating_rods_active(3)
+        assert heater.heating_rods_active == 1
+        scheduler.run_until(start + 59)
+        assert heater.heating_rods_active == 1
+        scheduler.run_until(start + 60)
+        assert heater.heating_rods_active == 2
+        scheduler.run_until(start + 120)
+        assert heater.heating_rods_active == 3
+
+        # the next step of a new request waits for the rest of the interval, too
+        scheduler.run_until(start + 150)
+        heater.set_heating_rods_active(1)
+        assert heater.heating_rods_active == 3
+        scheduler.run_until(start + 180)
+        assert heater.heating_rods_active == 2
+        scheduler.run_until(start + 300)
+        assert heater.heating_rods_active == 1
+        assert shelly.commands == 5
+    finally:
+        heater.stop()
+
+
+def test_fresh_install_creates_no_legacy_files(tmp_path):
+    heater, shelly, clock, scheduler = started_heater(tmp_path)
+    heater.stop()
+    assert [file.name for file in tmp_path.iterdir() if file.name.startswith("heater_") and file.name.endswith(".json.gz")] == []
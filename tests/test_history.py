@@ -0,0 +1,125 @@
+import pytest
+from datetime import datetime
+from clock import VirtualClock
+from history import HeatingHistory, bucket_start, next_bucket_start, bucket_key
+
+
+def test_bucket_boundaries():
+    time = datetime(2026, 3, 4, 13, 45, 12)     # wednesday
+    assert bucket_start(time, "hour") == datetime(2026, 3, 4, 13)
+    assert bucket_start(time, "day") == datetime(2026, 3, 4)
+    assert bucket_start(time, "week") == datetime(2026, 3, 2)
+    assert bucket_start(time, "month") == datetime(2026, 3, 1)
+    assert next_bucket_start(datetime(2026, 12, 1), "month") == datetime(2027, 1, 1)
+    assert next_bucket_start(datetime(2026, 1, 31, 23), "hour") == datetime(2026, 2, 1)
+    assert bucket_key(time, "hour") == "2026-03-04T13"
+    assert bucket_key(time, "week") == "2026-03-02"
+    with pytest.raises(ValueError):
+        bucket_start(time, "year")
+
+
+def test_session_is_split_by_hour_and_rolled_up():
+    history = HeatingHistory()
+    history.add(0, datetime(2026, 3, 4, 13, 30).timestamp(), datetime(2026, 3, 4, 15, 15).timestamp())
+    assert history.heating_secs(0, "hour", datetime(2026, 3, 4, 13)) == 30 * 60
+    assert history.heating_secs(0, "hour", datetime(2026, 3, 4, 14)) == 60 * 60
+    assert history.heating_secs(0, "hour", datetime(2026, 3, 4, 15)) == 15 * 60
+    for bucket in ["day", "week", "month"]:
+        assert history.heating_secs(0, bucket, datetime(2026, 3, 4)) == 105 * 60
+    assert history.heating_secs(1, "day", datetime(2026, 3, 4)) == 0
+
+
+def test_session_crossing_midnight_is_split_by_day():
+    history = HeatingHistory()
+    history.add(0, datetime(2026, 3, 31, 23, 40).timestamp(), datetime(2026, 4, 1, 0, 10).timestamp())
+    assert history.heating_secs(0, "day", datetime(2026, 3, 31)) == 20 * 60
+    assert history.heating_secs(0, "day", datetime(2026, 4, 1)) == 10 * 60
+    assert history.heating_secs(0, "month", datetime(2026, 3, 15)) == 20 * 60
+    assert history.heating_secs(0, "week", datetime(2026, 4, 1)) == 30 * 60
+
+
+def test_imported_days_have_no_hourly_resolution():
+    history = HeatingHistory()
+    history.add_day(1, datetime(2026, 3, 4), 7200)
+    assert history.heating_secs(1, "hour", datetime(2026, 3, 4, 0)) == 0
+    assert history.heating_secs(1, "day", datetime(2026, 3, 4)) == 7200
+    assert history.heating_secs(1, "month", datetime(2026, 3, 1)) == 7200
+    assert history.rod_ids == [1]
+
+
+def test_energy_is_measured_if_available_otherwise_estimated():
+    history = HeatingHistory()
+    history.add(0, datetime(2026, 3, 4, 10).timestamp(), datetime(2026, 3, 4, 11).timestamp())
+    history.add(1, datetime(2026, 3, 4, 10).timestamp(), datetime(2026, 3, 4, 11).timestamp())
+    history.add_energy(1, datetime(2026, 3, 4, 10, 30).timestamp(), 1800)
+    assert history.energy(0, "hour", datetime(2026, 3, 4, 10), 2000) == 2000
+    assert history.energy(1, "hour", datetime(2026, 3, 4, 10), 2000) == 1800
+    assert history.energy(1, "day", datetime(2026, 3, 4), 2000) == 1800
+
+
+def test_incomplete_energy_is_estimated():
+    history = HeatingHistory()
+    history.add(0, datetime(2026, 3, 4, 10).timestamp(), datetime(2026, 3, 4, 12).timestamp())
+    history.add_energy(0, datetime(2026, 3, 4, 10, 30).timestamp(), 500, is_complete=False)
+    history.add_energy(0, datetime(2026, 3, 4, 11, 30).timestamp(), 1900)
+    assert history.energy(0, "hour", datetime(2026, 3, 4, 10), 2000) == 2000
+    assert history.energy(0, "hour", datetime(2026, 3, 4, 11), 2000) == 1900
+    assert history.energy(0, "day", datetime(2026, 3, 4), 2000) == 4000
+
+
+def test_query_reports_kwh_per_bucket():
+    history = HeatingHistory()
+    history.add(0, datetime(2026, 3, 4, 10).timestamp(), datetime(2026, 3, 4, 11).timestamp())
+    history.add(1, datetime(2026, 3, 5, 10).timestamp(), datetime(2026, 3, 5, 10, 30).timestamp())
+    result = history.query(datetime(2026, 3, 4, 8), datetime(2026, 3, 6), "day", [0, 1], 2000)
+    assert result == [{"start": "2026-03-04T00:00:00", "rods": {0: 2.0, 1: 0.0}, "total": 2.0},
+                      {"start": "2026-03-05T00:00:00", "rods": {0: 0.0, 1: 1.0}, "total": 1.0}]
+    with pytest.raises(ValueError):
+        history.query(datetime(2020, 1, 1), datetime(2026, 1, 1), "hour", [0], 2000)
+
+
+def test_rows_generate_each_bucket_and_rod():
+    history = HeatingHistory()
+    history.add(0, datetime(2026, 1, 31, 22).timestamp(), datetime(2026, 2, 1, 2).timestamp())
+    rows = list(history.rows(datetime(2026, 1, 15), datetime(2026, 3, 1), "month", [0, 1], 2000))
+    assert rows == [(0, datetime(2026, 1, 1), datetime(2026, 2, 1), 7200, 4000),
+                    (1, datetime(2026, 1, 1), datetime(2026, 2, 1), 0, 0),
+                    (0, datetime(2026, 2, 1), datetime(2026, 3, 1), 7200, 4000),
+                    (1, datetime(2026, 2, 1), datetime(2026, 3, 1), 0, 0)]
+    assert len(list(history.rows(datetime(2026, 1, 1), datetime(2027, 1, 1), "hour", [0], 2000))) == 365 * 24
+    assert list(history.rows(datetime(2026, 1, 1), datetime(2026, 1, 1), "day", [0], 2000)) == []
+
+
+def test_rows_validate_the_bucket_on_call():
+    with pytest.raises(ValueError):
+        HeatingHistory().rows(datetime(2026, 1, 1), datetime(2026, 2, 1), "year", [0], 2000)
+
+
+def test_dict_round_trip():
+    history = HeatingHistory()
+    history.add_day(2, datetime(2026, 3, 1), 600)
+    history.add(0, datetime(2026, 3, 4, 10).timestamp(), datetime(2026, 3, 4, 11).timestamp())
+    history.add_energy(0, datetime(2026, 3, 4, 10, 30).timestamp(), 100, is_complete=False)
+    restored = HeatingHistory.from_dict(history.to_dict())
+    assert restored.rod_ids == [0, 2]
+    assert restored.heating_secs(2, "month", datetime(2026, 3, 1)) == 600
+    assert restored.heating_secs(0, "week", datetime(2026, 3, 4)) == 3600
+    assert restored.energy(0, "day", datetime(2026, 3, 4), 2000) == 2000
+
+
+def test_hourly_buckets_are_dropped_after_the_retention_by_the_clock():
+    clock = VirtualClock(datetime(2025, 6, 1, 12))
+    history = HeatingHistory(clock)
+    history.add(0, datetime(2025, 1, 1, 10).timestamp(), datetime(2025, 1, 1, 11).timestamp())
+    history.add_energy(0, datetime(2025, 1, 1, 10, 30).timestamp(), 400)
+    history.add(0, datetime(2026, 1, 10, 10).timestamp(), datetime(2026, 1, 10, 11).timestamp())
+    restored = HeatingHistory.from_dict(history.to_dict(), clock)
+    assert restored.heating_secs(0, "hour", datetime(2025, 1, 1, 10)) == 3600
+    assert restored.energy(0, "hour", datetime(2025, 1, 1, 10), 2000) == 400
+
+    clock.advance_to(datetime(2025, 1, 2).timestamp() + HeatingHistory.HOURLY_RETENTION_DAYS * 24 * 60 * 60)
+    restored = HeatingHistory.from_dict(history.to_dict(), clock)
+    assert restored.heating_secs(0, "hour", datetime(2025, 1, 1, 10)) == 0
+    assert restored.energy(0, "hour", datetime(2025, 1, 1, 10), 2000) == 0
+    assert restored.heating_secs(0, "day", datetime(2025, 1, 1)) == 3600
+    assert restored.heating_secs(0, "hour", datetime(2026, 1, 10, 10)) == 3600
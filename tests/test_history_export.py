@@ -0,0 +1,51 @@
+import os
+import sys
+import subprocess
+from datetime import datetime
+from journal import TransitionJournal
+from history_export import sessions
+from shelly import SCRIPT_AUTO_OFF_SEC
+
+
+START = datetime(2026, 3, 2, 10, 0).timestamp()
+
+
+def journal_of(tmp_path, records) -> TransitionJournal:
+    journal = TransitionJournal(str(tmp_path))
+    journal.load()
+    for rod_id, is_activated, timestamp in records:
+        journal.append(rod_id, is_activated, timestamp)
+    journal.commit()
+    return journal
+
+
+def session_rows(journal: TransitionJournal, start: float, end: float, now: float):
+    return [(rod_id, on, off) for rod_id, on, off, _, _ in sessions(journal, datetime.fromtimestamp(start), datetime.fromtimestamp(end), 500, now)]
+
+
+def test_sessions_within_and_crossing_the_range(tmp_path):
+    journal = journal_of(tmp_path, [(0, True, START - 600), (0, False, START + 600),
+                                    (1, True, START + 100), (1, False, START + 200),
+                                    (2, True, START - 1200), (2, False, START - 300)])
+    assert session_rows(journal, START, START + 3600, START + 7200) == [(0, START, START + 600), (1, START + 100, START + 200)]
+
+
+def test_session_spanning_the_range_is_reported(tmp_path):
+    journal = journal_of(tmp_path, [(0, True, START - 600), (0, False, START + 1200)])
+    assert session_rows(journal, START, START + 600, START + 7200) == [(0, START, START + 600)]
+    # still running
+    journal = journal_of(tmp_path / "running", [(0, True, START - 600)])
+    assert session_rows(journal, START, START + 3600, START + 60) == [(0, START, START + 60)]
+
+
+def test_session_left_open_ends_at_the_auto_off(tmp_path):
+    journal = journal_of(tmp_path, [(0, True, START - SCRIPT_AUTO_OFF_SEC - 60), (1, True, START - 600), (0, True, START + 100), (1, True, START + 100)])
+    assert session_rows(journal, START, START + 3600, START + 7200) == [(1, START, START + 100),
+                                                                        (0, START + 100, START + 100 + SCRIPT_AUTO_OFF_SEC),
+                                                                        (1, START + 100, START + 100 + SCRIPT_AUTO_OFF_SEC)]
+
+
+def test_command_line_does_not_import_the_heater():
+    code = "import sys, history_export; sys.exit(1 if 'heater' in sys.modules else 0)"
+    directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    assert subprocess.run([sys.executable, "-c", code], cwd=directory).returncode == 0
@@ -0,0 +1,102 @@
+import pytest
+from datetime import datetime, timedelta
+from clock import VirtualClock
+from heater import Heater
+from replay import ReplayEngine, TraceEvent, VirtualShelly3Pro
+from shelly import SCRIPT_AUTO_OFF_SEC
+
+
+START = datetime(2025, 6, 1, 8, 0)
+
+
+def test_virtual_clock_advances_only_forward():
+    clock = VirtualClock(START)
+    assert clock.now() == START
+    assert clock.time() == clock.monotonic() == START.timestamp()
+    clock.advance_to(START.timestamp() + 90)
+    assert clock.now() == START + timedelta(seconds=90)
+    clock.advance_to(START.timestamp())
+    assert clock.time() == START.timestamp() + 90
+
+
+def test_virtual_shelly_emulates_the_auto_off():
+    clock = VirtualClock(START)
+    shelly = VirtualShelly3Pro(clock, 2, power_watt=2000)
+    shelly.switch(0, True)
+    clock.advance_to(START.timestamp() + 1800)
+    assert shelly.query(0)
+    assert shelly.query_all()[0].power == 2000
+    clock.advance_to(START.timestamp() + SCRIPT_AUTO_OFF_SEC + 60)
+    assert not shelly.query(0)
+    assert shelly.auto_offs[0] == 1
+    assert shelly.heating_secs[0] == SCRIPT_AUTO_OFF_SEC
+    assert shelly.energy_wh(0) == pytest.approx(2000 * SCRIPT_AUTO_OFF_SEC / 3600)
+
+
+def test_trace_is_loaded_in_time_order(tmp_path):
+    trace = tmp_path / "trace.csv"
+    trace.write_text("time,kind,value\n"
+                     "# comment\n"
+                     "2025-06-01T10:05:00,surplus,1250\n"
+                     "2025-06-01T10:00:00,rods,2\n" +
+                     str(datetime(2025, 6, 1, 10, 10).timestamp()) + ",surplus,-300\n")
+    events = TraceEvent.load(str(trace))
+    assert [(event.time, event.kind, event.value) for event in events] == [(datetime(2025, 6, 1, 10, 0), "rods", 2),
+                                                                           (datetime(2025, 6, 1, 10, 5), "surplus", 1250),
+                                                                           (datetime(2025, 6, 1, 10, 10), "surplus", -300)]
+    trace.write_text("2025-06-01T10:00:00,power,2\n")
+    with pytest.raises(ValueError):
+        TraceEvent.load(str(trace))
+
+
+def surplus_trace(watts):
+    return [TraceEvent(START + timedelta(minutes=5 * i), "surplus", watt) for i, watt in enumerate(watts)]
+
+
+def test_replay_without_surplus_keeps_the_rods_off():
+    report = ReplayEngine(surplus_trace([-500] * 24)).run()
+    assert report["energy_kwh"] == 0
+    assert report["switch_commands"] == 0
+    assert report["wear_balance"] == 1.0
+
+
+def test_replay_uses_the_surplus():
+    report = ReplayEngine(surplus_trace([-200] * 3 + [4500] * 36 + [-200] * 12)).run()
+    assert report["energy_kwh"] > 0
+    assert report["grid_energy_kwh"] < report["surplus_energy_kwh"]
+    assert report["speedup"] > 1
+    assert sum(rod["switch_ons"] for rod in report["rods"].values()) > 0
+    assert report["start"] == START.isoformat()
+
+
+def test_replay_is_deterministic():
+    events = surplus_trace([-200, 2500, 4500, 1200, 6500, 300, -400, 2100] * 6)
+    first, second = ReplayEngine(events).run(), ReplayEngine(events).run()
+    for report in [first, second]:
+        del report["wall_time_sec"]
+        del report["speedup"]
+    assert first == second
+
+
+def test_replay_of_rod_commands():
+    events = [TraceEvent(START, "rods", 3), TraceEvent(START + timedelta(hours=2), "rods", 0)]
+    report = ReplayEngine(events, auto_decrease_min=30).run()
+    heating_hours = sorted(rod["heating_hours"] for rod in report["rods"].values())
+    # one rod is switched off by the auto decrease, the others by the auto-off of the device script
+    assert heating_hours[0] == pytest.approx(0.5, abs=0.05)
+    assert heating_hours[1:] == [SCRIPT_AUTO_OFF_SEC / 3600] * 2
+    assert sum(rod["auto_offs"] for rod in report["rods"].values()) == 2
+    assert report["energy_kwh"] == pytest.approx(sum(heating_hours) * Heater.HEATER_ROD_POWER / 1000, abs=0.01)
+    assert report["grid_energy_kwh"] == report["energy_kwh"]
+
+
+def test_replay_of_a_day_is_fast():
+    events = [TraceEvent(START + timedelta(minutes=5 * i), "surplus", [-300, 800, 1700, 2600, 4200, 900][i % 6]) for i in range(24 * 12)]
+    report = ReplayEngine(events).run()
+    assert report["switch_commands"] > 50
+    assert report["wall_time_sec"] < 3      # about 1 sec. The journal is not fsynced per commit period
+
+
+def test_empty_trace_is_rejected():
+    with pytest.raises(ValueError):
+        ReplayEngine([])
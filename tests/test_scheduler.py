@@ -0,0 +1,132 @@
+from datetime import datetime
+from clock import VirtualClock
+from scheduler import Scheduler
+
+
+START = datetime(2026, 3, 4, 10, 0)
+
+
+def create() -> (VirtualClock, Scheduler):
+    clock = VirtualClock(START)
+    return clock, Scheduler("test", clock)
+
+
+def test_periodic_job_runs_at_its_interval():
+    clock, scheduler = create()
+    runs = []
+    scheduler.every("job", 10, lambda: runs.append(clock.time() - START.timestamp()), initial_delay_sec=5)
+    scheduler.run_until(START.timestamp() + 40)
+    assert runs == [5, 15, 25, 35]
+    assert clock.time() == START.timestamp() + 40
+
+
+def test_one_shot_job_runs_once():
+    clock, scheduler = create()
+    runs = []
+    job = scheduler.once("job", lambda: runs.append(clock.time() - START.timestamp()), delay_sec=3)
+    scheduler.run_until(START.timestamp() + 100)
+    assert runs == [3]
+    assert job.runs == 1
+    assert scheduler.jobs == []
+
+
+def test_jobs_run_in_due_order():
+    clock, scheduler = create()
+    runs = []
+    scheduler.every("a", 7, lambda: runs.append("a"))
+    scheduler.every("b", 5, lambda: runs.append("b"), initial_delay_sec=1)
+    scheduler.run_until(START.timestamp() + 15)
+    # a: 0, 7, 14  b: 1, 6, 11
+    assert runs == ["a", "b", "b", "a", "b", "a"]
+
+
+def test_cancelled_job_does_not_run():
+    clock, scheduler = create()
+    runs = []
+    job = scheduler.every("job", 10, lambda: runs.append(clock.time()))
+    scheduler.run_until(START.timestamp() + 15)
+    job.cancel()
+    scheduler.run_until(START.timestamp() + 100)
+    assert len(runs) == 2
+    assert scheduler.jobs == []
+
+
+def test_reschedule_brings_a_run_forward():
+    clock, scheduler = create()
+    runs = []
+    job = scheduler.every("job", 60, lambda: runs.append(clock.time() - START.timestamp()), initial_delay_sec=60)
+    scheduler.run_until(START.timestamp() + 10)
+    scheduler.reschedule(job, 5)
+    scheduler.run_until(START.timestamp() + 200)
+    # the interval continues from the rescheduled run
+    assert runs == [15, 75, 135, 195]
+    assert scheduler.jobs == [job]
+
+
+def test_reschedule_does_not_postpone_a_run():
+    clock, scheduler = create()
+    runs = []
+    job = scheduler.every("job", 60, lambda: runs.append(clock.time() - START.timestamp()), initial_delay_sec=20)
+    scheduler.reschedule(job, 30)
+    scheduler.run_until(START.timestamp() + 30)
+    assert runs == [20]
+
+
+def test_reschedule_of_a_cancelled_job_is_ignored():
+    clock, scheduler = create()
+    runs = []
+    job = scheduler.every("job", 60, lambda: runs.append(clock.time()), initial_delay_sec=60)
+    job.cancel()
+    scheduler.reschedule(job, 1)
+    scheduler.run_until(START.timestamp() + 200)
+    assert runs == []
+
+
+def test_job_may_change_its_interval():
+    clock, scheduler = create()
+    runs = []
+
+    def func():
+        runs.append(clock.time() - START.timestamp())
+        job.interval_sec = 2 * job.interval_sec
+
+    job = scheduler.every("job", 1, func)
+    scheduler.run_until(START.timestamp() + 20)
+    # the changed interval applies from the current run
+    assert runs == [0, 2, 6, 14]
+
+
+def test_job_may_schedule_jobs_due_within_the_run():
+    clock, scheduler = create()
+    runs = []
+    scheduler.once("first", lambda: scheduler.once("second", lambda: runs.append(clock.time() - START.timestamp()), delay_sec=5), delay_sec=1)
+    scheduler.run_until(START.timestamp() + 10)
+    assert runs == [6]
+
+
+def test_overrun_skips_the_missed_runs():
+    clock, scheduler = create()
+    runs = []
+
+    def slow():
+        runs.append(clock.time() - START.timestamp())
+        if len(runs) == 1:
+            clock.advance_to(clock.time() + 25)
+
+    job = scheduler.every("job", 10, slow)
+    scheduler.run_until(START.timestamp() + 60)
+    assert runs == [0, 35, 45, 55]
+    assert job.overruns == 1
+
+
+def test_failing_job_keeps_running():
+    clock, scheduler = create()
+    runs = []
+
+    def fail():
+        runs.append(clock.time())
+        raise ValueError("test")
+
+    scheduler.every("job", 10, fail)
+    scheduler.run_until(START.timestamp() + 25)
+    assert len(runs) == 3
@@ -0,0 +1,137 @@
+import asyncio
+import pytest
+import tornado.web
+from time import monotonic, sleep
+from urllib.request import urlopen
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from heater import Heater
+from heater_fleet import HeaterConfig, HeaterFleet
+from heater_webthing import ShellyEventHandler
+from shelly import Shelly3Pro, SHELLY_SCRIPT_TEMPLATE, shared_event_loop
+from shelly_simulator import ShellySimulator
+
+
+def wait_until(condition, timeout_sec: float = 5):
+    deadline = monotonic() + timeout_sec
+    while not condition():
+        if monotonic() > deadline:
+            raise TimeoutError("condition not met within " + str(timeout_sec) + " sec")
+        sleep(0.01)
+
+
+@pytest.fixture
+def simulator():
+    simulator = ShellySimulator(num_switches=3, power_watt=500)
+    simulator.start()
+    yield simulator
+    simulator.stop()
+
+
+def start_heater(simulator: ShellySimulator, directory, callback_addr: str = None) -> Heater:
+    # the sync period is long, so that the state changes of the tests are not taken over by polling
+    heater = Heater(simulator.addr, str(directory), callback_addr, num_heating_rods=3, min_sync_period_sec=600, max_sync_period_sec=600,
+                    state_file=str(directory / "heater_state.bin"))
+    heater.start()
+    wait_until(lambda: heater.startup_state == Heater.STARTUP_READY)
+    wait_until(lambda: len([script for script in simulator.scripts.values() if script['running']]) == 3)
+    return heater
+
+
+def rpc(simulator: ShellySimulator, request: str):
+    with urlopen(simulator.addr + "/rpc/" + request, timeout=5) as response:
+        return response.read()
+
+
+def test_command_switches_the_device(simulator, tmp_path):
+    heater = start_heater(simulator, tmp_path)
+    try:
+        heater.set_heating_rods_active(2)
+        assert len([output for output in simulator.outputs.values() if output]) == 2
+        heater.set_heating_rods_active(0)
+        assert simulator.outputs == {0: False, 1: False, 2: False}
+        assert simulator.requests["Switch.Set"] == 4
+    finally:
+        heater.stop()
+
+
+def test_query_all_is_parsed(simulator, tmp_path):
+    heater = start_heater(simulator, tmp_path)
+    try:
+        rpc(simulator, "Switch.Set?id=1&on=true")
+        sleep(0.1)
+        states = heater.shelly.query_all()
+        assert {id: status.is_on for id, status in states.items()} == {0: False, 1: True, 2: False}
+        assert states[1].power == 500
+        assert states[0].power == 0
+        assert states[1].energy > 0
+    finally:
+        heater.stop()
+
+
+def test_pushed_event_is_applied(simulator, tmp_path):
+    sockets = bind_sockets(0, "127.0.0.1")
+    callback_addr = "http://127.0.0.1:" + str(sockets[0].getsockname()[1])
+    heater = Heater(simulator.addr, str(tmp_path), callback_addr, num_heating_rods=3, min_sync_period_sec=600, max_sync_period_sec=600,
+                    state_file=str(tmp_path / "heater_state.bin"))
+
+    async def serve() -> HTTPServer:
+        server = HTTPServer(tornado.web.Application([(r'/shelly/event', ShellyEventHandler, ShellyEventHandler.args({None: heater}))]))
+        server.add_sockets(sockets)
+        return server
+
+    server = asyncio.run_coroutine_threadsafe(serve(), shared_event_loop()).result()
+    try:
+        heater.start()
+        wait_until(lambda: heater.startup_state == Heater.STARTUP_READY)
+        wait_until(lambda: len([script for script in simulator.scripts.values() if script['running']]) == 3)
+        rpc(simulator, "Switch.Set?id=2&on=true")        # e.g. switched by the app of the device
+        wait_until(lambda: heater.heating_rods_active == 1)
+        assert heater.get_heating_rod(2).is_activated
+        rpc(simulator, "Switch.Set?id=2&on=false")
+        wait_until(lambda: heater.heating_rods_active == 0)
+        assert simulator.requests["Shelly.GetStatus"] <= 2       # not polled
+    finally:
+        heater.stop()
+        shared_event_loop().call_soon_threadsafe(server.stop)
+
+
+def test_scripts_are_not_uploaded_again(simulator, tmp_path):
+    heater = start_heater(simulator, tmp_path)
+    heater.stop()
+    uploads, lists = simulator.requests["Script.PutCode"], simulator.requests["Script.List"]
+    assert uploads >= 3
+    heater = start_heater(simulator, tmp_path)      # the deployed scripts have the same hashes
+    try:
+        wait_until(lambda: simulator.requests["Script.List"] > lists)
+        sleep(0.2)      # an upload would follow the list immediately
+        assert simulator.requests["Script.PutCode"] == uploads
+        assert len(simulator.scripts) == 3
+    finally:
+        heater.stop()
+
+
+def test_deploy_with_matching_hashes_uploads_nothing(simulator):
+    shelly = Shelly3Pro(simulator.addr)
+    scripts = {id + 1: ("auto_off_" + str(id), SHELLY_SCRIPT_TEMPLATE.substitute({"id": id, "callback": "", "auto_off_ms": 60000})) for id in range(0, 3)}
+    assert sorted(shelly.deploy_scripts_async(scripts).result(timeout=5)) == [1, 2, 3]
+    assert simulator.requests["Script.PutCode"] == 3
+    assert shelly.deploy_scripts_async(scripts).result(timeout=5) == []
+    assert simulator.requests["Script.PutCode"] == 3
+    simulator.scripts[2]['running'] = False        # e.g. stopped after a crash of the script
+    assert shelly.deploy_scripts_async(scripts).result(timeout=5) == []
+    assert simulator.requests["Script.PutCode"] == 3
+    assert simulator.scripts[2]['running']
+
+
+def test_fleet_reports_an_unreachable_device(simulator, tmp_path):
+    configs = [HeaterConfig("reachable", simulator.addr, min_sync_period_sec=0.2, max_sync_period_sec=0.5, state_file=str(tmp_path / "reachable_state.bin")),
+               HeaterConfig("unreachable", "http://127.0.0.1:1", min_sync_period_sec=0.2, max_sync_period_sec=0.5, sync_timeout_sec=1,
+                            state_file=str(tmp_path / "unreachable_state.bin"))]
+    fleet = HeaterFleet(configs, str(tmp_path))
+    fleet.start()
+    try:
+        wait_until(lambda: fleet.heaters["reachable"].startup_state == Heater.STARTUP_READY)
+        wait_until(lambda: fleet.heaters["unreachable"].startup_state == Heater.STARTUP_DEVICE_UNREACHABLE)
+    finally:
+        fleet.stop()
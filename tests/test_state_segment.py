@@ -0,0 +1,43 @@
+import pytest
+from datetime import datetime
+from heater import Heater, HeaterSnapshot
+from state_segment import StateSegment, StateSegmentReader
+
+
+def snapshot(version: int) -> HeaterSnapshot:
+    return HeaterSnapshot(version, datetime(2026, 3, 2, 10, 0), 1000, 500, 3, 2, 2, {0: True, 1: True, 2: False}, 1200, 35000,
+                          "ok", "ready", 36000, 125, 250, 500, datetime(2026, 3, 2, 9, 0), datetime(2026, 3, 2, 10, 0))
+
+
+def test_written_state_is_read(tmp_path):
+    filename = str(tmp_path / "state.bin")
+    segment = StateSegment(filename)
+    reader = StateSegmentReader(filename)
+    assert reader.read() is None
+    segment.write(snapshot(7))
+    state = reader.read()
+    assert state["version"] == 7
+    assert state["heating_rods_activated"] == {0: True, 1: True, 2: False}
+    assert state["startup_state"] == "ready"
+    reader.close()
+    segment.close()
+
+
+def test_second_writer_fails(tmp_path):
+    filename = str(tmp_path / "state.bin")
+    segment = StateSegment(filename)
+    segment.write(snapshot(3))
+    with pytest.raises(ValueError):
+        StateSegment(filename)
+    assert StateSegmentReader(filename).read()["version"] == 3      # not clobbered
+    segment.close()
+    StateSegment(filename).close()      # released on close
+
+
+def test_default_state_file_is_derived_from_the_directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(Heater, "STATE_DIRECTORY", str(tmp_path))
+    assert Heater.default_state_file("/var/lib/heater") == str(tmp_path / "heater_var_lib_heater_state.bin")
+    assert Heater.default_state_file("/var/lib/heater", "garage") == str(tmp_path / "heater_var_lib_heater_garage_state.bin")
+    assert Heater.default_state_file("/srv/heater-2") != Heater.default_state_file("/srv/heater-1")
+    monkeypatch.setattr(Heater, "STATE_DIRECTORY", str(tmp_path / "missing"))
+    assert Heater.default_state_file("/var/lib/heater") == "/var/lib/heater/heater_state.bin"
@@ -0,0 +1,127 @@
+from datetime import datetime
+from clock import VirtualClock
+from replay import InlineExecutor
+from scheduler import Scheduler
+from surplus import StubSurplusSource, SurplusController
+
+
+START = datetime(2025, 6, 1, 12, 0)
+
+
+class StubHeater:
+    # switches the rods immediately
+
+    HEATER_ROD_POWER = 1000
+
+    def __init__(self, name: str = None, heating_rods: int = 3):
+        self.name = name
+        self.heating_rods = heating_rods
+        self.heating_rods_active = 0
+        self.commands = []
+
+    @property
+    def power(self) -> int:
+        return self.heating_rods_active * self.HEATER_ROD_POWER
+
+    def set_heating_rods_active(self, new_num: int, reason: str = None):
+        self.heating_rods_active = new_num
+        self.commands.append(new_num)
+
+
+class Setup:
+
+    def __init__(self, name: str = None, **kwargs):
+        self.clock = VirtualClock(START)
+        self.scheduler = Scheduler("test scheduler", self.clock)
+        self.heater = StubHeater(name)
+        self.source = StubSurplusSource()
+        self.controller = SurplusController(self.heater, self.source, self.scheduler, executor=InlineExecutor(), clock=self.clock, **kwargs)
+        self.controller.start()
+
+    def surplus_at(self, offset_sec: float, surplus: float):
+        # the surplus sampled after the heater has been switched, i.e. the consumption of the heater is already deducted
+        self.scheduler.run_until(START.timestamp() + offset_sec)
+        self.source.set_surplus(surplus)
+
+    def run_until(self, offset_sec: float):
+        self.scheduler.run_until(START.timestamp() + offset_sec)
+
+
+def test_hysteresis():
+    setup = Setup(hysteresis_watt=100)
+    setup.surplus_at(0, 1050)
+    assert setup.heater.heating_rods_active == 0
+    setup.surplus_at(100, 1150)
+    assert setup.heater.heating_rods_active == 1
+    setup.surplus_at(200, -50)      # available 950 W
+    assert setup.heater.heating_rods_active == 1
+    setup.surplus_at(300, -150)
+    assert setup.heater.heating_rods_active == 0
+
+
+def test_min_on_time_delays_the_decrease():
+    setup = Setup(min_on_sec=60, settle_sec=15, feed_latency_sec=5)
+    setup.surplus_at(0, 1500)
+    assert setup.heater.commands == [1]
+    setup.surplus_at(20, -800)
+    assert setup.heater.heating_rods_active == 1
+    setup.run_until(59)
+    assert setup.heater.heating_rods_active == 1
+    setup.run_until(60)     # recheck with the latest surplus
+    assert setup.heater.commands == [1, 0]
+
+
+def test_min_off_time_delays_the_increase():
+    setup = Setup(min_on_sec=0, min_off_sec=120, settle_sec=15, feed_latency_sec=5)
+    setup.surplus_at(0, 1500)
+    setup.surplus_at(20, -800)
+    assert setup.heater.commands == [1, 0]
+    setup.surplus_at(40, 1500)
+    setup.run_until(139)
+    assert setup.heater.commands == [1, 0]
+    setup.run_until(140)
+    assert setup.heater.commands == [1, 0, 1]
+
+
+def test_samples_before_the_feed_latency_are_ignored():
+    setup = Setup(min_on_sec=0, settle_sec=0, feed_latency_sec=5)
+    setup.surplus_at(0, 1500)
+    setup.surplus_at(3, -800)       # sampled before the command took effect
+    setup.run_until(60)
+    assert setup.heater.commands == [1]
+    assert len(setup.scheduler.jobs) == 0
+    setup.surplus_at(61, -800)
+    assert setup.heater.commands == [1, 0]
+
+
+def test_settle_time_delays_the_next_command():
+    setup = Setup(min_on_sec=0, settle_sec=15, feed_latency_sec=5)
+    setup.surplus_at(0, 1500)
+    setup.surplus_at(6, -800)
+    assert setup.heater.commands == [1]
+    setup.run_until(15)
+    assert setup.heater.commands == [1, 0]
+
+
+def test_newer_sample_brings_the_recheck_forward():
+    setup = Setup(name="garage", min_on_sec=30, min_off_sec=0, settle_sec=15, feed_latency_sec=5, increase_interval_sec=60)
+    setup.surplus_at(0, 1500)
+    setup.surplus_at(10, 1500)      # increase awaits the increase interval (60 sec)
+    [job] = setup.scheduler.jobs
+    assert job.name == "garage surplus recheck"
+    setup.surplus_at(12, -800)      # decrease awaits the min on time (30 sec) only
+    setup.run_until(29)
+    assert setup.heater.commands == [1]
+    setup.run_until(30)
+    assert setup.heater.commands == [1, 0]
+    setup.run_until(120)
+    assert setup.heater.commands == [1, 0]
+
+
+def test_stop_cancels_the_recheck():
+    setup = Setup(min_on_sec=60)
+    setup.surplus_at(0, 1500)
+    setup.surplus_at(20, -800)
+    setup.controller.stop()
+    setup.run_until(120)
+    assert setup.heater.commands == [1]